@@ -0,0 +1,10 @@
+""" Benchmarks for findoutlie metrics, detectors and pipelines
+
+Run the benchmarks from the root directory (containing ``README.md``) with::
+
+    python3 -m findoutlie.benchmarks.run_benchmarks --output bench.json
+
+and compare against a previous run with::
+
+    python3 -m findoutlie.benchmarks.run_benchmarks --compare old_bench.json
+"""
@@ -0,0 +1,314 @@
+""" Time metrics, detectors and pipelines on synthetic images
+
+Run as:
+
+    python3 -m findoutlie.benchmarks.run_benchmarks --output bench.json
+
+For each image in a grid of sizes, data types and compression, record the
+best time over repeats, and the peak memory allocated (from ``tracemalloc``)
+for each benchmarked function.  We also time importing the main modules, in
+a fresh Python process, because scripts pay that cost on every run.  Results
+are saved as JSON.  Use
+``--compare`` with an earlier JSON file to list functions that got slower, or
+used more memory.
+"""
+
+from pathlib import Path
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie import __version__
+from findoutlie import outfind
+from findoutlie.metrics import dvars, dvars_voxel
+from findoutlie.detectors import (mad_voxel_detector, mad_voxel_counts,
+                                  mad_time_detector, iqr_detector)
+from findoutlie.spm_funcs import get_spm_globals
+from findoutlie.benchmarks.synthetic import write_image
+
+# (volume shape, number of volumes)
+SIZES = [
+    ((32, 32, 16), 100),
+    ((64, 64, 32), 200),
+    ((64, 64, 32), 600),
+]
+
+QUICK_SIZES = [((16, 16, 8), 40)]
+
+DTYPES = ('int16', 'float32')
+
+COMPRESSED = (True, False)
+
+# Modules for which to time import in a fresh process.
+IMPORT_MODULES = ('findoutlie.outfind',)
+
+# Code for child process, printing import time in seconds, and peak RSS in MB.
+_IMPORT_CODE = '''\
+import resource, sys, time
+start = time.perf_counter()
+import {module}
+wall = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(wall, peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10)
+'''
+
+
+def image_benchmarks(fname):
+    """ Return list of (name, function) pairs to benchmark for image `fname`
+
+    Array inputs are prepared here, so they are not part of the timings.
+    """
+    data = nib.load(fname).get_fdata()
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    brain = outfind.segment_brain(voxels)
+    dvs = dvars_voxel(brain)
+    return [
+        ('metrics.dvars', lambda: dvars(nib.load(fname))),
+        ('metrics.dvars_voxel', lambda: dvars_voxel(brain)),
+        ('detectors.mad_voxel_detector', lambda: mad_voxel_detector(brain)),
+        ('detectors.mad_voxel_counts', lambda: mad_voxel_counts(brain)),
+        ('detectors.mad_time_detector',
+         lambda: mad_time_detector(dvs, lower_bound=True)),
+        ('detectors.iqr_detector', lambda: iqr_detector(dvs)),
+        ('spm_funcs.get_spm_globals', lambda: get_spm_globals(fname)),
+        ('outfind.load_run', lambda: outfind.load_run(fname)),
+        ('outfind.detect_outliers_mad_median_absolute_deviation_mask',
+         lambda: outfind.detect_outliers_mad_median_absolute_deviation_mask(
+             fname)),
+        ('outfind.detect_outliers_mad_dvars_mask',
+         lambda: outfind.detect_outliers_mad_dvars_mask(fname)),
+        ('outfind.detect_outliers_mad_sliding_window_mask',
+         lambda: outfind.detect_outliers_mad_sliding_window_mask(fname)),
+        ('outfind.file_outliers', lambda: outfind.file_outliers(fname)),
+    ]
+
+
+def measure(func, repeat=3):
+    """ Return best time in seconds, and peak allocated MB, for `func`
+
+    Timings are without ``tracemalloc``, which slows allocations.  Peak memory
+    is from a separate call with ``tracemalloc`` running.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def measure_import(module, repeat=3):
+    """ Return best time in seconds, and peak RSS MB, to import `module`
+
+    Each import is in a new Python process, so nothing is already imported.
+    Peak RSS includes the Python interpreter itself.
+    """
+    package_root = str(Path(__file__).parent.parent.parent)
+    times, peaks = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', _IMPORT_CODE.format(module=module)],
+            capture_output=True, text=True, check=True,
+            cwd=package_root).stdout
+        wall, peak = output.split()
+        times.append(float(wall))
+        peaks.append(float(peak))
+    return min(times), min(peaks)
+
+
+def import_benchmarks(modules=IMPORT_MODULES, repeat=3, names=None):
+    """ Return list of result dicts for import times of `modules`
+    """
+    results = []
+    for module in modules:
+        name = f'import {module}'
+        if names is not None and name not in names:
+            continue
+        best, peak_mb = measure_import(module, repeat)
+        results.append({
+            'name': name,
+            'shape': [],
+            'n_vols': 0,
+            'dtype': '',
+            'compressed': False,
+            'time': best,
+            'peak_mb': peak_mb,
+        })
+    return results
+
+
+def git_commit():
+    """ Return current git commit of the repository, or None
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=SIZES, dtypes=DTYPES, compressed=COMPRESSED,
+                   repeat=3, names=None):
+    """ Run benchmarks over grid of images, return results dict
+
+    Parameters
+    ----------
+    sizes : sequence, optional
+        Sequence of (volume shape, number of volumes) pairs.
+    dtypes : sequence, optional
+        Sequence of image data types on disk.
+    compressed : sequence, optional
+        Sequence of booleans, True for ``.nii.gz`` images, False for ``.nii``.
+    repeat : int, optional
+        Number of timed calls for each function; we record the best.
+    names : sequence, optional
+        If not None, only run benchmarks with these names.  Import benchmarks
+        have names like "import findoutlie.outfind".
+
+    Returns
+    -------
+    results : dict
+        With keys "meta" (dict describing versions and commit) and "results"
+        (list of dicts, one per benchmark and image, and one per import
+        benchmark).
+    """
+    results = import_benchmarks(repeat=repeat, names=names)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for (shape, n_vols), dtype, gz in itertools.product(
+                sizes, dtypes, compressed):
+            ext = '.nii.gz' if gz else '.nii'
+            fname = Path(tmpdir) / f'sub-01_bench_bold{ext}'
+            write_image(fname, shape, n_vols, dtype)
+            for name, func in image_benchmarks(fname):
+                if names is not None and name not in names:
+                    continue
+                best, peak_mb = measure(func, repeat)
+                results.append({
+                    'name': name,
+                    'shape': list(shape),
+                    'n_vols': n_vols,
+                    'dtype': dtype,
+                    'compressed': gz,
+                    'time': best,
+                    'peak_mb': peak_mb,
+                })
+    meta = {
+        'version': __version__,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'nibabel': nib.__version__,
+        'machine': platform.machine(),
+    }
+    return {'meta': meta, 'results': results}
+
+
+def _result_key(result):
+    return (result['name'], tuple(result['shape']), result['n_vols'],
+            result['dtype'], result['compressed'])
+
+
+def compare_results(old, new, tolerance=0.2):
+    """ Return descriptions of benchmarks in `new` that are worse than `old`
+
+    Parameters
+    ----------
+    old : dict
+        Results from :func:`run_benchmarks`.
+    new : dict
+        Results from :func:`run_benchmarks`.
+    tolerance : float, optional
+        Fractional increase in time or peak memory to allow before reporting
+        a regression.
+
+    Returns
+    -------
+    regressions : list
+        List of strings, one for each regression.
+    """
+    old_results = {_result_key(r): r for r in old['results']}
+    regressions = []
+    for result in new['results']:
+        key = _result_key(result)
+        if key not in old_results:
+            continue
+        for field in ('time', 'peak_mb'):
+            before, after = old_results[key][field], result[field]
+            if after > before * (1 + tolerance) and after - before > 1e-3:
+                regressions.append(
+                    f'{key[0]} {key[1:]}: {field} {before:.4g} -> {after:.4g}')
+    return regressions
+
+
+def format_results(results):
+    """ Return table of `results` as string
+    """
+    lines = [f'{"benchmark":<60} {"image":<32} {"time (s)":>9} {"peak MB":>9}']
+    for r in results['results']:
+        image = (f'{"x".join(map(str, r["shape"]))}x{r["n_vols"]} '
+                 f'{r["dtype"]}{" gz" if r["compressed"] else ""}'
+                 if r['shape'] else '-')
+        lines.append(f'{r["name"]:<60} {image:<32} {r["time"]:>9.4f} '
+                     f'{r["peak_mb"]:>9.1f}')
+    return '\n'.join(lines)
+
+
+def get_parser():
+    parser = ArgumentParser(
+        description=__doc__,  # Usage from docstring
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--output", help="JSON file to write results")
+    parser.add_argument("--compare",
+                        help="JSON file of earlier results to compare")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fractional slowdown to allow in comparison "
+                        "(default 0.2)")
+    parser.add_argument("--quick", action="store_true",
+                        help="Run on one small image only")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed calls per benchmark")
+    parser.add_argument("--name", action="append",
+                        help="Only run benchmark with this name (can be "
+                        "given more than once)")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    results = run_benchmarks(QUICK_SIZES if args.quick else SIZES,
+                             repeat=args.repeat, names=args.name)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'wt') as fobj:
+            json.dump(results, fobj, indent=2)
+    if args.compare:
+        with open(args.compare, 'rt') as fobj:
+            old = json.load(fobj)
+        regressions = compare_results(old, results, args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+""" Make synthetic 4D images for benchmarking
+
+The images have an ellipsoid of bright "brain" voxels in a darker background,
+Gaussian noise, a linear drift over time, and a few spike volumes, where
+noise is added to the whole volume.
+"""
+
+import numpy as np
+
+import nibabel as nib
+
+
+def make_data(shape, n_vols, dtype=np.int16, n_spikes=3, drift=40.,
+              seed=0):
+    """ Make synthetic 4D data array
+
+    Parameters
+    ----------
+    shape : sequence
+        Shape of each 3D volume.
+    n_vols : int
+        Number of volumes.
+    dtype : dtype, optional
+        Data type of returned array.
+    n_spikes : int, optional
+        Number of spike volumes.
+    drift : float, optional
+        Size of linear drift from first to last volume.
+    seed : int, optional
+        Seed for random number generator.
+
+    Returns
+    -------
+    data : array
+        Array of shape ``tuple(shape) + (n_vols,)``.
+    spikes : array
+        Sorted indices of spike volumes.
+    """
+    rng = np.random.default_rng(seed)
+    shape = tuple(shape)
+    centre = (np.array(shape) - 1) / 2
+    grids = np.indices(shape).astype(float)
+    radius2 = sum(((g - c) / (c + 0.5)) ** 2 for g, c in zip(grids, centre))
+    base = np.where(radius2 < 0.7, 800., 30.).astype(np.float32)
+    data = np.empty(shape + (n_vols,), dtype=dtype)
+    spikes = np.sort(rng.choice(n_vols, min(n_spikes, n_vols), replace=False))
+    # Fill one volume at a time, to limit memory use for large images.
+    for i in range(n_vols):
+        vol = base + rng.normal(0, 20, shape).astype(np.float32)
+        vol += drift * i / max(n_vols - 1, 1)
+        if i in spikes:
+            vol += rng.normal(150, 50, shape).astype(np.float32)
+        data[..., i] = np.clip(vol, 0, None)
+    return data, spikes
+
+
+def make_image(shape, n_vols, dtype=np.int16, n_spikes=3, drift=40.,
+               seed=0):
+    """ Make synthetic 4D Nifti image
+
+    See :func:`make_data` for parameters.
+
+    Returns
+    -------
+    img : Nifti1Image
+        Synthetic image.
+    spikes : array
+        Sorted indices of spike volumes.
+    """
+    data, spikes = make_data(shape, n_vols, dtype, n_spikes, drift, seed)
+    img = nib.Nifti1Image(data, np.diag([3., 3., 3., 1.]))
+    img.set_data_dtype(dtype)
+    return img, spikes
+
+
+def write_image(fname, shape, n_vols, dtype=np.int16, n_spikes=3, drift=40.,
+                seed=0):
+    """ Write synthetic 4D image to `fname`, return spike indices
+
+    Use a filename ending in ``.nii.gz`` for a compressed image.  See
+    :func:`make_data` for other parameters.
+    """
+    img, spikes = make_image(shape, n_vols, dtype, n_spikes, drift, seed)
+    nib.save(img, fname)
+    return spikes
@@ -0,0 +1,189 @@
+""" Estimate peak memory, and choose block sizes to keep under a budget
+
+The memory for outlier detection on one run is mostly:
+
+* while loading: the block of volumes being read, on-disk and calculation
+  copies, and the float64 running sum for the mean image;
+* after loading: the brain voxels by time points array, plus temporary
+  arrays for the block of voxels that the metrics are working on.  With
+  ``voxel_jobs`` worker processes (see :mod:`findoutlie.voxelpool`), the
+  brain voxels are in shared memory, counted once, but each worker has its
+  own interpreter, and its own temporary arrays for its block of voxels.
+
+:func:`estimate_peak` models these from the image shape and data types, and
+:func:`plan_blocks` picks the largest volume and voxel blocks that keep the
+estimate under a budget, or raises ``MemoryError`` at once if even the
+smallest blocks will not fit.  Before the brain mask is known, we assume all
+voxels are brain voxels, so estimates for images are upper bounds.  Stores
+(see :mod:`findoutlie.store`) record the number of brain voxels, so their
+estimates are closer.
+"""
+
+import numpy as np
+
+from .cache import parse_size
+from .store import is_store, read_store
+from .voxelpool import TASKS_PER_JOB
+from .lazy import lazy_import
+
+nib = lazy_import('nibabel')
+
+# Allowance for the Python interpreter and imported modules.
+BASE_BYTES = 64 * 2 ** 20
+
+# Largest blocks to use; larger blocks give little extra speed.
+MAX_VOLUME_BLOCK = 16
+MAX_VOXEL_BLOCK = 2 ** 16
+
+# Block sizes without a memory budget.  Without a budget, dvars works on all
+# the voxels at once, and the voxel outlier counts on blocks of this size.
+DEFAULT_VOLUME_BLOCK = 1
+DEFAULT_VOXEL_BLOCK = 4096
+
+
+def run_info(fname):
+    """ Return size information for image or store `fname`, from headers
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, or store directory.
+
+    Returns
+    -------
+    info : dict
+        With keys "n_voxels", "n_volumes", "disk_itemsize" (bytes per value
+        on disk), "n_brain" (number of brain voxels, None if not known) and
+        "streamed" (True if the run is read from an image).
+    """
+    if is_store(fname):
+        mask, brain_voxels, meta = read_store(fname)
+        return {'n_voxels': mask.size, 'n_volumes': brain_voxels.shape[-1],
+                'disk_itemsize': brain_voxels.dtype.itemsize,
+                'n_brain': brain_voxels.shape[0], 'streamed': False}
+    header = nib.load(fname).header
+    shape = header.get_data_shape()
+    return {'n_voxels': int(np.prod(shape[:-1])), 'n_volumes': shape[-1],
+            'disk_itemsize': header.get_data_dtype().itemsize,
+            'n_brain': None, 'streamed': True}
+
+
+def estimate_peak(n_voxels, n_volumes, dtype=np.float64,
+                  volume_block=DEFAULT_VOLUME_BLOCK, voxel_block=None,
+                  disk_itemsize=8, n_brain=None, streamed=True,
+                  base=BASE_BYTES, voxel_jobs=1):
+    """ Return estimated peak memory in bytes for outlier detection on a run
+
+    Parameters
+    ----------
+    n_voxels : int
+        Number of voxels in each volume.
+    n_volumes : int
+        Number of volumes.
+    dtype : dtype, optional
+        Floating point type for calculations.
+    volume_block : int, optional
+        Number of volumes to read at a time.
+    voxel_block : int, optional
+        Number of voxels for metrics to work on at a time, in each voxel
+        worker process.  None for the defaults without a budget.
+    disk_itemsize : int, optional
+        Bytes per value in the image on disk.
+    n_brain : int, optional
+        Number of brain voxels.  If None, assume all voxels.
+    streamed : bool, optional
+        True if the run is read from an image, False for a store.
+    base : int, optional
+        Bytes to allow for the interpreter and modules, in each process.
+    voxel_jobs : int, optional
+        Number of worker processes for the per-voxel calculations.  If 1,
+        calculate in this process.
+
+    Returns
+    -------
+    n_bytes : int
+        Estimated peak memory in bytes, for this process and its voxel
+        workers together, including shared memory.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    n_brain = n_voxels if n_brain is None else n_brain
+    brain = n_brain * n_volumes * itemsize
+    load = 0
+    if streamed:
+        read = n_voxels * volume_block * (disk_itemsize + itemsize)
+        # Mean image sum, block sum and mask, then brain array filling.
+        load = max(read + n_voxels * 17,
+                   brain + read + n_brain * volume_block * itemsize)
+    # Rows for each task of a voxel pool; dvars works on a whole task at a
+    # time by default.
+    task_rows = (n_brain if voxel_jobs == 1 else
+                 -(-n_brain // (voxel_jobs * TASKS_PER_JOB)))
+    count_rows = min(voxel_block or DEFAULT_VOXEL_BLOCK, n_brain)
+    dvars_rows = min(voxel_block or task_rows, n_brain)
+    # Deviations, absolute deviations and partition copy, plus outliers, in
+    # each worker.
+    counts = voxel_jobs * count_rows * n_volumes * (3 * itemsize + 1)
+    # Differences and their squares, in each worker.
+    dvars = voxel_jobs * dvars_rows * max(n_volumes - 1, 0) * 2 * itemsize
+    workers = 0 if voxel_jobs == 1 else voxel_jobs * base
+    return int(base + workers +
+               max(load, brain + n_voxels + max(counts, dvars)))
+
+
+def plan_blocks(info, max_bytes, dtype=np.float64, base=BASE_BYTES,
+                voxel_jobs=1):
+    """ Return largest volume and voxel blocks keeping under `max_bytes`
+
+    Parameters
+    ----------
+    info : dict
+        Size information, from :func:`run_info`.
+    max_bytes : int or str
+        Memory budget, in bytes, or as string such as "4G".
+    dtype : dtype, optional
+        Floating point type for calculations.
+    base : int, optional
+        Bytes to allow for the interpreter and modules, in each process.
+    voxel_jobs : int, optional
+        Number of worker processes for the per-voxel calculations, sharing
+        `max_bytes`.
+
+    Returns
+    -------
+    volume_block : int
+        Number of volumes to read at a time.
+    voxel_block : int
+        Number of voxels for metrics to work on at a time, in each voxel
+        worker.
+
+    Raises
+    ------
+    MemoryError
+        If the run will not fit in `max_bytes`, even with the smallest
+        blocks.
+    """
+    max_bytes = parse_size(max_bytes)
+    n_brain = (info['n_voxels'] if info['n_brain'] is None
+               else info['n_brain'])
+    volume_block = min(MAX_VOLUME_BLOCK, info['n_volumes'])
+    voxel_block = max(min(MAX_VOXEL_BLOCK, n_brain), 1)
+
+    def estimate(volume_block, voxel_block):
+        return estimate_peak(dtype=dtype, volume_block=volume_block,
+                             voxel_block=voxel_block, base=base,
+                             voxel_jobs=voxel_jobs, **info)
+
+    while estimate(volume_block, voxel_block) > max_bytes:
+        if volume_block == 1 and voxel_block == 1:
+            needed = estimate(1, 1) / 2 ** 20
+            raise MemoryError(
+                f'Need at least {needed:.1f} MB, but budget is '
+                f'{max_bytes / 2 ** 20:.1f} MB')
+        # Halve the block with the larger memory cost.
+        read_cost = info['n_voxels'] * volume_block
+        voxel_cost = voxel_block * info['n_volumes'] * voxel_jobs
+        if voxel_block > 1 and (voxel_cost >= read_cost or volume_block == 1):
+            voxel_block //= 2
+        else:
+            volume_block //= 2
+    return volume_block, voxel_block
@@ -0,0 +1,224 @@
+""" On-disk cache of per-run metrics
+
+The outlier detectors only need a few 1D metrics per run (voxel outlier
+counts, dvars, volume means) and the brain mask.  These are slow to calculate
+but small, so we store them in a cache directory, one compressed ``.npz``
+file per run.  Files are named by a key made from the SHA1 hash of the image
+contents, the parameters used to calculate the metrics, the package version
+and :data:`METRICS_FORMAT`, so any change in the data or the calculation
+gives a new entry.
+
+The cache has a maximum size.  When a new entry takes the cache over this
+size, we delete the least recently used entries.
+"""
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from . import __version__
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'findoutlie'
+
+DEFAULT_MAX_BYTES = 2 ** 30
+
+# Version of the metric calculations.  Increase this for any change to the
+# code that changes the cached values, so older entries are not used.
+METRICS_FORMAT = 1
+
+_SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_size(size):
+    """ Return number of bytes from string `size` such as "512M" or "2G"
+
+    Parameters
+    ----------
+    size : str or int
+        Size in bytes, or with suffix "K", "M", "G" or "T" (optionally
+        followed by "B"), for binary kilobytes, megabytes etc.
+
+    Returns
+    -------
+    n_bytes : int
+        Size in bytes.
+    """
+    if isinstance(size, int):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*$', size.upper())
+    if match is None:
+        raise ValueError(f'Cannot interpret "{size}" as a size')
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit])
+
+
+def file_hash(filename, chunk_size=2 ** 20):
+    """ Return SHA1 hexadecimal hash string for contents of `filename`
+
+    Reads the file in chunks of `chunk_size` bytes, so memory use does not
+    depend on the file size.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def path_key(fname):
+    """ Return key for file `fname` from its resolved path, mtime and size
+
+    The key changes if the file is modified, without reading the file
+    contents.
+    """
+    path = Path(fname).resolve()
+    stat = path.stat()
+    spec = json.dumps([str(path), stat.st_mtime_ns, stat.st_size])
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+
+def read_hash_lists(data_directory):
+    """ Read SHA1 hashes from ``hash_list.txt`` files in `data_directory`
+
+    File names in ``hash_list.txt`` are relative to the directory containing
+    the group directory, as in ``data/group-01/hash_list.txt``.
+
+    Parameters
+    ----------
+    data_directory : str or Path
+        Directory containing ``hash_list.txt`` files.
+
+    Returns
+    -------
+    hashes : dict
+        Dictionary with keys being resolved file paths and values being SHA1
+        hashes.
+    """
+    hashes = {}
+    for hash_pth in Path(data_directory).glob('**/hash_list.txt'):
+        root = hash_pth.parent.parent
+        for line in hash_pth.read_text().splitlines():
+            if not line.strip():
+                continue
+            expected_hash, fname = line.split()
+            hashes[(root / fname).resolve()] = expected_hash
+    return hashes
+
+
+def evict_lru(directory, pattern, max_bytes):
+    """ Delete least recently used files in `directory` to fit `max_bytes`
+
+    Files matching glob `pattern` are deleted in order of modification time,
+    oldest first, until their total size is no more than `max_bytes`.  Caches
+    set the modification time when they use a file, so this is the least
+    recently used order.  Files that other processes delete while we work
+    are skipped.
+    """
+    entries = []
+    for path in Path(directory).glob(pattern):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # Deleted by another process.
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:  # Deleted by another process.
+            pass
+        total -= size
+
+
+class MetricsCache:
+    """ Least recently used cache of per-run metrics in a directory
+
+    Parameters
+    ----------
+    cache_dir : str or Path, optional
+        Directory for cache files.
+    max_bytes : int or str, optional
+        Maximum total size of the cache files, see :func:`parse_size`.
+    refresh : bool, optional
+        If True, ignore existing entries; recalculate and overwrite them.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES, refresh=False):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = parse_size(max_bytes)
+        self.refresh = refresh
+        # Apply a lower maximum size now, rather than on the next new entry.
+        self.evict()
+
+    def key(self, content_hash, params):
+        """ Return key for image with hash `content_hash`, and `params`
+
+        Parameters
+        ----------
+        content_hash : str
+            SHA1 hash of the image file contents.
+        params : dict
+            Parameters used to calculate the metrics.  Values must be
+            serializable to JSON.
+        """
+        spec = json.dumps({'content_hash': content_hash,
+                           'params': params,
+                           'version': __version__,
+                           'format': METRICS_FORMAT}, sort_keys=True)
+        return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f'{key}.npz'
+
+    def get(self, key):
+        """ Return dict of metrics for `key`, or None if not in cache
+        """
+        if self.refresh:
+            return None
+        path = self._path(key)
+        # Another process may evict the entry at any time, so treat a
+        # missing file as a miss, rather than checking first.
+        try:
+            with np.load(path) as npz:
+                metrics = dict(npz)
+        except FileNotFoundError:
+            return None
+        # Mark as recently used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # Evicted since we read it.
+            pass
+        return metrics
+
+    def put(self, key, metrics):
+        """ Store dict of arrays `metrics` for `key`, then evict if needed
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename, so other processes never see
+        # a partial file.
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                np.savez_compressed(fobj, **metrics)
+            os.replace(tmp_name, self._path(key))
+        except FileNotFoundError:
+            # Another process removed the cache directory; the metrics are
+            # still valid, so carry on without caching them.
+            return
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def evict(self):
+        """ Delete least recently used entries until under ``max_bytes``
+        """
+        evict_lru(self.cache_dir, '*.npz', self.max_bytes)
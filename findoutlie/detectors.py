@@ -12,9 +12,9 @@ requirements are met and raise an error otherwise.
 
 # Any imports you need
 # +++your code here+++
-import numpy as np
+from functools import partial
 
-from scipy.stats import norm
+import numpy as np
 
 def mad_voxel_detector(img,threshold=3.5):
     """ Detect outliers in 'img' using mediaan absolute deviation.
@@ -39,37 +39,187 @@ def mad_voxel_detector(img,threshold=3.5):
     """
     # Calculate median per voxel
     med = np.expand_dims(np.nanmedian(img,axis=-1),axis=1)
+    # Calculate absolute deviations once, for the MAD and the outliers
+    abs_dev = np.abs(img-med)
     # Calculate mean absolute deviation per voxel
-    mad = np.expand_dims(np.nanmedian(np.abs(img-med),axis=-1),axis=1)
+    mad = np.expand_dims(np.nanmedian(abs_dev,axis=-1),axis=1)
     # calculate the outliers
-    outlier_tf = np.abs(img-med)>(threshold*mad)
+    outlier_tf = abs_dev>(threshold*mad)
     return outlier_tf
 
+
+def median_last(values):
+    """ Median along last axis of `values`, which must not contain NaNs
+
+    Uses selection with ``np.partition`` rather than a full sort.  Gives the
+    same result as ``np.median(values, axis=-1)``.
+
+    Parameters
+    ----------
+    values : array
+        Array with no NaN values.
+
+    Returns
+    -------
+    med : array
+        Median over last axis, with shape ``values.shape[:-1]``.
+    """
+    n = values.shape[-1]
+    half = n // 2
+    if n % 2:
+        return np.partition(values, half, axis=-1)[..., half]
+    part = np.partition(values, [half - 1, half], axis=-1)
+    return (part[..., half - 1] + part[..., half]) / 2
+
+
+def mad_voxel_counts(img, threshold=3.5, block_size=4096):
+    """ Count outlying voxels per time point, as for `mad_voxel_detector`
+
+    Gives the same result as ``np.sum(mad_voxel_detector(img, threshold),
+    axis=0)``, but works on blocks of `block_size` voxels (rows) at a time,
+    so never builds the full boolean outlier array, or full size temporary
+    arrays.  Blocks without NaNs use ``np.partition`` for the medians,
+    blocks with NaNs fall back to ``np.nanmedian``.
+
+    Parameters
+    ----------
+    img : 2D array
+        Values for which we will detect outliers, voxels in rows, time points
+        in columns.
+    threshold : float, optional
+        Scalar to multiply the median absolute deviation
+        to form the upper and lower threshold. Default is 3.5.
+    block_size : int, optional
+        Number of voxels (rows) to process at a time.
+
+    Returns
+    -------
+    counts : 1D array
+        Number of outlying voxels for each time point (column) in `img`.
+    """
+    counts = np.zeros(img.shape[-1], dtype=np.intp)
+    for start in range(0, img.shape[0], block_size):
+        block = img[start:start + block_size]
+        if np.isnan(block).any():
+            median = partial(np.nanmedian, axis=-1)
+        else:
+            median = median_last
+        abs_dev = np.abs(block - median(block)[:, None])
+        mad = median(abs_dev)[:, None]
+        counts += np.count_nonzero(abs_dev > threshold * mad, axis=0)
+    return counts
+
+
+def voxel_subset(n_voxels, subsample, seed=0):
+    """ Return sorted indices of a random subset of `n_voxels` voxels
+
+    Parameters
+    ----------
+    n_voxels : int
+        Number of voxels to choose from.
+    subsample : float or int
+        If float, fraction of voxels to choose, in (0, 1].  If int, number of
+        voxels to choose; all voxels if `subsample` >= `n_voxels`.
+    seed : int, optional
+        Seed for random number generator, so the subset is repeatable.
+
+    Returns
+    -------
+    indices : 1D array
+        Sorted indices of chosen voxels.
+    """
+    if isinstance(subsample, (int, np.integer)):
+        if subsample < 1:
+            raise ValueError('Voxel count must be at least 1')
+        n_chosen = min(int(subsample), n_voxels)
+    else:
+        if not 0 < subsample <= 1:
+            raise ValueError('Voxel fraction must be > 0 and <= 1')
+        n_chosen = max(int(round(n_voxels * subsample)), min(n_voxels, 1))
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n_voxels, n_chosen, replace=False))
+
+
+def mad_voxel_count_sweep(img, thresholds, block_size=4096):
+    """ Count outlying voxels per time point, for each of `thresholds`
+
+    Gives the same result as ``[mad_voxel_counts(img, t) for t in
+    thresholds]``, but calculates the medians and deviations once.  For each
+    block of voxels, we sort the deviations, divided by the voxel MAD, for
+    each time point, so the count for each threshold is a binary search
+    (``np.searchsorted``) rather than a new comparison over all voxels.
+
+    Parameters
+    ----------
+    img : 2D array
+        Values for which we will detect outliers, voxels in rows, time points
+        in columns.
+    thresholds : sequence
+        Non-negative scalars to multiply the median absolute deviation to form
+        the upper and lower thresholds.
+    block_size : int, optional
+        Number of voxels (rows) to process at a time.
+
+    Returns
+    -------
+    counts : 2D array
+        Number of outlying voxels, with one row per threshold, and one column
+        per time point (column) in `img`.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    counts = np.zeros((len(thresholds), img.shape[-1]), dtype=np.intp)
+    for start in range(0, img.shape[0], block_size):
+        block = img[start:start + block_size]
+        if np.isnan(block).any():
+            median = partial(np.nanmedian, axis=-1)
+        else:
+            median = median_last
+        abs_dev = np.abs(block - median(block)[:, None])
+        mad = median(abs_dev)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normed = abs_dev / mad
+        # Zero MAD: any deviation is an outlier, no deviation is not.
+        normed[(mad == 0) & (abs_dev == 0)] = 0
+        # NaN values are never outliers.
+        normed[np.isnan(normed)] = -np.inf
+        normed.sort(axis=0)
+        n_voxels = normed.shape[0]
+        for col in range(normed.shape[1]):
+            counts[:, col] += n_voxels - np.searchsorted(
+                normed[:, col], thresholds, side='right')
+    return counts
+
+
 def mad_time_detector(measures, lower_bound, threshold=3.5):
     """ Detect outliers in 'measures' using median absolute deviation.
     Returns 1D vector of same length as 'measures', where True means the corresponsding 
     value in 'measures' is an outlier.
 
     Call med as median and mad as median absolute deviation of the 'measures'
+
+    For a 2D 'measures', detect outliers in each row separately.
     
     Parameters
     ----------
-    measures : 1D array
+    measures : 1D or 2D array
         Values for which we will detect outliers
+    lower_bound : bool
+        If True, values below the median can be outliers, otherwise only
+        values above the median.
     threshold : float, optional
         Scalar to multiply the median aboslute deviation to form the upper threshold. 
         Default is 3.5.
     
     Returns
     -------
-    outlier_tf : 1D boolean array
-        1D boolean array of same length as 'measures', where True means the 
+    outlier_tf : boolean array
+        Boolean array of same shape as 'measures', where True means the 
         corresponding value in 'measures' is an outlier. 
     """
     # Calculate median of measures
-    med = np.median(measures)
+    med = np.median(measures, axis=-1, keepdims=True)
     # Calculate median absoulte deviation of measures
-    mad = np.median(np.abs(measures-med))
+    mad = np.median(np.abs(measures-med), axis=-1, keepdims=True)
     # Calculate the outliers
     if lower_bound:
         outlier_tf = np.abs(measures-med)>threshold*mad
@@ -77,6 +227,134 @@ def mad_time_detector(measures, lower_bound, threshold=3.5):
         outlier_tf = measures>med+threshold*mad
     return outlier_tf
 
+
+def mad_time_sweep(measures, lower_bound, thresholds):
+    """ Detect outliers in `measures` for each of `thresholds`
+
+    Gives the same result as ``[mad_time_detector(measures, lower_bound, t)
+    for t in thresholds]``, from one calculation of the median and MAD.
+
+    Parameters
+    ----------
+    measures : 1D or 2D array
+        Values for which we will detect outliers.
+    lower_bound : bool
+        If True, values below the median can be outliers, otherwise only
+        values above the median.
+    thresholds : sequence
+        Scalars to multiply the median absolute deviation to form the
+        thresholds.
+
+    Returns
+    -------
+    outlier_tf : boolean array
+        Array of shape ``(len(thresholds),) + measures.shape``, where True
+        means the corresponding value in `measures` is an outlier at that
+        threshold.
+    """
+    measures = np.asarray(measures)
+    thresholds = np.reshape(thresholds, (-1,) + (1,) * measures.ndim)
+    med = np.median(measures, axis=-1, keepdims=True)
+    mad = np.median(np.abs(measures - med), axis=-1, keepdims=True)
+    if lower_bound:
+        return np.abs(measures - med) > thresholds * mad
+    return measures > med + thresholds * mad
+
+
+def sliding_window_sweep(measures, thresholds, window_length=20, step=10):
+    """ Detect outliers in sliding windows of `measures`, for each threshold
+
+    Gives the same result as ``[sliding_window_detector(measures,
+    window_length, step, t) for t in thresholds]``.
+
+    Parameters
+    ----------
+    measures : 1D array
+        Values for which we will detect outliers
+    thresholds : sequence
+        Scalars to multiply the median absolute deviation to form the
+        thresholds.
+    window_length : int, optional
+        Number of values in each window.
+    step : int, optional
+        Number of values between starts of successive windows.
+
+    Returns
+    -------
+    outlier_tf : 2D boolean array
+        Array with one row per threshold, and one column per value in
+        `measures`, where True means an outlier.
+    """
+    measures = np.asarray(measures)
+    n = len(measures)
+    outlier_tf = np.zeros((len(thresholds), n), dtype=bool)
+    starts = np.arange(0, max(n - window_length, 0), step)
+    if len(starts):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            measures, window_length)[starts]
+        window_tf = mad_time_sweep(windows, True, thresholds)
+        thr_rows, rows, cols = np.nonzero(window_tf)
+        outlier_tf[thr_rows, starts[rows] + cols] = True
+        last_start = starts[-1] + step
+    else:
+        last_start = 0
+    if last_start < n:
+        outlier_tf[:, last_start:] |= mad_time_sweep(
+            measures[last_start:], True, thresholds)
+    return outlier_tf
+
+
+def sliding_window_detector(measures, window_length=20, step=10,
+                            threshold=3.5):
+    """ Detect outliers in 'measures' with MAD in sliding windows
+
+    Windows of `window_length` values start at every `step` values.  The last
+    window starts at the first step for which the window would reach the end
+    of `measures`, and runs to the end of `measures`.  A value is an outlier if
+    `mad_time_detector` (with ``lower_bound=True``) finds it is an outlier in
+    any window containing it.
+
+    All the full-length windows are processed together, as rows of a sliding
+    window view of `measures`.
+
+    Parameters
+    ----------
+    measures : 1D array
+        Values for which we will detect outliers
+    window_length : int, optional
+        Number of values in each window.
+    step : int, optional
+        Number of values between starts of successive windows.
+    threshold : float, optional
+        Scalar to multiply the median aboslute deviation to form the
+        threshold.
+
+    Returns
+    -------
+    outlier_tf : 1D boolean array
+        1D boolean array of same length as 'measures', where True means the
+        corresponding value in 'measures' is an outlier.
+    """
+    measures = np.asarray(measures)
+    n = len(measures)
+    outlier_tf = np.zeros(n, dtype=bool)
+    # Full windows are those ending before the last value.
+    starts = np.arange(0, max(n - window_length, 0), step)
+    if len(starts):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            measures, window_length)[starts]
+        window_tf = mad_time_detector(windows, True, threshold)
+        rows, cols = np.nonzero(window_tf)
+        outlier_tf[starts[rows] + cols] = True
+        last_start = starts[-1] + step
+    else:
+        last_start = 0
+    if last_start < n:
+        outlier_tf[last_start:] |= mad_time_detector(
+            measures[last_start:], True, threshold)
+    return outlier_tf
+
+
 def iqr_detector(measures, iqr_proportion=1.5):
     """ Detect outliers in `measures` using interquartile range.
 
@@ -115,12 +393,39 @@ def iqr_detector(measures, iqr_proportion=1.5):
     # https://textbook.nipraxis.org/numpy_logical.html
     # +++your code here+++
     # Calculate the quartiles of the data
-    Q1 = np.percentile(measures, 25, interpolation="midpoint")
-    Q2 = np.percentile(measures, 50, interpolation="midpoint")
-    Q3 = np.percentile(measures, 75, interpolation="midpoint")
+    Q1 = np.percentile(measures, 25, method="midpoint")
+    Q2 = np.percentile(measures, 50, method="midpoint")
+    Q3 = np.percentile(measures, 75, method="midpoint")
     # Calculate the interquartile range
     IQR = Q3 - Q1
     # Calculate the outliers
     outlier_tf = np.logical_or(measures > (Q3 + IQR * iqr_proportion), measures < (Q1 - IQR * iqr_proportion))
     return outlier_tf
-    
+
+
+def iqr_sweep(measures, iqr_proportions):
+    """ Detect outliers in `measures` by IQR, for each of `iqr_proportions`
+
+    Gives the same result as ``[iqr_detector(measures, p) for p in
+    iqr_proportions]``, from one calculation of the quartiles.
+
+    Parameters
+    ----------
+    measures : 1D array
+        Values for which we will detect outliers
+    iqr_proportions : sequence
+        Scalars to multiply the IQR to form upper and lower thresholds.
+
+    Returns
+    -------
+    outlier_tf : 2D boolean array
+        Array with one row per IQR proportion, and one column per value in
+        `measures`, where True means an outlier.
+    """
+    measures = np.asarray(measures)
+    proportions = np.reshape(iqr_proportions, (-1, 1))
+    Q1 = np.percentile(measures, 25, method="midpoint")
+    Q3 = np.percentile(measures, 75, method="midpoint")
+    IQR = Q3 - Q1
+    return np.logical_or(measures > (Q3 + IQR * proportions),
+                         measures < (Q1 - IQR * proportions))
@@ -0,0 +1,289 @@
+""" Combine outlier detectors with a rule, sharing their intermediate values
+
+Each detector declares the intermediate values it needs, such as dvars or
+the voxel outlier counts.  :class:`Intermediates` calculates each value at
+most once per run, and keeps it for any other detector that needs it.  The
+detector results combine with a rule expression, with ``|`` for union, ``&``
+for intersection, and ``vote(k, ...)`` for volumes found by at least ``k``
+of the detectors in the vote.  For example, the default rule::
+
+    sliding_window & (mad_voxel | dvars)
+
+gives volumes that the sliding window detector finds, and that either the
+voxel outlier count detector, or the dvars detector, also finds.  The rule::
+
+    vote(2, mad_voxel, dvars, iqr_dvars, spm_global)
+
+gives volumes found by at least two of those four detectors.
+
+The intermediate values are:
+
+* ``run`` : :class:`findoutlie.outfind.RunData`, loaded on first use;
+* ``mask`` : 1D brain mask;
+* ``brain_voxels`` : 2D array of brain voxels by time points;
+* ``voxel_outlier_counts`` : number of outlying brain voxels per volume;
+* ``dvars`` : dvars of brain voxels;
+* ``volume_means`` : mean of brain voxels per volume;
+* ``spm_globals`` : SPM global metric per volume, over all voxels.
+"""
+
+import ast
+
+import numpy as np
+
+from .metrics import dvars_voxel
+from .profiling import stage
+from .detectors import (iqr_detector, mad_voxel_counts, mad_time_detector,
+                        sliding_window_detector, voxel_subset)
+
+DEFAULT_RULE = 'sliding_window & (mad_voxel | dvars)'
+
+
+def _voxel_outlier_counts(brain_voxels, block_size=None, subsample=None,
+                          seed=0, pool=None, **options):
+    if subsample is not None:
+        brain_voxels = brain_voxels[voxel_subset(len(brain_voxels),
+                                                 subsample, seed)]
+    counts = mad_voxel_counts if pool is None else pool.mad_voxel_counts
+    if block_size is None:
+        return counts(brain_voxels)
+    return counts(brain_voxels, block_size=block_size)
+
+
+def _dvars(brain_voxels, block_size=None, pool=None, **options):
+    if pool is None:
+        return dvars_voxel(brain_voxels, block_size)
+    return pool.dvars_voxel(brain_voxels, block_size)
+
+
+def _volume_means(brain_voxels, **options):
+    return np.mean(brain_voxels, axis=0, dtype=np.float64)
+
+
+# Name: (names of needed intermediates, function of needed values).  The
+# functions also get the options of :class:`Intermediates` as keyword
+# arguments.
+INTERMEDIATES = {
+    'mask': (('run',), lambda run, **options: run.mask),
+    'brain_voxels': (('run',), lambda run, **options: run.brain_voxels),
+    'voxel_outlier_counts': (('brain_voxels',), _voxel_outlier_counts),
+    'dvars': (('brain_voxels',), _dvars),
+    'volume_means': (('brain_voxels',), _volume_means),
+    'spm_globals': (('run',), lambda run, **options: run.spm_globals),
+}
+
+
+class Intermediates:
+    """ Intermediate values for one run, each calculated at most once
+
+    Parameters
+    ----------
+    values : dict, optional
+        Values already known, for example from the metrics cache, or
+        ``{'run': run}`` for a loaded run.
+    load : callable, optional
+        Called as ``load(spm_globals=needs_spm)`` to load the run, the first
+        time a value needs it.  ``needs_spm`` is True if the run should
+        collect SPM globals while loading.
+    needs : iterable, optional
+        Names of all values that will be needed, so loading can collect them
+        in the same pass.
+    block_size : int, optional
+        Number of voxels for calculations to work on at a time, to limit
+        memory use.  None gives the default for each calculation.
+    subsample : float or int, optional
+        If not None, count voxel outliers on a random subset of the brain
+        voxels, of this fraction (float) or number (int) of voxels, for a
+        fast triage.  See :func:`findoutlie.detectors.voxel_subset`.
+    seed : int, optional
+        Seed for choosing the random subset of voxels.
+    pool : VoxelPool, optional
+        If not None, calculate the voxel outlier counts and dvars on blocks
+        of voxels in parallel, with this
+        :class:`findoutlie.voxelpool.VoxelPool`.
+    """
+
+    def __init__(self, values=None, load=None, needs=(), block_size=None,
+                 subsample=None, seed=0, pool=None):
+        self.values = dict(values or {})
+        self._load = load
+        self._needs = set(needs)
+        self.options = {'block_size': block_size, 'subsample': subsample,
+                        'seed': seed, 'pool': pool}
+
+    def __getitem__(self, name):
+        if name in self.values:
+            return self.values[name]
+        if name == 'run':
+            if self._load is None:
+                raise ValueError('No run loaded, and no way to load it')
+            with stage('load_run'):
+                value = self._load(spm_globals='spm_globals' in self._needs)
+        else:
+            if name not in INTERMEDIATES:
+                raise ValueError(f'No intermediate value called "{name}"')
+            needs, func = INTERMEDIATES[name]
+            args = [self[need] for need in needs]
+            with stage(name):
+                value = func(*args, **self.options)
+        self.values[name] = value
+        return value
+
+
+class Detector:
+    """ Outlier detector working on intermediate values
+
+    Parameters
+    ----------
+    needs : sequence
+        Names of intermediate values, passed to `func` as positional
+        arguments, in this order.
+    func : callable
+        Function returning boolean array, True for outlier volumes.
+    **kwargs : dict
+        Keyword arguments for `func`.
+    """
+
+    def __init__(self, needs, func, **kwargs):
+        self.needs = tuple(needs)
+        self.func = func
+        self.kwargs = kwargs
+
+    def __call__(self, intermediates):
+        """ Return indices of outlier volumes, given `intermediates`
+        """
+        args = [intermediates[need] for need in self.needs]
+        return np.nonzero(self.func(*args, **self.kwargs))[0]
+
+
+def default_detectors(window_length=20, window_step=10):
+    """ Return dict of named built-in detectors
+
+    Parameters
+    ----------
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    """
+    return {
+        'mad_voxel': Detector(('voxel_outlier_counts',), mad_time_detector,
+                              lower_bound=False),
+        'dvars': Detector(('dvars',), mad_time_detector, lower_bound=True),
+        'sliding_window': Detector(('volume_means',),
+                                   sliding_window_detector,
+                                   window_length=window_length,
+                                   step=window_step),
+        'iqr_dvars': Detector(('dvars',), iqr_detector, iqr_proportion=2),
+        'spm_global': Detector(('spm_globals',), mad_time_detector,
+                               lower_bound=True),
+    }
+
+
+def _rule_names(node):
+    """ Return detector names in parsed rule `node`, checking syntax
+    """
+    if isinstance(node, ast.Name):
+        return [node.id]
+    if isinstance(node, ast.BinOp) and isinstance(node.op,
+                                                  (ast.BitOr, ast.BitAnd)):
+        return _rule_names(node.left) + _rule_names(node.right)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id == 'vote' and not node.keywords
+            and len(node.args) >= 2
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, int)):
+        return [name for arg in node.args[1:] for name in _rule_names(arg)]
+    raise ValueError(f'Invalid rule expression: {ast.unparse(node)}')
+
+
+class Ensemble:
+    """ Detectors combined by a rule expression
+
+    Parameters
+    ----------
+    rule : str, optional
+        Rule expression; see module docstring.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    detectors : dict, optional
+        Extra, or replacement, named :class:`Detector` instances to use in
+        `rule`.
+    """
+
+    def __init__(self, rule=DEFAULT_RULE, window_length=20, window_step=10,
+                 detectors=None):
+        try:
+            self._tree = ast.parse(rule, mode='eval').body
+        except SyntaxError as err:
+            raise ValueError(f'Invalid rule expression: {rule}') from err
+        all_detectors = default_detectors(window_length, window_step)
+        all_detectors.update(detectors or {})
+        names = _rule_names(self._tree)
+        missing = sorted(set(names).difference(all_detectors))
+        if missing:
+            raise ValueError(f'Unknown detectors in rule: {missing}')
+        self.detectors = {name: all_detectors[name] for name in names}
+
+    @property
+    def needs(self):
+        """ Names of intermediate values needed, including indirect needs
+        """
+        needs = set()
+        todo = [need for detector in self.detectors.values()
+                for need in detector.needs]
+        while todo:
+            name = todo.pop()
+            if name not in needs:
+                needs.add(name)
+                todo += INTERMEDIATES.get(name, ((),))[0]
+        return needs
+
+    def intermediates(self, values=None, load=None, **options):
+        """ Return :class:`Intermediates` for this ensemble
+
+        `options` are keyword arguments for :class:`Intermediates`.
+        """
+        return Intermediates(values, load, self.needs, **options)
+
+    def detector_outliers(self, intermediates):
+        """ Return dict of outlier indices for each detector in the rule
+        """
+        outliers = {}
+        for name, detector in self.detectors.items():
+            # Calculate the needed values first, in their own stages, so the
+            # detector stage times the detector alone.
+            for need in detector.needs:
+                intermediates[need]
+            with stage(f'detect_{name}'):
+                outliers[name] = detector(intermediates)
+        return outliers
+
+    def outliers(self, intermediates):
+        """ Return indices of outlier volumes, combined by the rule
+        """
+        return self.combine(self.detector_outliers(intermediates))
+
+    def combine(self, detector_outliers):
+        """ Return indices of outlier volumes from `detector_outliers`
+
+        `detector_outliers` is a dict of outlier indices for each detector in
+        the rule, from :meth:`detector_outliers`.
+        """
+        return self._evaluate(self._tree, detector_outliers)
+
+    def _evaluate(self, node, outliers):
+        if isinstance(node, ast.Name):
+            return outliers[node.id]
+        if isinstance(node, ast.BinOp):
+            combine = (np.union1d if isinstance(node.op, ast.BitOr)
+                       else np.intersect1d)
+            return combine(self._evaluate(node.left, outliers),
+                           self._evaluate(node.right, outliers))
+        # vote(k, ...)
+        votes = [np.unique(self._evaluate(arg, outliers))
+                 for arg in node.args[1:]]
+        values, counts = np.unique(np.concatenate(votes), return_counts=True)
+        return values[counts >= node.args[0].value]
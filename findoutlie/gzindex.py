@@ -0,0 +1,159 @@
+""" Random access to volumes in ``.nii.gz`` images via gzip seek points
+
+Gzip streams can only be decompressed from the start, so reading volume k of
+a ``.nii.gz`` image normally means decompressing every volume before it.  A
+seek-point index stores the decompressor state at regular points in the
+stream, so a read can start from the nearest point before volume k.
+
+We build the index once per file, and save it in an index directory, by
+default next to the metrics cache.  Index files are named by a key from the
+image path, modification time and size, so a changed image gets a new index.
+
+Building and using the index needs the optional ``indexed_gzip`` package.
+Without it, :func:`load_indexed` falls back to an ordinary open image, which
+gives the same data, but without fast random access.
+"""
+
+from pathlib import Path
+import os
+import tempfile
+
+from .cache import DEFAULT_CACHE_DIR, path_key
+from .profiling import stage
+from .lazy import lazy_import
+
+nib = lazy_import('nibabel')
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+DEFAULT_INDEX_DIR = DEFAULT_CACHE_DIR / 'gzindex'
+
+# Distance between seek points in uncompressed bytes.  Each seek point stores
+# a 32 KB window, so smaller spacing means faster seeks, but larger indices.
+DEFAULT_SPACING = 2 ** 22
+
+
+def index_path(fname, index_dir=DEFAULT_INDEX_DIR):
+    """ Return path of seek-point index for image `fname` in `index_dir`
+    """
+    return Path(index_dir) / f'{path_key(fname)}.gzidx'
+
+
+def build_index(fname, index_dir=DEFAULT_INDEX_DIR, spacing=DEFAULT_SPACING):
+    """ Build seek-point index for gzip file `fname`, save in `index_dir`
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of gzip file.
+    index_dir : str or Path, optional
+        Directory in which to save index.
+    spacing : int, optional
+        Distance between seek points in uncompressed bytes.
+
+    Returns
+    -------
+    index_fname : Path
+        Filename of saved index.
+
+    Raises
+    ------
+    ImportError
+        If ``indexed_gzip`` is not installed.
+    """
+    if indexed_gzip is None:
+        raise ImportError('Building gzip indices needs indexed_gzip')
+    index_fname = index_path(fname, index_dir)
+    index_fname.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file and rename, so other processes never see a
+    # partial index.
+    fd, tmp_name = tempfile.mkstemp(dir=index_fname.parent, suffix='.tmp')
+    os.close(fd)
+    with stage('build_gzindex'):
+        with indexed_gzip.IndexedGzipFile(str(fname),
+                                          spacing=spacing) as gz_fobj:
+            gz_fobj.build_full_index()
+            gz_fobj.export_index(tmp_name)
+    os.replace(tmp_name, index_fname)
+    return index_fname
+
+
+def load_indexed(fname, index_dir=DEFAULT_INDEX_DIR, build=True):
+    """ Load image `fname` for random access to volumes
+
+    For ``.nii.gz`` images, use the seek-point index in `index_dir`, building
+    the index first if it does not exist, and `build` is True.
+
+    The returned image keeps its file open; call :func:`close_image` when
+    done with it.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D NIfTI image.
+    index_dir : str or Path, optional
+        Directory containing seek-point indices.
+    build : bool, optional
+        If True, build the index if it does not exist.
+
+    Returns
+    -------
+    img : nibabel image
+        Image, where slicing ``img.dataobj[..., k]`` seeks directly to volume
+        `k`.  Uncompressed images, and compressed images without an index (or
+        without ``indexed_gzip``), are opened as usual.
+    """
+    index_fname = None
+    if str(fname).endswith('.gz') and indexed_gzip is not None:
+        index_fname = index_path(fname, index_dir)
+        if not index_fname.is_file():
+            if build:
+                build_index(fname, index_dir)
+            else:
+                index_fname = None
+    if index_fname is None:
+        fobj = nib.openers.ImageOpener(fname)
+    else:
+        fobj = indexed_gzip.IndexedGzipFile(str(fname),
+                                            index_file=str(index_fname))
+    # The image does not close a file object we give it, so the caller owns
+    # the open file, via the image file map.
+    file_holder = nib.FileHolder(str(fname), fobj)
+    return nib.Nifti1Image.from_file_map({'header': file_holder,
+                                          'image': file_holder})
+
+
+def close_image(img):
+    """ Close the file kept open by image `img` from :func:`load_indexed`
+    """
+    img.file_map['image'].fileobj.close()
+
+
+def read_volume(fname, k, index_dir=DEFAULT_INDEX_DIR, dtype='float64'):
+    """ Read volume `k` from 4D image `fname`, using seek-point index
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image.
+    k : int
+        Index of volume to read.
+    index_dir : str or Path, optional
+        Directory containing seek-point indices.
+    dtype : dtype, optional
+        Data type of returned volume.
+
+    Returns
+    -------
+    vol : array
+        3D volume `k` from image.
+    """
+    img = load_indexed(fname, index_dir)
+    try:
+        with stage('read_indexed_volume'):
+            return img.dataobj[..., k].astype(dtype)
+    finally:
+        close_image(img)
@@ -0,0 +1,128 @@
+""" Cache of decompressed images, for memory-mapped reads
+
+Reading from a ``.nii.gz`` image means decompressing it, which is slow, and
+must be done again for every read.  An :class:`ImageCache` stores each
+compressed image once as an uncompressed ``.nii`` file in a cache directory,
+and loads it from there with ``mmap=True``.  Processes reading the same
+image then share the operating system page cache, and later runs do not need
+to decompress at all.
+
+Cache files are named by a key from the original path, modification time and
+size, so a changed image gets a new cache file.  Before adding a file that
+would take the cache over its maximum size, we delete the least recently used
+files.  Images larger than the whole cache are read from the compressed file
+as usual.
+"""
+
+from pathlib import Path
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .cache import parse_size, evict_lru, path_key
+from .profiling import stage
+from .lazy import lazy_import
+
+nib = lazy_import('nibabel')
+
+DEFAULT_IMAGE_CACHE_DIR = Path.home() / '.cache' / 'findoutlie' / 'images'
+
+
+def uncompressed_size(fname):
+    """ Return size in bytes of image `fname` as an uncompressed ``.nii`` file
+
+    Uses the image header only, without decompressing the data.
+    """
+    img = nib.load(fname)
+    return (int(img.dataobj.offset) +
+            int(np.prod(img.shape)) * img.get_data_dtype().itemsize)
+
+
+class ImageCache:
+    """ Least recently used cache of decompressed images in a directory
+
+    Parameters
+    ----------
+    cache_dir : str or Path, optional
+        Directory for decompressed images.
+    max_bytes : int or str, optional
+        Maximum total size of the decompressed images, see
+        :func:`findoutlie.cache.parse_size`.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_IMAGE_CACHE_DIR, max_bytes='20G'):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = parse_size(max_bytes)
+        # Apply a lower maximum size now, rather than on the next new image.
+        self.evict()
+
+    def cached_path(self, fname):
+        """ Return path of decompressed copy of `fname`, making it if needed
+
+        Returns None if the decompressed image would be larger than
+        ``max_bytes``.
+        """
+        path = self.cache_dir / f'{path_key(fname)}.nii'
+        try:
+            # Mark as recently used.
+            os.utime(path)
+            return path
+        except FileNotFoundError:  # Not cached, or evicted.
+            pass
+        n_bytes = uncompressed_size(fname)
+        if n_bytes > self.max_bytes:
+            return None
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Make room before writing, so eviction cannot remove the new file.
+        evict_lru(self.cache_dir, '*.nii', self.max_bytes - n_bytes)
+        # Decompress to a temporary file and rename, so other processes never
+        # see a partial file.
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with stage('decompress_to_cache'):
+                with os.fdopen(fd, 'wb') as out_fobj, \
+                        gzip.open(fname, 'rb') as in_fobj:
+                    shutil.copyfileobj(in_fobj, out_fobj, 2 ** 20)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        return path
+
+    def evict(self):
+        """ Delete least recently used images until under ``max_bytes``
+        """
+        evict_lru(self.cache_dir, '*.nii', self.max_bytes)
+
+    def load(self, fname):
+        """ Load image `fname`, memory-mapped, via cache if compressed
+
+        Parameters
+        ----------
+        fname : str or Path
+            Filename of image.  Uncompressed images are loaded directly.
+
+        Returns
+        -------
+        img : nibabel image
+            Image with memory-mapped data, or, for compressed images larger
+            than ``max_bytes``, the image opened as usual.
+        """
+        if not str(fname).endswith('.gz'):
+            return nib.load(fname, mmap=True, keep_file_open=True)
+        path = self.cached_path(fname)
+        if path is None:
+            return nib.load(fname, keep_file_open=True)
+        # Open the file now, and keep it open, so the data stay readable if
+        # another process evicts the file while we are using it.
+        try:
+            fobj = open(path, 'rb')
+        except FileNotFoundError:  # Evicted since cached_path.
+            return nib.load(fname, keep_file_open=True)
+        file_holder = nib.FileHolder(str(path), fobj)
+        return nib.Nifti1Image.from_file_map({'header': file_holder,
+                                              'image': file_holder},
+                                             mmap=True)
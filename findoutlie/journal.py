@@ -0,0 +1,134 @@
+""" Append-only journal of finished runs, for resuming batch jobs
+
+:func:`findoutlie.outfind.find_outliers` keeps its results in memory until
+all images are done, so a crash or preemption loses all the work so far.
+With a journal, each image's result is appended to a file as soon as the
+image is finished, and a later batch job can skip the images already in the
+journal.
+
+The journal is a text file with one JSON object per line, per finished
+image, with keys:
+
+* ``file`` : resolved path of the image;
+* ``key`` : key from the path, modification time and size of the image (see
+  :func:`findoutlie.cache.path_key`), so a changed image is not skipped;
+* ``hash`` : SHA1 hash of the image contents, if known, otherwise null;
+* ``params`` : parameters for the detection, and the package version;
+* ``outliers`` : list of outlier volume indices;
+* ``seconds`` : wall time to process the image;
+* ``finished`` : local time the image finished, in ISO format.
+
+Each line is flushed to disk as it is written, so a crash can lose at most a
+partial last line, which reading ignores.
+"""
+
+from pathlib import Path
+import json
+import os
+import time
+
+import numpy as np
+
+from . import __version__
+from .cache import path_key
+
+
+def _normalize(params):
+    # Parameters as they will read back from JSON, with package version.
+    return json.loads(json.dumps(dict(params, version=__version__)))
+
+
+class Journal:
+    """ Append-only journal of outliers for finished runs
+
+    Parameters
+    ----------
+    path : str or Path
+        Journal file.  It need not exist yet.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def entries(self):
+        """ Return list of entry dicts in journal, oldest first
+
+        Lines that are not complete JSON objects, such as a last line cut
+        off by a crash, are skipped.
+        """
+        if not self.path.is_file():
+            return []
+        entries = []
+        with open(self.path, 'rt') as fobj:
+            for line in fobj:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(entry, dict):
+                    entries.append(entry)
+        return entries
+
+    def completed(self, params):
+        """ Return outliers for runs finished with `params`, and unchanged
+
+        Parameters
+        ----------
+        params : dict
+            Detection parameters, as passed to :meth:`record`.
+
+        Returns
+        -------
+        outliers : dict
+            Dictionary with keys being resolved image paths, and values being
+            arrays of outlier indices.  Where there is more than one matching
+            entry for an image, the latest wins.
+        """
+        params = _normalize(params)
+        outliers = {}
+        for entry in self.entries():
+            if entry.get('params') != params:
+                continue
+            path = Path(entry['file'])
+            try:
+                if path_key(path) != entry['key']:
+                    continue
+            except FileNotFoundError:
+                continue
+            outliers[path] = np.array(entry['outliers'], dtype=int)
+        return outliers
+
+    def record(self, fname, params, outliers, seconds=None,
+               content_hash=None):
+        """ Append entry for finished run `fname`, and flush to disk
+
+        Parameters
+        ----------
+        fname : str or Path
+            Filename of image, or store directory.
+        params : dict
+            Detection parameters.  Values must be JSON serializable.
+        outliers : array-like
+            Indices of outlier volumes.
+        seconds : float, optional
+            Wall time to process `fname`.
+        content_hash : str, optional
+            SHA1 hash of contents of `fname`, if known.
+        """
+        path = Path(fname).resolve()
+        entry = {'file': str(path), 'key': path_key(path),
+                 'hash': content_hash, 'params': _normalize(params),
+                 'outliers': [int(i) for i in outliers],
+                 'seconds': seconds,
+                 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        line = json.dumps(entry) + '\n'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'ab+') as fobj:
+            # Start a new line after any partial line from a crash.
+            if fobj.tell() > 0:
+                fobj.seek(-1, os.SEEK_END)
+                if fobj.read(1) != b'\n':
+                    line = '\n' + line
+            fobj.write(line.encode('utf-8'))
+            fobj.flush()
+            os.fsync(fobj.fileno())
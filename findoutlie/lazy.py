@@ -0,0 +1,43 @@
+""" Import modules on first use
+
+Importing nibabel takes a noticeable fraction of the start-up time of a
+script, and some runs never need it, for example when all metrics come from
+the cache, or from a voxel store.  ``nib = lazy_import('nibabel')`` returns a
+module object at once, and only runs the real import when code first gets an
+attribute from the module.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """ Return module `name`, to be imported on first attribute access
+
+    Parameters
+    ----------
+    name : str
+        Full module name, such as ``'nibabel'``.
+
+    Returns
+    -------
+    module : module
+        Module `name`.  If the module is already imported, this is the
+        imported module.
+
+    Raises
+    ------
+    ImportError
+        If there is no module `name`.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -5,7 +5,9 @@
 # +++your code here+++
 import numpy as np
 
-def dvars_voxel(voxels):
+from .streaming import stream_image, Dvars
+
+def dvars_voxel(voxels, block_size=None):
     """ Calculate dvars metric on 2D array with voxels in rows and time-points(volumes) in columns
 
     The dvars calculation between two volumes is defined as the square root of 
@@ -14,6 +16,9 @@ def dvars_voxel(voxels):
     Parameters
     ----------
     voxels : 2D array
+    block_size : int, optional
+        If not None, work on this many voxels (rows) at a time, to limit the
+        size of the temporary arrays.
 
     Returns
     -------
@@ -21,12 +26,42 @@ def dvars_voxel(voxels):
         One-dimensional array with n-1 elements, where n is the number of 
         volumes in 'img'.
     """
-    vol_diff = voxels[..., 1:] - voxels[..., :-1]
-    dvar_val = np.sqrt(np.mean(vol_diff ** 2, axis=0))
+    dvar_val = np.sqrt(sum_sq_diffs(voxels, block_size) / len(voxels))
     return dvar_val
 
 
-def dvars(img):
+def sum_sq_diffs(voxels, block_size=None):
+    """ Sum over voxels of squared differences between successive volumes
+
+    Partial sums over blocks of voxels add up to the sum for all voxels, so
+    :func:`dvars_voxel` can work on blocks of voxels in parallel.
+
+    Parameters
+    ----------
+    voxels : 2D array
+        Voxels in rows, time points in columns.
+    block_size : int, optional
+        If not None, work on this many voxels (rows) at a time, to limit the
+        size of the temporary arrays.
+
+    Returns
+    -------
+    sum_sq : 1D array or 0
+        float64 array with n-1 elements, where n is the number of columns in
+        `voxels`, or 0 if `voxels` has no rows.
+    """
+    if block_size is None:
+        block_size = max(len(voxels), 1)
+    sum_sq = 0
+    for start in range(0, len(voxels), block_size):
+        block = voxels[start:start + block_size]
+        vol_diff = block[..., 1:] - block[..., :-1]
+        # Accumulate in float64, for precision with float32 `voxels`.
+        sum_sq = sum_sq + np.sum(vol_diff ** 2, axis=0, dtype=np.float64)
+    return sum_sq
+
+
+def dvars(img, dtype=np.float64):
     """ Calculate dvars metric on Nibabel image `img`
 
     The dvars calculation between two volumes is defined as the square root of
@@ -35,6 +70,8 @@ def dvars(img):
     Parameters
     ----------
     img : nibabel image
+    dtype : dtype, optional
+        Floating point type for calculations.
 
     Returns
     -------
@@ -49,12 +86,8 @@ def dvars(img):
     #
     # You may be be able to solve this in four lines, without a loop.
     # But solve it any way you can.
-    # This is a placeholder, replace it to write your solution.
-    data = img.get_fdata()
-   
-    voxel_by_time = np.reshape(data, (-1, data.shape[-1]))
-    dvar_val = dvars_voxel(voxel_by_time)
-
-    return dvar_val
-
-    raise NotImplementedError("Code up this function")
+    # Read one volume at a time, keeping only the previous volume, rather
+    # than loading the whole image.  See ``streaming.load_image`` for
+    # efficient streaming reads from compressed images.
+    dvars_acc, = stream_image(img, [Dvars()], dtype=dtype)
+    return dvars_acc.result()
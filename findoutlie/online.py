@@ -0,0 +1,208 @@
+""" Detect outlier volumes one volume at a time, as they arrive
+
+The detectors in :mod:`findoutlie.outfind` need the whole run.  Here, an
+:class:`OnlineDetector` accepts one 3D volume at a time, for example during
+acquisition, and decides whether each volume is an outlier from the volumes
+so far.
+
+The detector keeps the first `warmup` volumes, then freezes the brain mask
+from their mean, and starts per-voxel estimates of the median and median
+absolute deviation (MAD) over time from them.  After that, it keeps only:
+
+* the previous volume, for dvars;
+* the running per-voxel median and MAD, updated for each volume with a
+  small step towards the new value ("frugal" streaming quantiles);
+* the last `history` values of each volume metric, for robust thresholds.
+
+so each volume costs O(voxels) time, and memory does not grow with run length.
+
+For example, to replay an existing run::
+
+    for decision in replay('sub-01_task-rest_bold.nii.gz'):
+        if decision['outlier']:
+            print(decision['index'])
+"""
+
+from collections import deque
+
+import numpy as np
+
+from .spm_funcs import spm_globals_voxels
+from .streaming import load_image, iter_volumes
+from .outfind import mask_from_mean
+
+
+def _robust_outlier(value, values, lower_bound, threshold):
+    """ True if `value` is an outlier by median and MAD of `values`
+    """
+    values = np.array(values)
+    med = np.median(values)
+    mad = np.median(np.abs(values - med))
+    if lower_bound:
+        return bool(np.abs(value - med) > threshold * mad)
+    return bool(value > med + threshold * mad)
+
+
+class OnlineDetector:
+    """ Detect outlier volumes from one volume at a time
+
+    Decisions combine the two whole-run detectors that do not need future
+    volumes: a volume is an outlier if it has an outlying number of outlier
+    voxels (as for :func:`findoutlie.outfind.mad_voxel_outliers`), or
+    outlying dvars (as for :func:`findoutlie.outfind.dvars_outliers`).  Dvars
+    for a volume is from the difference to the previous volume.
+
+    Parameters
+    ----------
+    warmup : int, optional
+        Number of volumes to collect before freezing the brain mask.
+        Decisions for these volumes come after the last of them arrives.
+    threshold : float, optional
+        Scalar to multiply the median absolute deviation to form thresholds,
+        for voxel values and volume metrics.
+    history : int, optional
+        Number of recent volumes to use for robust thresholds on volume
+        metrics.
+    rate : float, optional
+        Step size, as a fraction of the voxel MAD, for updating the running
+        per-voxel median and MAD with each new volume.
+    """
+
+    def __init__(self, warmup=20, threshold=3.5, history=100, rate=0.05):
+        if warmup < 1:
+            raise ValueError('warmup must be at least 1')
+        self.warmup = warmup
+        self.threshold = threshold
+        self.rate = rate
+        self.mask = None
+        self.n_volumes = 0
+        self._shape = None
+        self._buffer = []
+        self._median = None
+        self._mad = None
+        self._previous = None
+        self._counts = deque(maxlen=history)
+        self._dvars = deque(maxlen=history)
+
+    def add_volume(self, vol):
+        """ Add next volume `vol`, return decisions for volumes now decided
+
+        Parameters
+        ----------
+        vol : array
+            3D volume.
+
+        Returns
+        -------
+        decisions : list
+            List of dicts, one per decided volume, in order of arrival.  This
+            is empty during warm-up, and has all the warm-up volumes when the
+            last warm-up volume arrives.  Each dict has keys "index" (volume
+            number), "dvars" (nan for the first volume), "mean" (mean of
+            brain voxels), "spm_global", "voxel_outliers" (number of outlier
+            voxels), "voxel_outlier" and "dvars_outlier" (True for outlier by
+            each metric), and "outlier" (True if either is True).
+        """
+        vol = np.asarray(vol, dtype=np.float64)
+        if self._shape is None:
+            self._shape = vol.shape
+        elif vol.shape != self._shape:
+            raise ValueError(f'Volume shape {vol.shape} does not match '
+                             f'earlier shape {self._shape}')
+        vol = np.reshape(vol, -1)
+        if self.mask is not None:
+            return [self._judge(self._measure(vol))]
+        self._buffer.append(vol)
+        if len(self._buffer) < self.warmup:
+            return []
+        return self._freeze()
+
+    def finish(self):
+        """ Return decisions for any volumes still in warm-up
+
+        Call at the end of a run, in case the run was shorter than `warmup`.
+        """
+        return self._freeze() if self._buffer else []
+
+    def _freeze(self):
+        """ Freeze mask from warm-up volumes, return their decisions
+        """
+        warmup = np.stack(self._buffer, axis=-1)
+        self._buffer = []
+        mean = np.mean(warmup, axis=-1, dtype=np.float64)
+        self.mask = np.reshape(mask_from_mean(mean), self._shape)
+        flat_mask = np.reshape(self.mask, -1)
+        brain = warmup[flat_mask]
+        self._median = np.median(brain, axis=-1)
+        self._mad = np.median(np.abs(brain - self._median[:, None]), axis=-1)
+        # Measure all warm-up volumes before judging any of them, so the
+        # first volumes have the whole warm-up as history.
+        decisions = [self._measure(vol) for vol in warmup.T]
+        return [self._judge(decision) for decision in decisions]
+
+    def _measure(self, vol):
+        """ Return metrics for flat volume `vol`, add them to the history
+
+        The returned dict is ready for :meth:`_judge`.
+        """
+        brain = vol[np.reshape(self.mask, -1)]
+        # Count outlier voxels, and update per-voxel estimates.
+        diff = brain - self._median
+        abs_dev = np.abs(diff)
+        n_outliers = int(np.count_nonzero(
+            abs_dev > self.threshold * self._mad))
+        step = self.rate * np.where(self._mad > 0, self._mad, abs_dev)
+        self._median += step * np.sign(diff)
+        self._mad += step * np.sign(abs_dev - self._mad)
+        self._counts.append(n_outliers)
+        if self._previous is None:
+            dvars = np.nan
+        else:
+            dvars = np.sqrt(np.mean((brain - self._previous) ** 2))
+            self._dvars.append(dvars)
+        self._previous = brain
+        decision = {
+            'index': self.n_volumes,
+            'dvars': dvars,
+            'mean': np.mean(brain),
+            'spm_global': spm_globals_voxels(vol[:, None])[0],
+            'voxel_outliers': n_outliers,
+        }
+        self.n_volumes += 1
+        return decision
+
+    def _judge(self, decision):
+        """ Add outlier flags to `decision`, using the current history
+        """
+        decision['voxel_outlier'] = _robust_outlier(
+            decision['voxel_outliers'], self._counts, False, self.threshold)
+        decision['dvars_outlier'] = (
+            not np.isnan(decision['dvars']) and
+            _robust_outlier(decision['dvars'], self._dvars, True,
+                            self.threshold))
+        decision['outlier'] = (decision['voxel_outlier'] or
+                               decision['dvars_outlier'])
+        return decision
+
+
+def replay(fname, **kwargs):
+    """ Feed run `fname` to :class:`OnlineDetector` one volume at a time
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image.
+    **kwargs : dict
+        Parameters for :class:`OnlineDetector`.
+
+    Yields
+    ------
+    decision : dict
+        Decision for each volume, in order, as for
+        :meth:`OnlineDetector.add_volume`.
+    """
+    detector = OnlineDetector(**kwargs)
+    img = load_image(fname)
+    for block in iter_volumes(img):
+        yield from detector.add_volume(np.reshape(block, img.shape[:-1]))
+    yield from detector.finish()
@@ -2,43 +2,458 @@
 """
 
 from pathlib import Path
+from contextlib import nullcontext
+from functools import partial
+import os
+import time
 
 import numpy as np
 
-import nibabel as nib
+from .metrics import dvars,dvars_voxel
+from .cache import file_hash, path_key, read_hash_lists, parse_size
+from .budget import (DEFAULT_VOLUME_BLOCK, run_info, estimate_peak,
+                     plan_blocks)
+from .store import (STORE_SUFFIX, StoreWriter, is_store, read_store,
+                    store_path)
+from .profiling import stage, current_file
+from . import profiling
+from .streaming import (load_image, close_image, stream_image, MeanImage,
+                        BrainVoxels, SpmGlobals, downsample_factors,
+                        downsampled_shape)
+from .spm_funcs import spm_globals_voxels
+from .ensemble import DEFAULT_RULE, Ensemble, Intermediates
+from .voxelpool import VoxelPool
+from .detectors import (iqr_detector, mad_voxel_counts, mad_time_detector,
+                        sliding_window_detector,
+                        mad_voxel_count_sweep, mad_time_sweep,
+                        sliding_window_sweep, voxel_subset)
 
-from skimage.filters import threshold_otsu
+class RunData:
+    """ Image data for one run, shared between the outlier detectors
 
-from .metrics import dvars,dvars_voxel
-from .detectors import iqr_detector,mad_voxel_detector,mad_time_detector
+    Loading and segmenting a run is the expensive part of outlier detection,
+    so do it once and pass the result to each detector.
+
+    Parameters
+    ----------
+    voxels : array or None
+        2D array with voxels in rows and timepoints in columns.  None if the
+        run was streamed from file, and only the brain voxels were kept.
+    mask : array, optional
+        1D boolean array, True for brain voxels in `voxels`.  If None,
+        calculate with :func:`brain_mask`.
+    brain_voxels : array, optional
+        2D array of brain voxels by timepoints.  If None, select from
+        `voxels` with `mask`.
+    spm_globals : array, optional
+        SPM global metric for each volume.  If None, calculate from `voxels`
+        when first needed.
+
+    Attributes
+    ----------
+    voxels : array or None
+        2D array with voxels in rows and timepoints in columns
+    mask : array
+        1D boolean array, True for brain voxels in `voxels`
+    brain_voxels : array
+        2D array containing only brain voxels in rows and timepoints in columns
+    spm_globals : array
+        SPM global metric for each volume.
+    """
+
+    def __init__(self, voxels, mask=None, brain_voxels=None,
+                 spm_globals=None):
+        self.voxels = voxels
+        self.mask = brain_mask(voxels) if mask is None else mask
+        self.brain_voxels = (voxels[self.mask] if brain_voxels is None
+                             else brain_voxels)
+        self._spm_globals = spm_globals
+
+    @property
+    def spm_globals(self):
+        if self._spm_globals is None:
+            if self.voxels is None:
+                raise ValueError('SPM globals need all voxels; load the run '
+                                 'with spm_globals=True')
+            self._spm_globals = spm_globals_voxels(self.voxels)
+        return self._spm_globals
+
+    @property
+    def n_volumes(self):
+        return self.brain_voxels.shape[-1]
+
+
+def run_dtype(fname, dtype=None):
+    """ Return floating point type for calculations on image or store `fname`
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, or store directory.
+    dtype : dtype, optional
+        Requested type.  If None, use float64 for images, and the stored
+        type for stores, so the memory-mapped store voxels are used as they
+        are, rather than copied into memory as another type.
+
+    Returns
+    -------
+    dtype : numpy dtype
+        Type for calculations.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    if is_store(fname):
+        return np.dtype(read_store(fname)[2]['dtype'])
+    return np.dtype(np.float64)
+
+
+def load_run(fname, block_size=1, dtype=None, image_cache=None,
+             spm_globals=False, downsample=None, pool=None):
+    """ Load image file `fname` into :class:`RunData`
+
+    The image is read in blocks of volumes, in two passes.  The first pass
+    calculates the mean image for the brain mask, the second collects the
+    brain voxels.  The full 4D image is never in memory.
+
+    `fname` can also be a time-major store directory (see
+    :mod:`findoutlie.store`).  Then the brain voxels are memory-mapped from
+    the store.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, as string or Path object, or store directory.
+    block_size : int, optional
+        Number of volumes to read at a time.
+    dtype : dtype, optional
+        Floating point type for the brain voxels, and so for the
+        calculations on them.  float32 halves memory use, see
+        :func:`dtype_deviations` for the effect on the results.  If None,
+        use float64 for images, and the stored type for stores.  Another
+        type for a store means reading all the store voxels into memory.
+    image_cache : ImageCache, optional
+        If not None, read a memory-mapped decompressed copy of `fname` from
+        this cache.
+    spm_globals : bool, optional
+        If True, also calculate SPM globals in the first pass.  Stores only
+        have the brain voxels, so do not have SPM globals.
+    downsample : int or sequence, optional
+        If not None, average each volume over blocks of this many voxels
+        along each spatial axis (or ``(x, y, z)`` voxels), as it is read.
+        The mask, brain voxels and SPM globals are then for the downsampled
+        image; see :func:`findoutlie.streaming.downsample`.  The downsampled
+        image is small, so it is read in one pass.  Stores cannot be
+        downsampled.
+    pool : VoxelPool, optional
+        If not None, collect the brain voxels in shared memory from this
+        :class:`findoutlie.voxelpool.VoxelPool`, so its workers can use them
+        without copies.
+
+    Returns
+    -------
+    run : RunData
+        Brain mask and brain voxels for `fname`.  The ``voxels`` attribute
+        is None.
+    """
+    dtype = run_dtype(fname, dtype)
+    if is_store(fname):
+        if spm_globals:
+            raise ValueError(f'Store {fname} has no SPM globals')
+        if downsample is not None:
+            raise ValueError(f'Cannot downsample store {fname}')
+        with stage('read_store'):
+            mask, brain_voxels, _ = read_store(fname)
+        if brain_voxels.dtype != dtype:
+            brain_voxels = brain_voxels.astype(dtype)
+        return RunData(None, mask, brain_voxels)
+    with stage('load_image'):
+        img = load_image(fname, image_cache)
+    first_pass = [MeanImage()] + ([SpmGlobals()] if spm_globals else [])
+    try:
+        if downsample is not None:
+            # Downsampled images are small, so keep all their voxels from the
+            # first pass, instead of reading the image again.
+            n_voxels = int(np.prod(downsampled_shape(img.shape, downsample)))
+            first_pass.append(BrainVoxels(np.ones(n_voxels, dtype=bool),
+                                          img.shape[-1], dtype))
+        mean_image = stream_image(img, first_pass, block_size, dtype,
+                                  downsample)[0]
+        with stage('mask'):
+            mask = mask_from_mean(mean_image.result())
+        if downsample is None:
+            empty = np.empty if pool is None else pool.empty
+            brain, = stream_image(
+                img, [BrainVoxels(mask, img.shape[-1], dtype, empty)],
+                block_size, dtype)
+            brain_voxels = brain.result()
+        else:
+            brain_voxels = first_pass[-1].result()[mask]
+    finally:
+        # The brain voxels are copies, so we can close the image file.
+        close_image(img)
+    return RunData(None, mask, brain_voxels,
+                   first_pass[1].result() if spm_globals else None)
+
+
+def convert_to_store(fname, store_dir, dtype=np.float32, block_size=64,
+                     content_hash=None):
+    """ Write brain voxels of image `fname` to time-major store `store_dir`
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, as string or Path object
+    store_dir : str or Path
+        Directory for store.
+    dtype : dtype, optional
+        Data type for stored voxel values.  float32 is exact for int16 images.
+    block_size : int, optional
+        Number of volumes to read and write at a time.
+    content_hash : str, optional
+        SHA1 hash of contents of `fname`, if known, to record in the store.
+
+    Returns
+    -------
+    store_dir : Path
+        Directory of store.
+    """
+    with stage('load_image'):
+        img = load_image(fname)
+    mean_image, = stream_image(img, [MeanImage()], block_size, dtype)
+    with stage('mask'):
+        mask = mask_from_mean(mean_image.result())
+    if content_hash is None:
+        with stage('file_hash'):
+            content_hash = file_hash(fname)
+    writer = StoreWriter(
+        store_dir, np.reshape(mask, img.shape[:-1]), img.shape[-1],
+        img.affine, dtype,
+        meta={'source': str(fname), 'source_sha1': content_hash})
+    stream_image(img, [writer], block_size, dtype)
+    writer.close()
+    return Path(store_dir)
+
+
+def convert_dataset(data_directory, store_root, dtype=np.float32, jobs=1):
+    """ Convert all images in `data_directory` to stores in `store_root`
+
+    See :func:`convert_to_store`, and :func:`findoutlie.store.store_path`
+    for the store directory names.
+
+    Parameters
+    ----------
+    data_directory : str or Path
+        Directory containing images.
+    store_root : str or Path
+        Directory in which to write stores.
+    dtype : dtype, optional
+        Data type for stored voxel values.
+    jobs : int, optional
+        Number of processes to use.  If None, use one process per CPU.
+
+    Returns
+    -------
+    store_dirs : list
+        Store directories, in sorted image filename order.
+    """
+    image_fnames = sorted(Path(data_directory).glob("**/sub-*.nii.gz"))
+    hashes = read_hash_lists(data_directory)
+
+    def args(fname):
+        return (fname, store_path(fname, data_directory, store_root), dtype,
+                64, hashes.get(fname.resolve()))
+
+    if jobs == 1:
+        return [convert_to_store(*args(fname)) for fname in image_fnames]
+    # Importing the process pool machinery is slow; only do it when needed.
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {fname: executor.submit(convert_to_store, *args(fname))
+                   for fname in largest_first(image_fnames)}
+        return [futures[fname].result() for fname in image_fnames]
+
+
+def brain_mask(img, pool=None):
+    """ Return mask of brain voxels in 2D voxel by time array `img`
 
-def segment_brain(img):
-    """ Segments brain region from background and returns only brain voxels
     Parameters
     ----------
     img : array
         2D array with voxels in rows and timepoints in columns
+    pool : VoxelPool, optional
+        If not None, calculate the voxel means on blocks of voxels in
+        parallel, with this :class:`findoutlie.voxelpool.VoxelPool`.
+
     Returns
     -------
-    thresholded_img : array
-        2D array containing only brain voxels in rows and timepoints in columns
+    mask : array
+        1D boolean array with one element per row of `img`, True for brain
+        voxels.
     """
     # calculate the mean of each voxel over time
-    mean_img = np.mean(img, axis=-1)
+    if pool is not None:
+        return mask_from_mean(pool.voxel_means(img))
+    return mask_from_mean(np.mean(img, axis=-1))
+
+
+def threshold_otsu(image, nbins=256):
+    """ Return threshold for `image` from Otsu's method
+
+    Otsu's method chooses the threshold that maximizes the variance between
+    the values below and above the threshold, estimated from a histogram.
+    This gives the same thresholds as ``skimage.filters.threshold_otsu``, for
+    floating point images, without having to import scikit-image.
+
+    Parameters
+    ----------
+    image : array
+        Array of values to threshold.
+    nbins : int, optional
+        Number of histogram bins.
+
+    Returns
+    -------
+    threshold : float
+        Upper edge of lower class; values greater than `threshold` are in the
+        upper class.
+    """
+    values = np.ravel(image)
+    first = values[0]
+    if np.all(values == first):
+        return first
+    counts, edges = np.histogram(values, bins=nbins)
+    counts = counts.astype(np.float32)
+    centers = (edges[:-1] + edges[1:]) / 2
+    # Class weights and means for each possible threshold.
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * centers) / weight1
+    mean2 = (np.cumsum((counts * centers)[::-1]) / weight2[::-1])[::-1]
+    # Between-class variance, for threshold after each bin but the last.
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return centers[np.argmax(variance12)]
+
+
+def mask_from_mean(mean_img):
+    """ Return mask of brain voxels given `mean_img`, mean over time per voxel
+
+    Parameters
+    ----------
+    mean_img : array
+        Mean over time for each voxel.
+
+    Returns
+    -------
+    mask : array
+        Boolean array of same shape as `mean_img`, True for brain voxels.
+    """
     # calculate the threshold for segmenting brain from background
     threshold = threshold_otsu(mean_img)
-    mask = mean_img > threshold
+    return mean_img > threshold
+
+
+def segment_brain(img, pool=None):
+    """ Segments brain region from background and returns only brain voxels
+    Parameters
+    ----------
+    img : array
+        2D array with voxels in rows and timepoints in columns
+    pool : VoxelPool, optional
+        If not None, calculate the voxel means in parallel; see
+        :func:`brain_mask`.
+    Returns
+    -------
+    thresholded_img : array
+        2D array containing only brain voxels in rows and timepoints in columns
+    """
     # filter only brain voxels
-    brain_voxels = img[mask]
-    return brain_voxels
-    
-def detect_outliers_mad_median_absolute_deviation_mask(fname):
+    return img[brain_mask(img, pool)]
+
+
+def mad_voxel_outliers(run, subsample=None, seed=0):
+    """ Detect outlier volumes in `run` from counts of outlying brain voxels
+
+    Parameters
+    ----------
+    run : RunData
+        Loaded and segmented data for one run.
+    subsample : float or int, optional
+        If not None, count outlying voxels in this fraction (float) or number
+        (int) of randomly chosen brain voxels, for a fast triage.
+    seed : int, optional
+        Seed for choosing the random voxels.
+
+    Returns
+    -------
+    outliers : tuple
+        Indices of outlier volumes, as returned by ``np.nonzero``.
+    """
+    brain_voxels = run.brain_voxels
+    if subsample is not None:
+        brain_voxels = brain_voxels[voxel_subset(len(brain_voxels),
+                                                 subsample, seed)]
+    # calculate the number of outlying voxels for each time point
+    voxel_outliers_per_time = mad_voxel_counts(brain_voxels)
+    # find the outliers in the time-series
+    outliers_time = mad_time_detector(voxel_outliers_per_time, lower_bound=False)
+    # Return indices of True values from Boolean array.
+    return np.nonzero(outliers_time)
+
+
+def dvars_outliers(run):
+    """ Detect outlier volumes in `run` from dvars of the brain voxels
+
+    Parameters
+    ----------
+    run : RunData
+        Loaded and segmented data for one run.
+
+    Returns
+    -------
+    outliers : tuple
+        Indices of outlier volumes, as returned by ``np.nonzero``.
+    """
+    # calculate dvars
+    dvs = dvars_voxel(run.brain_voxels)
+    # detect outliers
+    is_outlier = mad_time_detector(dvs, lower_bound=True)
+    return np.nonzero(is_outlier)
+
+
+def sliding_window_outliers(run, window_length=20, window_step=10):
+    """ Detect outlier volumes in `run` with a sliding window over volume means
+
+    Parameters
+    ----------
+    run : RunData
+        Loaded and segmented data for one run.
+    window_length : int, optional
+        Number of volumes in each window.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+
+    Returns
+    -------
+    outliers : array
+        Indices of outlier volumes.
+    """
+    # calculate the mean of the brain voxels for each volume, once
+    volume_means = np.mean(run.brain_voxels, axis=0, dtype=np.float64)
+    # apply sliding window
+    is_outlier = sliding_window_detector(volume_means, window_length,
+                                         window_step)
+    return np.nonzero(is_outlier)[0]
+
+
+def detect_outliers_mad_median_absolute_deviation_mask(fname, dtype=np.float64):
     """ Detect outliers given image file path 'filename'
      
     Parameters
     ----------
     fname : str or Path
         Filename of 4D image, as string or Path object
+    dtype : dtype, optional
+        Floating point type for calculations.
     
     Returns
     -------
@@ -46,28 +461,18 @@ def detect_outliers_mad_median_absolute_deviation_mask(fname):
         Indices of outlier volumes.
     """
     # A mask is used to first segment the brain regions from the background, then median absolute deviation is used to detect outliers
-    img = nib.load(fname)
-    img_data = img.get_fdata()
-    # reshape from 4D to 2D
-    img_data_2D = np.reshape(img_data, (-1,img_data.shape[-1]))
-    # segment brain from background
-    brain_voxels = segment_brain(img_data_2D)
-    # find the outlying voxels
-    outliers_voxel = mad_voxel_detector(brain_voxels)
-    # calculate the number of outlying voxels for each time point
-    voxel_outliers_per_time = np.nansum(outliers_voxel,axis=0)
-    # find the outliers in the time-series    
-    outliers_time = mad_time_detector(voxel_outliers_per_time, lower_bound=False)
-    # Return indices of True values from Boolean array. 
-    return np.nonzero(outliers_time)
+    return mad_voxel_outliers(load_run(fname, dtype=dtype))
 
-def detect_outliers_mad_dvars_mask(fname):
+
+def detect_outliers_mad_dvars_mask(fname, dtype=np.float64):
     """ Detect outliers given image file path 'filename'
     
     Parameters
     ----------
     fname : str or Path
         Filename of 4D image, as string or Path object
+    dtype : dtype, optional
+        Floating point type for calculations.
     
     Returns
     -------
@@ -75,25 +480,23 @@ def detect_outliers_mad_dvars_mask(fname):
         Indices of outlier volumes.
     """
     # A mask is used to first segment the brain regions from the background, dvars is calculated and then median absolute deviation is used to detect outliers 
-    img = nib.load(fname)
-    img_data = img.get_fdata()
-    # reshape from 4D to 2D
-    img_data_2D = np.reshape(img_data, (-1,img_data.shape[-1]))
-    # segment brain from background
-    brain_voxels = segment_brain(img_data_2D)
-    # calculate dvars
-    dvs = dvars_voxel(brain_voxels)
-    # detect outliers
-    is_outlier = mad_time_detector(dvs, lower_bound=True)
-    return np.nonzero(is_outlier)
+    return dvars_outliers(load_run(fname, dtype=dtype))
 
-def detect_outliers_mad_sliding_window_mask(fname):
+
+def detect_outliers_mad_sliding_window_mask(fname, dtype=np.float64,
+                                            window_length=20, window_step=10):
     """ Detect outliers given image file path 'filename'
     
     Parameters
     ----------
     fname : str or Path
         Filename of 4D image, as string or Path object
+    dtype : dtype, optional
+        Floating point type for calculations.
+    window_length : int, optional
+        Number of volumes in each window.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
     
     Returns 
     -------
@@ -101,27 +504,193 @@ def detect_outliers_mad_sliding_window_mask(fname):
         Indices of outlier volumes.
     """
     # A mask is used to first segment the brain regions from the background, sliding window approach is used to detect outliers in each window using median absolute deviation
-    img = nib.load(fname)
-    img_data = img.get_fdata()
-    # reshape from 4D to 2D
-    img_data_2D = np.reshape(img_data, (-1,img_data.shape[-1]))
-    # segment brain from background
-    brain_voxels = segment_brain(img_data_2D)
-    # apply sliding window
-    overlap = 10
-    window_length = 20
-    outliers = []
-    for i in range(0, brain_voxels.shape[-1],overlap):
-       if i+window_length>=brain_voxels.shape[-1]:
-           elements = np.mean(brain_voxels[:,i:],axis=0)
-           outliers_1 = np.nonzero(mad_time_detector(elements, lower_bound=True))[0] + i
-           outliers.extend(outliers_1)
-           break
-       else:
-           elements = np.mean(brain_voxels[:,i:i+window_length],axis=0)
-           outliers_1 = np.nonzero(mad_time_detector(elements, lower_bound=True))[0] + i
-           outliers.extend(outliers_1)
-    return np.unique(outliers)
+    return sliding_window_outliers(load_run(fname, dtype=dtype),
+                                   window_length, window_step)
+
+
+# Intermediate values stored as metrics, for example in the metrics cache.
+METRIC_NAMES = ('mask', 'voxel_outlier_counts', 'dvars', 'volume_means')
+
+# Intermediate values with one value per volume (one fewer for dvars).
+VOLUME_METRICS = ('voxel_outlier_counts', 'dvars', 'volume_means',
+                  'spm_globals')
+
+
+def run_metrics(run, block_size=None, subsample=None, seed=0, pool=None,
+                spm_globals=False):
+    """ Calculate the metrics the masked detectors need for `run`
+
+    Parameters
+    ----------
+    run : RunData
+        Loaded and segmented data for one run.
+    block_size : int, optional
+        Number of voxels to work on at a time.  None gives the default.
+    subsample : float or int, optional
+        If not None, count voxel outliers on this fraction (float) or number
+        (int) of randomly chosen brain voxels.
+    seed : int, optional
+        Seed for choosing the random voxels.
+    pool : VoxelPool, optional
+        If not None, calculate voxel outlier counts and dvars in parallel
+        with this :class:`findoutlie.voxelpool.VoxelPool`.
+    spm_globals : bool, optional
+        If True, also return the SPM globals of `run`, for rules that use
+        them.
+
+    Returns
+    -------
+    metrics : dict
+        Dictionary with keys "voxel_outlier_counts" (number of outlying brain
+        voxels per volume), "dvars" (dvars of brain voxels), "volume_means"
+        (mean of brain voxels per volume) and "mask" (brain mask), and
+        "spm_globals" (SPM global per volume) if `spm_globals` is True.
+    """
+    intermediates = Intermediates({'run': run}, block_size=block_size,
+                                  subsample=subsample, seed=seed, pool=pool)
+    names = METRIC_NAMES + (('spm_globals',) if spm_globals else ())
+    return {name: intermediates[name] for name in names}
+
+
+def metrics_outliers(metrics, window_length=20, window_step=10,
+                     rule=DEFAULT_RULE, load=None, block_size=None,
+                     subsample=None, seed=0, pool=None):
+    """ Combine the masked detectors on `metrics` to find outlier volumes
+
+    Parameters
+    ----------
+    metrics : dict
+        Metrics for one run, from :func:`run_metrics`.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    rule : str, optional
+        Rule combining the detectors, see :mod:`findoutlie.ensemble`.
+    load : callable, optional
+        Function to load the run, if `rule` needs values not in `metrics`;
+        see :class:`findoutlie.ensemble.Intermediates`.
+    block_size : int, optional
+        Number of voxels to work on at a time, for metrics not in `metrics`.
+    subsample : float or int, optional
+        If not None, count voxel outliers on this fraction (float) or number
+        (int) of randomly chosen brain voxels, if not in `metrics`.
+    seed : int, optional
+        Seed for choosing the random voxels.
+    pool : VoxelPool, optional
+        If not None, calculate metrics not in `metrics` on blocks of voxels
+        in parallel, with this :class:`findoutlie.voxelpool.VoxelPool`.
+        `load` should then usually load into this pool.
+
+    Returns
+    -------
+    outliers : array
+        Indices of outlier volumes.
+    """
+    ensemble = Ensemble(rule, window_length, window_step)
+    return ensemble.outliers(ensemble.intermediates(
+        metrics, load, block_size=block_size, subsample=subsample, seed=seed,
+        pool=pool))
+
+
+def metrics_results(metrics, window_length=20, window_step=10,
+                    rule=DEFAULT_RULE, load=None, block_size=None,
+                    subsample=None, seed=0, pool=None):
+    """ Return outliers, outliers per detector, and per-volume metrics
+
+    As for :func:`metrics_outliers`, but also return what the outliers came
+    from, for example to store in :class:`findoutlie.resultsdb.ResultsDB`.
+    The voxel outlier counts, dvars and volume means are always calculated,
+    as for :func:`run_metrics`; the SPM globals only if `rule` needs them.
+
+    Parameters are as for :func:`metrics_outliers`.
+
+    Returns
+    -------
+    results : dict
+        With keys "outliers" (indices of outlier volumes), "detectors" (dict
+        of outlier indices for each detector in `rule`) and "metrics" (dict
+        of calculated values named in :data:`VOLUME_METRICS`).
+    """
+    ensemble = Ensemble(rule, window_length, window_step)
+    intermediates = Intermediates(
+        metrics, load, ensemble.needs.union(METRIC_NAMES),
+        block_size=block_size, subsample=subsample, seed=seed, pool=pool)
+    detectors = ensemble.detector_outliers(intermediates)
+    # Calculate any metrics the rule did not need.
+    for name in METRIC_NAMES:
+        intermediates[name]
+    return {'outliers': ensemble.combine(detectors),
+            'detectors': detectors,
+            'metrics': {name: np.asarray(intermediates.values[name])
+                        for name in VOLUME_METRICS
+                        if name in intermediates.values}}
+
+
+def detect_run_outliers(run, window_length=20, window_step=10,
+                        rule=DEFAULT_RULE):
+    """ Combine the masked detectors to find outlier volumes in `run`
+
+    Parameters
+    ----------
+    run : RunData
+        Loaded and segmented data for one run.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    rule : str, optional
+        Rule combining the detectors, see :mod:`findoutlie.ensemble`.
+
+    Returns
+    -------
+    outliers : array
+        Indices of outlier volumes.
+    """
+    return metrics_outliers({'run': run}, window_length, window_step, rule)
+
+
+def run_threshold_sweep(run, thresholds, window_length=20, window_step=10):
+    """ Combine the masked detectors on `run` for each of `thresholds`
+
+    For each threshold, all the MAD thresholds in :func:`detect_run_outliers`
+    (3.5 by default) are set to the threshold.  The voxel deviations, dvars
+    and volume means are calculated once, for all thresholds.
+
+    Parameters
+    ----------
+    run : RunData
+        Loaded and segmented data for one run.
+    thresholds : sequence
+        Non-negative scalars to multiply the median absolute deviation to
+        form thresholds.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+
+    Returns
+    -------
+    outliers : list
+        Arrays of indices of outlier volumes, one per threshold.
+    """
+    with stage('voxel_outlier_count_sweep'):
+        counts = mad_voxel_count_sweep(run.brain_voxels, thresholds)
+    with stage('dvars'):
+        dvs = dvars_voxel(run.brain_voxels)
+    with stage('volume_means'):
+        means = np.mean(run.brain_voxels, axis=0, dtype=np.float64)
+    with stage('detect_sweep'):
+        # Each threshold applies to its own row of voxel outlier counts; the
+        # detector works on each row, with the thresholds as a column.
+        mad_tf = mad_time_detector(
+            counts, False, np.asarray(thresholds, dtype=float)[:, None])
+        dvars_tf = mad_time_sweep(dvs, True, thresholds)
+        sliding_tf = sliding_window_sweep(means, thresholds, window_length,
+                                          window_step)
+    return [np.intersect1d(np.nonzero(sliding)[0],
+                           np.union1d(np.nonzero(mad)[0], np.nonzero(dv)[0]))
+            for mad, dv, sliding in zip(mad_tf, dvars_tf, sliding_tf)]
 
 
 def detect_outliers(fname):
@@ -138,37 +707,651 @@ def detect_outliers(fname):
         Indices of outlier volumes.
     """
     # This is a very simple function, using dvars and iqroutliers
-    img = nib.load(fname)
+    img = load_image(fname)
     dvs = dvars(img)
     is_outlier = iqr_detector(dvs, iqr_proportion=2)
     # Return indices of True values from Boolean array.
     return np.nonzero(is_outlier)
 
 
-def find_outliers(data_directory):
-    """ Return filenames and outlier indices for images in `data_directory`.
+def run_blocks(fname, dtype=None, max_memory=None, voxel_jobs=1):
+    """ Return volume and voxel block sizes for `fname` within `max_memory`
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, or store directory.
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    max_memory : int or str, optional
+        Memory budget, in bytes, or as string such as "4G".  If None, return
+        the default block sizes.
+    voxel_jobs : int, optional
+        Number of voxel worker processes sharing `max_memory`; see
+        :class:`findoutlie.voxelpool.VoxelPool`.  If None, one per CPU.
+
+    Returns
+    -------
+    volume_block : int
+        Number of volumes to read at a time.
+    voxel_block : int or None
+        Number of voxels for metrics to work on at a time, in each voxel
+        worker, or None for the defaults.
+
+    Raises
+    ------
+    MemoryError
+        If `fname` will not fit in `max_memory`.
+    """
+    if max_memory is None:
+        return DEFAULT_VOLUME_BLOCK, None
+    try:
+        return plan_blocks(run_info(fname), max_memory,
+                           run_dtype(fname, dtype),
+                           voxel_jobs=voxel_jobs or os.cpu_count())
+    except MemoryError as err:
+        raise MemoryError(f'{fname}: {err}') from err
+
+
+def memory_estimates(data_directory, dtype=None, voxel_jobs=1):
+    """ Return estimated peak memory for each image in `data_directory`
+
+    Estimates come from the image headers, so are quick to calculate.
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing images, or time-major stores.
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    voxel_jobs : int, optional
+        Number of voxel worker processes for each image.  If None, one per
+        CPU.
+
+    Returns
+    -------
+    estimates : dict
+        Dictionary with keys being filenames, and values being (default,
+        minimum) pairs, where ``default`` is the estimated peak bytes with
+        default block sizes, and ``minimum`` is the estimated peak bytes with
+        the smallest blocks, as used with a tight ``max_memory``.
+    """
+    estimates = {}
+    for fname in image_paths(data_directory):
+        info = run_info(fname)
+        kwargs = dict(info, dtype=run_dtype(fname, dtype),
+                      voxel_jobs=voxel_jobs or os.cpu_count())
+        estimates[fname] = (
+            estimate_peak(**kwargs),
+            estimate_peak(volume_block=1, voxel_block=1, **kwargs))
+    return estimates
+
+
+def _voxel_pool(voxel_jobs):
+    """ Return :class:`VoxelPool` for `voxel_jobs`, or null context if 1
+    """
+    return nullcontext() if voxel_jobs == 1 else VoxelPool(voxel_jobs)
+
+
+def file_metrics(fname, dtype=None, cache=None, content_hash=None,
+                 image_cache=None, max_memory=None, subsample=None, seed=0,
+                 downsample=None, voxel_jobs=1, spm_globals=False):
+    """ Return metrics for image `fname`, from `cache` if possible
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, as string or Path object
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    cache : MetricsCache, optional
+        Cache for metrics.  If None, always calculate the metrics.
+    content_hash : str, optional
+        SHA1 hash of contents of `fname`, if known, for example from a
+        ``hash_list.txt`` file.  If None, and `cache` is not None, calculate
+        the hash from the file.  A given hash may be out of date, so the
+        cache key then also has the path, modification time and size of
+        `fname`.
+    image_cache : ImageCache, optional
+        If not None, read images via this cache of decompressed images.
+    max_memory : int or str, optional
+        If not None, memory budget for calculating metrics; see
+        :func:`run_blocks`.
+    subsample : float or int, optional
+        If not None, count voxel outliers on this fraction (float) or number
+        (int) of randomly chosen brain voxels.
+    seed : int, optional
+        Seed for choosing the random voxels.
+    downsample : int or sequence, optional
+        If not None, calculate metrics on the image downsampled by this
+        factor; see :func:`load_run`.
+    voxel_jobs : int, optional
+        Number of processes for calculating the metrics on blocks of voxels
+        in parallel; see :class:`findoutlie.voxelpool.VoxelPool`.  If None,
+        use one per CPU.
+    spm_globals : bool, optional
+        If True, also calculate the SPM globals, in the same pass over the
+        image, and cache them with the other metrics.
+
+    Returns
+    -------
+    metrics : dict
+        Metrics for `fname`, see :func:`run_metrics`.
+    """
+    dtype = run_dtype(fname, dtype)
+    volume_block, voxel_block = run_blocks(fname, dtype, max_memory,
+                                           voxel_jobs)
+
+    def calculate():
+        with _voxel_pool(voxel_jobs) as pool:
+            run = load_run(fname, volume_block, dtype, image_cache,
+                           spm_globals, downsample, pool)
+            return run_metrics(run, voxel_block, subsample, seed, pool,
+                               spm_globals)
+
+    if cache is None:
+        return calculate()
+    params = {'dtype': np.dtype(dtype).name, 'voxel_threshold': 3.5}
+    if content_hash is not None:
+        # The hash list may not have been updated after an edit to the file.
+        params['file_key'] = path_key(fname)
+    elif is_store(fname):
+        # Metrics depend on the source image contents.
+        content_hash = read_store(fname)[2]['source_sha1']
+    if content_hash is None:
+        with stage('file_hash'):
+            content_hash = file_hash(fname)
+    if subsample is not None:
+        params.update(voxel_subsample=subsample, seed=seed)
+    if downsample is not None:
+        params['downsample'] = list(downsample_factors(downsample))
+    if spm_globals:
+        params['spm_globals'] = True
+    key = cache.key(content_hash, params)
+    with stage('cache_get'):
+        metrics = cache.get(key)
+    if metrics is None:
+        metrics = calculate()
+        with stage('cache_put'):
+            cache.put(key, metrics)
+    return metrics
+
+
+def file_outliers(fname, dtype=None, window_length=20, window_step=10,
+                  cache=None, content_hash=None, image_cache=None,
+                  rule=DEFAULT_RULE, max_memory=None, subsample=None,
+                  seed=0, downsample=None, results=False, voxel_jobs=1):
+    """ Load image `fname` and return indices of its outlier volumes
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, as string or Path object
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    cache : MetricsCache, optional
+        Cache for metrics.  If None, always calculate the metrics.
+    content_hash : str, optional
+        SHA1 hash of contents of `fname`, if known.
+    image_cache : ImageCache, optional
+        If not None, read images via this cache of decompressed images.
+    rule : str, optional
+        Rule combining the detectors, see :mod:`findoutlie.ensemble`.
+    max_memory : int or str, optional
+        If not None, memory budget, in bytes, or as string such as "4G".
+        Block sizes for reading and calculating come from this budget; see
+        :func:`run_blocks`.
+    subsample : float or int, optional
+        If not None, count voxel outliers on this fraction (float) or number
+        (int) of randomly chosen brain voxels, for a fast triage.
+    seed : int, optional
+        Seed for choosing the random voxels.
+    downsample : int or sequence, optional
+        If not None, run the detectors on the image downsampled by this
+        factor, for a fast preview; see :func:`load_run`.
+    results : bool, optional
+        If True, return the results dict from :func:`metrics_results`,
+        instead of the outlier indices.
+    voxel_jobs : int, optional
+        Number of processes for the per-voxel calculations within the run;
+        see :class:`findoutlie.voxelpool.VoxelPool`.  If None, use one per
+        CPU.
+
+    Returns
+    -------
+    outliers : array or dict
+        Indices of outlier volumes, or results dict if `results` is True.
+    """
+    dtype = run_dtype(fname, dtype)
+    with current_file(fname):
+        # The detectors load and segment the run once, if they need values
+        # that are not in the cached metrics.  The cached metrics include the
+        # SPM globals if the rule needs them.
+        needs_spm = 'spm_globals' in Ensemble(rule).needs
+        metrics = ({} if cache is None else
+                   file_metrics(fname, dtype, cache, content_hash,
+                                image_cache, max_memory, subsample, seed,
+                                downsample, voxel_jobs, needs_spm))
+        volume_block, voxel_block = run_blocks(fname, dtype, max_memory,
+                                               voxel_jobs)
+        detect = metrics_results if results else metrics_outliers
+        with _voxel_pool(voxel_jobs) as pool:
+            load = partial(load_run, fname, volume_block, dtype, image_cache,
+                           downsample=downsample, pool=pool)
+            return detect(metrics, window_length, window_step, rule, load,
+                          voxel_block, subsample, seed, pool)
+
+
+def file_threshold_sweep(fname, thresholds, dtype=None,
+                         window_length=20, window_step=10, image_cache=None):
+    """ Load image `fname` and return its outlier volumes for `thresholds`
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, or time-major store.
+    thresholds : sequence
+        Non-negative scalars to multiply the median absolute deviation to
+        form thresholds.
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    image_cache : ImageCache, optional
+        If not None, read images via this cache of decompressed images.
+
+    Returns
+    -------
+    outliers : list
+        Arrays of indices of outlier volumes, one per threshold.
+    """
+    with current_file(fname):
+        run = load_run(fname, dtype=dtype, image_cache=image_cache)
+        return run_threshold_sweep(run, thresholds, window_length,
+                                   window_step)
+
+
+def _profiled_call(func, *args):
+    # Run func in worker process, with profiling; return result and profile
+    # records, for the parent process.
+    profiling.enable()
+    result = func(*args)
+    return result, profiling.disable()
+
+
+def _timed_call(func, *args):
+    # Return result of func, and wall time in seconds.
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _imap_files(func, image_fnames, args, jobs=1):
+    """ Yield ``(fname, func(*args(fname)))`` for each of `image_fnames`
+
+    Use `jobs` processes, or run in this process if `jobs` is 1.  With one
+    process, yield in the order of `image_fnames`, otherwise in the order the
+    results arrive.  Submit the largest images first, and collect any profile
+    records from the workers.  If the caller stops iterating early, images
+    not yet started are cancelled.
+    """
+    if jobs == 1:
+        for fname in image_fnames:
+            yield fname, func(*args(fname))
+        return
+    profile = profiling.is_enabled()
+    worker = partial(_profiled_call, func) if profile else func
+    # Importing the process pool machinery is slow; only do it when needed.
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(worker, *args(fname)): fname
+                   for fname in largest_first(image_fnames)}
+        try:
+            for future in as_completed(futures):
+                # Drop our reference to the result once it is yielded.
+                fname = futures.pop(future)
+                result = future.result()
+                if profile:
+                    # Collect profile records from the worker.
+                    result, records = result
+                    profiling.add_records(records)
+                yield fname, result
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _map_files(func, image_fnames, args, jobs=1):
+    """ Return dict of ``func(*args(fname))`` for each of `image_fnames`
+
+    Keys are in the order of `image_fnames`.  See :func:`_imap_files`.
+    """
+    results = dict(_imap_files(func, image_fnames, args, jobs))
+    return {fname: results[fname] for fname in image_fnames}
+
+
+def _data_size(fname):
+    # Size of image file, or of voxel data in store.
+    path = Path(fname)
+    if path.is_dir():
+        path = path / 'brain.npy'
+    return path.stat().st_size
+
+
+def largest_first(fnames):
+    """ Return `fnames` sorted by decreasing file size
+
+    Starting the largest files first means the last worker in a pool is not
+    left with one big file after the others have finished.
+    """
+    return sorted(fnames, key=_data_size, reverse=True)
+
+
+def image_paths(data_directory):
+    """ Return sorted images and time-major stores in `data_directory`
+
+    Parameters
+    ----------
+    data_directory : str or Path
+        Directory containing ``sub-*.nii.gz`` images, or ``sub-*.tstore``
+        stores from :func:`convert_dataset`.
+
+    Returns
+    -------
+    paths : list
+        Sorted image filenames and store directories.
+    """
+    data_directory = Path(data_directory)
+    stores = [path for path in data_directory.glob(f"**/sub-*{STORE_SUFFIX}")
+              if is_store(path)]
+    return sorted(list(data_directory.glob("**/sub-*.nii.gz")) + stores)
+
+
+def iter_outliers(data_directory, jobs=1, dtype=None, window_length=20,
+                  window_step=10, cache=None, image_cache=None,
+                  rule=DEFAULT_RULE, max_memory=None, subsample=None,
+                  seed=0, downsample=None, journal=None, resume=False,
+                  results_db=None, voxel_jobs=1):
+    """ Yield filename and outlier indices for each image in `data_directory`
+
+    Results come as each image finishes, so callers can act on them before
+    the slowest image is done, and need not keep them all.
 
     Parameters
     ----------
     data_directory : str
-        Directory containing containing images.
+        Directory containing containing images, or time-major stores (see
+        :func:`convert_dataset`).
+    jobs : int, optional
+        Number of processes to use.  If 1 (the default), process images in
+        this process.  If None, use one process per CPU.
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    cache : MetricsCache, optional
+        Cache for per-run metrics.  Hashes from ``hash_list.txt`` files in
+        `data_directory` are used as the content hashes for the cache.  If
+        None, always calculate the metrics.
+    image_cache : ImageCache, optional
+        If not None, read images via this cache of decompressed images.
+    rule : str, optional
+        Rule combining the detectors, see :mod:`findoutlie.ensemble`.
+    max_memory : int or str, optional
+        If not None, memory budget for all processes together, in bytes, or
+        as string such as "4G".  Each of the `jobs` processes gets an equal
+        share, which it shares with its `voxel_jobs` workers.  Block sizes
+        come from the full image size, even with `downsample`.
+    subsample : float or int, optional
+        If not None, count voxel outliers on this fraction (float) or number
+        (int) of randomly chosen brain voxels, for a fast triage.  See
+        :func:`compare_to_full` to check agreement with all voxels.
+    seed : int, optional
+        Seed for choosing the random voxels.
+    downsample : int or sequence, optional
+        If not None, average each volume over blocks of this many voxels
+        along each axis (e.g. 2 for 2x2x2 blocks) as it is read, and run the
+        detectors on the downsampled images, for a fast preview.  See
+        :func:`compare_to_full` to check agreement with full resolution.
+    journal : Journal, optional
+        If not None, append the outliers for each image to this
+        :class:`findoutlie.journal.Journal` as soon as the image is done.
+    resume : bool, optional
+        If True, do not process images that `journal` has as finished with
+        the same detection parameters, and unchanged since; use the
+        outliers from the journal instead.
+    results_db : ResultsDB, optional
+        If not None, add the per-volume metrics, and the outliers from each
+        detector, for each processed image, to this
+        :class:`findoutlie.resultsdb.ResultsDB`.
+    voxel_jobs : int, optional
+        Number of processes for the per-voxel calculations within each run,
+        for runs too large to wait for in one process; see
+        :class:`findoutlie.voxelpool.VoxelPool`.  If None, use one per CPU.
+        Each of the `jobs` processes has its own `voxel_jobs` processes.
+
+    Yields
+    ------
+    fname : Path
+        Filename of image, or store directory.
+    outliers : array
+        Indices of outlier volumes for `fname`.  Images from the journal
+        come first.  Then, with one process, images come in sorted filename
+        order, otherwise in the order they finish.
+
+    Raises
+    ------
+    MemoryError
+        If any image will not fit in its share of `max_memory`.  We check
+        all images, from their headers, before starting.
+    """
+    image_fnames = image_paths(data_directory)
+    if max_memory is not None:
+        n_processes = 1 if jobs == 1 else jobs or os.cpu_count()
+        max_memory = parse_size(max_memory) // n_processes
+        # Fail before any processing if an image will not fit.
+        for fname in image_fnames:
+            run_blocks(fname, dtype, max_memory, voxel_jobs)
+    params = (dtype, window_length, window_step, cache)
+    hashes = ({} if cache is None and journal is None
+              else read_hash_lists(data_directory))
+    worker = partial(file_outliers, image_cache=image_cache, rule=rule,
+                     max_memory=max_memory, subsample=subsample, seed=seed,
+                     downsample=downsample, results=results_db is not None,
+                     voxel_jobs=voxel_jobs)
+
+    def args(fname):
+        return (fname,) + params + (hashes.get(fname.resolve()),)
+
+    if journal is None and results_db is None:
+        yield from _imap_files(worker, image_fnames, args, jobs)
+        return
+    # Parameters that change the outliers.
+    run_params = {'dtype': None if dtype is None else np.dtype(dtype).name,
+                  'window_length': window_length, 'window_step': window_step,
+                  'rule': rule, 'subsample': subsample, 'seed': seed,
+                  'downsample': downsample}
+    done = journal.completed(run_params) if journal and resume else {}
+    todo = []
+    for fname in image_fnames:
+        if fname.resolve() in done:
+            yield fname, done[fname.resolve()]
+        else:
+            todo.append(fname)
+    for fname, (result, seconds) in _imap_files(
+            partial(_timed_call, worker), todo, args, jobs):
+        outliers = result if results_db is None else result['outliers']
+        if results_db is not None:
+            results_db.add_run(fname, run_params, result)
+        if journal is not None:
+            journal.record(fname, run_params, outliers, seconds,
+                           hashes.get(fname.resolve()))
+        yield fname, outliers
+
+
+def find_outliers(data_directory, jobs=1, dtype=None, window_length=20,
+                  window_step=10, cache=None, image_cache=None,
+                  rule=DEFAULT_RULE, max_memory=None, subsample=None,
+                  seed=0, downsample=None, journal=None, resume=False,
+                  results_db=None, voxel_jobs=1):
+    """ Return filenames and outlier indices for images in `data_directory`.
+
+    Parameters are as for :func:`iter_outliers`.
 
     Returns
     -------
     outlier_dict : dict
         Dictionary with keys being filenames and values being lists of outliers
-        for filename.
+        for filename.  Keys are in sorted filename order.
+
+    Raises
+    ------
+    MemoryError
+        If any image will not fit in its share of `max_memory`.  We check
+        all images, from their headers, before starting.
     """
-    image_fnames = Path(data_directory).glob("**/sub-*.nii.gz")
-    outlier_dict = {}
-    for fname in image_fnames:
-        # detect outliers using mad over voxels and mad over time points
-        outliers_mad = detect_outliers_mad_median_absolute_deviation_mask(fname)
-        # detect outliers using dvars and mad over time points
-        outliers_dvars = detect_outliers_mad_dvars_mask(fname)
-        # detect outliers using sliding window and mad over time points
-        outliers_sliding_window = np.array(detect_outliers_mad_sliding_window_mask(fname))
-        outliers = np.intersect1d(outliers_sliding_window,np.union1d(outliers_mad, outliers_dvars))
-        #outliers = detect_outliers(fname)
-        outlier_dict[fname] = outliers
-    return outlier_dict
+    outlier_dict = dict(iter_outliers(
+        data_directory, jobs, dtype, window_length, window_step, cache,
+        image_cache, rule, max_memory, subsample, seed, downsample, journal,
+        resume, results_db, voxel_jobs))
+    return {fname: outlier_dict[fname] for fname in sorted(outlier_dict)}
+
+
+def compare_outliers(reference, test):
+    """ Return agreement of outlier indices `test` with `reference`
+
+    Parameters
+    ----------
+    reference : array-like
+        Outlier indices from full calculation.
+    test : array-like
+        Outlier indices from a faster approximation.
+
+    Returns
+    -------
+    agreement : dict
+        With keys "reference" and "test" (the indices), "missed" (indices in
+        `reference` but not `test`), "extra" (indices in `test` but not
+        `reference`) and "jaccard" (size of intersection over size of union,
+        1 if both are empty).
+    """
+    reference, test = np.unique(reference), np.unique(test)
+    union = np.union1d(reference, test)
+    common = np.intersect1d(reference, test)
+    return {'reference': reference, 'test': test,
+            'missed': np.setdiff1d(reference, test),
+            'extra': np.setdiff1d(test, reference),
+            'jaccard': len(common) / len(union) if len(union) else 1.}
+
+
+def compare_to_full(data_directory, approximation, **kwargs):
+    """ Compare outliers from an approximation to the full calculation
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing images, or time-major stores.
+    approximation : dict
+        Keyword arguments for :func:`find_outliers` that select the
+        approximation, such as ``{'subsample': 0.1}`` or
+        ``{'downsample': 2}``.
+    **kwargs : dict
+        Other keyword arguments for :func:`find_outliers`, for both runs.
+
+    Returns
+    -------
+    agreements : dict
+        Dictionary with keys being filenames, and values being dicts from
+        :func:`compare_outliers`.
+    """
+    full = find_outliers(data_directory, **kwargs)
+    test = find_outliers(data_directory, **dict(kwargs, **approximation))
+    return {fname: compare_outliers(full[fname], test[fname])
+            for fname in full}
+
+
+def sweep_thresholds(data_directory, thresholds, jobs=1, dtype=None,
+                     window_length=20, window_step=10, image_cache=None):
+    """ Return outlier indices for each of `thresholds`, for each image
+
+    Parameters
+    ----------
+    data_directory : str
+        Directory containing images, or time-major stores.
+    thresholds : sequence
+        Non-negative scalars to multiply the median absolute deviation to
+        form thresholds.
+    jobs : int, optional
+        Number of processes to use.  If None, use one process per CPU.
+    dtype : dtype, optional
+        Floating point type for calculations.  If None, use float64 for
+        images, and the stored type for stores; see :func:`run_dtype`.
+    window_length : int, optional
+        Number of volumes in each window for the sliding window detector.
+    window_step : int, optional
+        Number of volumes between starts of successive windows.
+    image_cache : ImageCache, optional
+        If not None, read images via this cache of decompressed images.
+
+    Returns
+    -------
+    sweep_dict : dict
+        Dictionary with keys being filenames, and values being lists, with
+        one array of outlier indices per threshold.  Keys are in sorted
+        filename order.
+    """
+    image_fnames = image_paths(data_directory)
+    params = (thresholds, dtype, window_length, window_step, image_cache)
+    return _map_files(file_threshold_sweep, image_fnames,
+                      lambda fname: (fname,) + params, jobs)
+
+
+def dtype_deviations(fname, dtype=np.float32):
+    """ Compare detector inputs and outliers for `dtype` against float64
+
+    Use this to check that a reduced precision `dtype` does not change the
+    outliers for a given image.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, as string or Path object
+    dtype : dtype, optional
+        Floating point type to compare against float64.
+
+    Returns
+    -------
+    deviations : dict
+        With keys "dvars", "volume_means" giving the maximum absolute
+        difference from the float64 values, relative to the largest absolute
+        float64 value, "voxel_outlier_counts" giving the
+        maximum difference in number of outlying voxels for any volume, and
+        "outliers_equal", True if the outlier indices are the same.
+    """
+    runs = [load_run(fname, dtype=dt) for dt in (np.float64, dtype)]
+    dvs = [dvars_voxel(run.brain_voxels) for run in runs]
+    means = [np.mean(run.brain_voxels, axis=0, dtype=np.float64)
+             for run in runs]
+    counts = [mad_voxel_counts(run.brain_voxels) for run in runs]
+    outliers = [detect_run_outliers(run) for run in runs]
+    return {
+        'dvars': np.max(np.abs(dvs[0] - dvs[1])) / np.max(np.abs(dvs[0])),
+        'volume_means': (np.max(np.abs(means[0] - means[1])) /
+                         np.max(np.abs(means[0]))),
+        'voxel_outlier_counts': np.max(np.abs(counts[0] - counts[1])),
+        'outliers_equal': np.array_equal(outliers[0], outliers[1]),
+    }
@@ -0,0 +1,164 @@
+""" Per-stage timing and memory instrumentation
+
+Profiling is off by default, and then :func:`stage` does nothing.  After
+:func:`enable`, each ``with stage(name):`` block adds its wall time, CPU time
+and any increase in the process peak resident memory (RSS) to a record for
+that stage and the current file (set with :func:`current_file`).  Records for
+the same stage and file accumulate, so stages inside loops give one record
+with a count of calls.
+
+For example::
+
+    profiling.enable()
+    with profiling.current_file(fname):
+        with profiling.stage('load'):
+            img = load(fname)
+    profiling.write_trace('trace.json')
+    print(profiling.summary())
+"""
+
+from contextlib import contextmanager
+import csv
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+FIELDS = ('file', 'stage', 'calls', 'wall', 'cpu', 'rss_increase_mb',
+          'peak_rss_mb')
+
+# Dictionary of records, keyed by (file, stage), or None if not profiling.
+_records = None
+
+_file = None
+
+
+def _peak_rss_mb():
+    """ Return peak resident memory of this process in MB, or nan
+    """
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def enable():
+    """ Start profiling, clearing any existing records
+    """
+    global _records
+    _records = {}
+
+
+def disable():
+    """ Stop profiling; return records collected so far
+    """
+    global _records
+    records = get_records()
+    _records = None
+    return records
+
+
+def is_enabled():
+    return _records is not None
+
+
+@contextmanager
+def current_file(fname):
+    """ Attribute stages in this context to file `fname`
+    """
+    global _file
+    previous, _file = _file, None if fname is None else str(fname)
+    try:
+        yield
+    finally:
+        _file = previous
+
+
+@contextmanager
+def stage(name):
+    """ Record wall time, CPU time and peak RSS increase for block as `name`
+    """
+    if _records is None:
+        yield
+        return
+    rss_before = _peak_rss_mb()
+    wall_before = time.perf_counter()
+    cpu_before = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_before
+        cpu = time.process_time() - cpu_before
+        peak_rss = _peak_rss_mb()
+        key = (_file, name)
+        record = _records.setdefault(key, {
+            'file': _file, 'stage': name, 'calls': 0, 'wall': 0., 'cpu': 0.,
+            'rss_increase_mb': 0., 'peak_rss_mb': 0.})
+        record['calls'] += 1
+        record['wall'] += wall
+        record['cpu'] += cpu
+        record['rss_increase_mb'] += peak_rss - rss_before
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss)
+
+
+def get_records():
+    """ Return list of records, one dict per file and stage
+    """
+    return [] if _records is None else [dict(r) for r in _records.values()]
+
+
+def add_records(records):
+    """ Merge `records`, for example from a worker process, into our records
+    """
+    if _records is None:
+        return
+    for record in records:
+        key = (record['file'], record['stage'])
+        if key not in _records:
+            _records[key] = dict(record)
+            continue
+        ours = _records[key]
+        for field in ('calls', 'wall', 'cpu', 'rss_increase_mb'):
+            ours[field] += record[field]
+        ours['peak_rss_mb'] = max(ours['peak_rss_mb'], record['peak_rss_mb'])
+
+
+def write_trace(fname, records=None):
+    """ Write `records` to `fname`, as TSV if `fname` ends in ``.tsv``, else JSON
+    """
+    records = get_records() if records is None else records
+    fname = str(fname)
+    with open(fname, 'wt', newline='') as fobj:
+        if fname.endswith('.tsv'):
+            writer = csv.DictWriter(fobj, FIELDS, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(records, fobj, indent=2)
+
+
+def summary(records=None, top=10):
+    """ Return table of the `top` stages by total wall time, over all files
+    """
+    records = get_records() if records is None else records
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {
+            'calls': 0, 'wall': 0., 'cpu': 0., 'peak_rss_mb': 0.})
+        total['calls'] += record['calls']
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['peak_rss_mb'] = max(total['peak_rss_mb'],
+                                   record['peak_rss_mb'])
+    ranked = sorted(totals.items(), key=lambda item: -item[1]['wall'])
+    lines = [f'{"stage":<28} {"calls":>7} {"wall (s)":>10} {"cpu (s)":>10} '
+             f'{"peak RSS MB":>12}']
+    for name, total in ranked[:top]:
+        lines.append(f'{name:<28} {total["calls"]:>7} {total["wall"]:>10.3f} '
+                     f'{total["cpu"]:>10.3f} {total["peak_rss_mb"]:>12.1f}')
+    return '\n'.join(lines)
@@ -0,0 +1,224 @@
+""" SQLite database of per-volume metrics and outliers across an archive
+
+:func:`findoutlie.outfind.find_outliers` gives only the outlier indices for
+each run.  A results database also keeps the metrics the outliers came from,
+and which detectors found each outlier, so later questions about the archive
+are database queries, rather than reprocessing.
+
+The database has tables:
+
+* ``runs`` : one row per run and parameter set, with columns ``id``,
+  ``file``, ``subject``, ``session``, ``task``, ``run`` (BIDS entities from
+  the filename, NULL if absent), ``params`` (detection parameters as JSON),
+  ``n_volumes``, ``n_outliers`` and ``added`` (local time, ISO format);
+* ``volumes`` : one row per volume, with columns ``run_id``, ``volume``,
+  ``voxel_outliers``, ``dvars``, ``mean``, ``spm_global`` and ``outlier`` (1
+  for outliers by the combined rule, otherwise 0).  As for the dvars
+  detector, ``dvars`` for volume ``i`` is from the difference of volumes
+  ``i`` and ``i + 1``, so is NULL for the last volume.  ``spm_global`` is
+  NULL unless the rule used the SPM globals;
+* ``detections`` : one row for each volume that each detector found, with
+  columns ``run_id``, ``volume`` and ``detector``.
+
+For example, runs with more than 5% outlier volumes::
+
+    SELECT file FROM runs WHERE n_outliers > 0.05 * n_volumes;
+
+or dvars values for subject 07::
+
+    SELECT dvars FROM volumes JOIN runs ON runs.id = volumes.run_id
+    WHERE subject = '07';
+
+Adding a run again with the same parameters replaces its earlier rows.
+"""
+
+from pathlib import Path
+import json
+import sqlite3
+import time
+
+from . import __version__
+
+_SCHEMA = """
+PRAGMA foreign_keys = ON;
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    subject TEXT,
+    session TEXT,
+    task TEXT,
+    run TEXT,
+    params TEXT NOT NULL,
+    n_volumes INTEGER,
+    n_outliers INTEGER,
+    added TEXT,
+    UNIQUE (file, params)
+);
+CREATE INDEX IF NOT EXISTS runs_subject ON runs (subject);
+CREATE INDEX IF NOT EXISTS runs_task ON runs (task);
+CREATE INDEX IF NOT EXISTS runs_run ON runs (run);
+CREATE TABLE IF NOT EXISTS volumes (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    volume INTEGER NOT NULL,
+    voxel_outliers INTEGER,
+    dvars REAL,
+    mean REAL,
+    spm_global REAL,
+    outlier INTEGER NOT NULL,
+    PRIMARY KEY (run_id, volume)
+);
+CREATE TABLE IF NOT EXISTS detections (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    volume INTEGER NOT NULL,
+    detector TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS detections_run ON detections (run_id, volume);
+CREATE INDEX IF NOT EXISTS detections_detector ON detections (detector);
+"""
+
+# BIDS filename entity: column name.
+BIDS_ENTITIES = {'sub': 'subject', 'ses': 'session', 'task': 'task',
+                 'run': 'run'}
+
+# Volume metric: column name.
+_METRIC_COLUMNS = {'voxel_outlier_counts': 'voxel_outliers',
+                   'dvars': 'dvars', 'volume_means': 'mean',
+                   'spm_globals': 'spm_global'}
+
+
+def bids_entities(fname):
+    """ Return dict of BIDS entities from filename `fname`
+
+    For example, ``sub-07_task-rest_run-02_bold.nii.gz`` gives ``{'subject':
+    '07', 'session': None, 'task': 'rest', 'run': '02'}``.
+    """
+    entities = dict.fromkeys(BIDS_ENTITIES.values())
+    name = Path(fname).name.split('.')[0]
+    for part in name.split('_'):
+        key, sep, value = part.partition('-')
+        if sep and key in BIDS_ENTITIES:
+            entities[BIDS_ENTITIES[key]] = value
+    return entities
+
+
+def _value(values, i):
+    # Python scalar for element `i` of `values`, or None if out of range.
+    return values[i].item() if i < len(values) else None
+
+
+class ResultsDB:
+    """ SQLite database of per-volume metrics and outliers
+
+    Parameters
+    ----------
+    path : str or Path
+        Database file.  It is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """ Close the database connection
+        """
+        self.connection.close()
+
+    def add_run(self, fname, params, results):
+        """ Add metrics and outliers for run `fname`
+
+        Parameters
+        ----------
+        fname : str or Path
+            Filename of image, or store directory.
+        params : dict
+            Detection parameters.  Values must be JSON serializable.
+        results : dict
+            Results for `fname`, from
+            :func:`findoutlie.outfind.metrics_results`.
+
+        Returns
+        -------
+        run_id : int
+            Row id of run in ``runs`` table.
+        """
+        path = Path(fname).resolve()
+        params = json.dumps(dict(params, version=__version__),
+                            sort_keys=True)
+        metrics = results['metrics']
+        n_volumes = len(metrics['volume_means'])
+        outliers = set(int(i) for i in results['outliers'])
+        columns = {_METRIC_COLUMNS[name]: values
+                   for name, values in metrics.items()}
+        volumes = [[_value(columns[col], i) if col in columns else None
+                    for col in _METRIC_COLUMNS.values()]
+                   + [int(i in outliers)] for i in range(n_volumes)]
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM runs WHERE file = ? AND params = ?',
+                (str(path), params))
+            entities = bids_entities(path)
+            cursor = self.connection.execute(
+                'INSERT INTO runs (file, subject, session, task, run, '
+                'params, n_volumes, n_outliers, added) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(path), entities['subject'], entities['session'],
+                 entities['task'], entities['run'], params, n_volumes,
+                 len(outliers), time.strftime('%Y-%m-%dT%H:%M:%S')))
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO volumes (run_id, volume, voxel_outliers, dvars, '
+                'mean, spm_global, outlier) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [[run_id, i] + row for i, row in enumerate(volumes)])
+            self.connection.executemany(
+                'INSERT INTO detections (run_id, volume, detector) '
+                'VALUES (?, ?, ?)',
+                [(run_id, int(i), name)
+                 for name, indices in results['detectors'].items()
+                 for i in indices])
+        return run_id
+
+    def query(self, sql, parameters=()):
+        """ Return list of rows from SQL query `sql` with `parameters`
+        """
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def outlier_runs(self, min_fraction=0.05):
+        """ Return (file, fraction) rows for runs over `min_fraction` outliers
+
+        Rows are in order of outlier fraction, highest first.
+        """
+        return self.query(
+            'SELECT file, CAST(n_outliers AS REAL) / n_volumes AS fraction '
+            'FROM runs WHERE n_outliers > ? * n_volumes '
+            'ORDER BY fraction DESC', (min_fraction,))
+
+    def metric_values(self, metric, **entities):
+        """ Return values of volume `metric` for runs matching `entities`
+
+        Parameters
+        ----------
+        metric : str
+            Column of ``volumes`` table, such as "dvars".
+        **entities : dict
+            BIDS entities to match, for example ``subject='07'``.
+
+        Returns
+        -------
+        values : list
+            Values of `metric`, by run, then volume, excluding NULLs.
+        """
+        columns = list(_METRIC_COLUMNS.values())
+        if metric not in columns:
+            raise ValueError(f'metric should be one of {columns}')
+        unknown = set(entities).difference(BIDS_ENTITIES.values())
+        if unknown:
+            raise ValueError(f'Unknown entities {sorted(unknown)}')
+        where = ''.join(f' AND {key} = ?' for key in entities)
+        rows = self.query(
+            f'SELECT {metric} FROM volumes JOIN runs ON runs.id = run_id '
+            f'WHERE {metric} IS NOT NULL{where} ORDER BY run_id, volume',
+            tuple(entities.values()))
+        return [value for value, in rows]
@@ -14,7 +14,12 @@ or better, in IPython::
 
 import numpy as np
 
-import nibabel as nib
+try:
+    from .lazy import lazy_import
+except ImportError:  # Imported as a top-level module, as in the tests.
+    from lazy import lazy_import
+
+nib = lazy_import('nibabel')
 
 
 def spm_global(vol):
@@ -34,23 +39,62 @@ def spm_global(vol):
     return np.mean(vol[vol > T])
 
 
-def get_spm_globals(fname):
+def spm_globals_voxels(voxels):
+    """ Calculate SPM global metric for each column of 2D array `voxels`
+
+    This is a vectorized version of :func:`spm_global`, working on all volumes
+    at once, without making a copy of the above-threshold voxels for each
+    volume.  The means and sums use float64, whatever the dtype of `voxels`.
+    For integer image data, the values are identical to :func:`spm_global` on
+    each volume.  For floating point data, the values are the same as for
+    :func:`spm_global` on each volume converted to float64, apart from
+    rounding differences from the order of the sums, of relative size less
+    than 1e-12.
+
+    Parameters
+    ----------
+    voxels : 2D array
+        Image data, with voxels in rows and volumes in columns.
+
+    Returns
+    -------
+    g : 1D array
+        SPM global metric, as float64, for each column of `voxels`.
+    """
+    T = np.mean(voxels, axis=0, dtype=np.float64) / 8
+    above = voxels > T
+    return (np.sum(voxels, axis=0, dtype=np.float64, where=above) /
+            np.count_nonzero(above, axis=0))
+
+
+def get_spm_globals(fname, dtype=np.float64, block_size=16):
     """ Calculate SPM global metrics for volumes in image filename `fname`
 
     Parameters
     ----------
-    fname : str
-        Filename of file containing 4D image
+    fname : str or nibabel image
+        Filename of file containing 4D image, or loaded image, for example
+        a memory-mapped image from ``findoutlie.imcache.ImageCache``.
+    dtype : dtype, optional
+        Floating point type for the volumes read from the image.  The sums
+        for the globals use float64, as for :func:`spm_globals_voxels`.
+    block_size : int, optional
+        Number of volumes to read and process at a time.
 
     Returns
     -------
     spm_vals : array
         SPM global metric for each 3D volume in the 4D image.
     """
-    img = nib.load(fname)
-    data = img.get_fdata()
+    # Keep the file open, and read a block of volumes at a time, rather than
+    # loading the whole image.
+    img = (fname if hasattr(fname, 'dataobj')
+           else nib.load(fname, keep_file_open=True))
+    n_vols = img.shape[-1]
     spm_vals = []
-    for i in range(data.shape[-1]):
-        vol = data[..., i]
-        spm_vals.append(spm_global(vol))
-    return np.array(spm_vals)
+    for start in range(0, n_vols, block_size):
+        block = np.asarray(img.dataobj[..., start:start + block_size],
+                           dtype=dtype)
+        spm_vals.append(
+            spm_globals_voxels(np.reshape(block, (-1, block.shape[-1]))))
+    return np.concatenate(spm_vals)
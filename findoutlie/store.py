@@ -0,0 +1,137 @@
+""" Time-major on-disk store of brain voxel time courses
+
+NIfTI images store data one volume after another, so reading the time
+course of one voxel touches every volume.  The per-voxel calculations
+(medians over time, means over time, differences between volumes) then jump
+around memory.  A store keeps only the brain voxels, as a 2D ``.npy`` array
+of brain voxels by time points, in C order, so each voxel time course is
+contiguous, and any block of voxels is one contiguous chunk of the file.  It
+can be memory-mapped, so detectors read only the blocks they need.
+
+A store is a directory, with name ending in ``.tstore``, containing:
+
+* ``brain.npy`` : brain voxels (rows) by time points (columns);
+* ``mask.npy`` : 3D boolean brain mask;
+* ``affine.npy`` : image affine;
+* ``meta.json`` : image shape, data type, source file and its SHA1 hash.
+
+``meta.json`` is written last, so a store without it is incomplete.
+"""
+
+from pathlib import Path
+import json
+
+import numpy as np
+
+from . import __version__
+
+STORE_SUFFIX = '.tstore'
+
+
+def is_store(path):
+    """ True if `path` is a complete store directory
+    """
+    return (Path(path) / 'meta.json').is_file()
+
+
+class StoreWriter:
+    """ Write brain voxels from streamed blocks of volumes into a store
+
+    Use as an accumulator with :func:`findoutlie.streaming.stream_image`, then
+    call :meth:`close` to finish the store.
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        Directory for store.
+    mask : array
+        3D boolean brain mask.
+    n_volumes : int
+        Number of volumes in the image.
+    affine : array
+        Image affine.
+    dtype : dtype, optional
+        Data type for stored voxel values.
+    meta : dict, optional
+        Extra metadata to write into ``meta.json``.
+    """
+
+    def __init__(self, store_dir, mask, n_volumes, affine, dtype=np.float32,
+                 meta=None):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        # Mark any existing store as incomplete while we write.
+        meta_path = self.store_dir / 'meta.json'
+        if meta_path.is_file():
+            meta_path.unlink()
+        self.mask = np.asarray(mask, dtype=bool)
+        self._flat_mask = np.reshape(self.mask, -1)
+        np.save(self.store_dir / 'mask.npy', self.mask)
+        np.save(self.store_dir / 'affine.npy', affine)
+        self._brain = np.lib.format.open_memmap(
+            self.store_dir / 'brain.npy', mode='w+', dtype=dtype,
+            shape=(int(np.count_nonzero(self.mask)), int(n_volumes)))
+        shape = [int(n) for n in self.mask.shape + (n_volumes,)]
+        self.meta = dict(meta or {}, shape=shape, dtype=np.dtype(dtype).name,
+                         version=__version__)
+        self._n = 0
+
+    def update(self, block):
+        n = block.shape[-1]
+        self._brain[:, self._n:self._n + n] = block[self._flat_mask]
+        self._n += n
+
+    def close(self):
+        """ Flush voxel data, and write ``meta.json`` to complete the store
+        """
+        self._brain.flush()
+        del self._brain
+        with open(self.store_dir / 'meta.json', 'wt') as fobj:
+            json.dump(self.meta, fobj, indent=2)
+
+
+def read_store(store_dir, mmap=True):
+    """ Read brain voxels, mask and metadata from store `store_dir`
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        Store directory.
+    mmap : bool, optional
+        If True, memory-map the brain voxels, otherwise read into memory.
+
+    Returns
+    -------
+    mask : array
+        1D boolean brain mask, in the voxel order of
+        ``np.reshape(data, (-1, n_volumes))``.
+    brain_voxels : array
+        2D array of brain voxels by time points.
+    meta : dict
+        Store metadata, with added "affine" and "mask_shape" entries.
+    """
+    store_dir = Path(store_dir)
+    with open(store_dir / 'meta.json', 'rt') as fobj:
+        meta = json.load(fobj)
+    mask = np.load(store_dir / 'mask.npy')
+    brain_voxels = np.load(store_dir / 'brain.npy',
+                           mmap_mode='r' if mmap else None)
+    meta['affine'] = np.load(store_dir / 'affine.npy')
+    meta['mask_shape'] = mask.shape
+    return np.reshape(mask, -1), brain_voxels, meta
+
+
+def store_path(fname, data_directory, store_root):
+    """ Return store directory for image `fname` in `data_directory`
+
+    The store has the same path relative to `store_root` as `fname` has to
+    `data_directory`, with the ``.nii`` or ``.nii.gz`` extension replaced
+    by ``.tstore``.
+    """
+    relative = Path(fname).relative_to(data_directory)
+    name = relative.name
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return Path(store_root) / relative.parent / (name + STORE_SUFFIX)
@@ -0,0 +1,297 @@
+""" Stream image data one block of volumes at a time
+
+Reading a 4D image with ``img.get_fdata()`` makes a float64 copy of the whole
+image in memory.  The routines here read a block of volumes at a time through
+``img.dataobj``, and pass each block to one or more accumulators, that update
+their metric from the new volumes.  Peak memory is then a few volumes, rather
+than the whole run.
+
+For example, to get dvars and the volume means in one pass over the image::
+
+    dvars, means = Dvars(), VolumeMeans()
+    stream_image(img, [dvars, means])
+    dvars.result(), means.result()
+"""
+
+from itertools import product
+
+import numpy as np
+
+from .spm_funcs import spm_globals_voxels
+from .profiling import stage
+from .lazy import lazy_import
+
+nib = lazy_import('nibabel')
+
+
+def load_image(fname, image_cache=None):
+    """ Load image `fname` for streaming reads
+
+    Keeping the file open means that reading successive volumes from a
+    compressed image does not need to decompress from the start of the file
+    for each read.
+
+    Parameters
+    ----------
+    fname : str or Path
+        Filename of 4D image, as string or Path object
+    image_cache : ImageCache, optional
+        If not None, load a memory-mapped decompressed copy of `fname` from
+        this cache.
+
+    Returns
+    -------
+    img : nibabel image
+    """
+    if image_cache is not None:
+        return image_cache.load(fname)
+    return nib.load(fname, keep_file_open=True)
+
+
+def close_image(img):
+    """ Close file object that `img` was loaded from, if any
+
+    Images from :meth:`findoutlie.imcache.ImageCache.load` keep an open file
+    object for the cached copy.  Images loaded from a filename close their
+    own files.
+
+    Parameters
+    ----------
+    img : nibabel image
+        Image from :func:`load_image`.
+    """
+    fileobj = img.file_map['image'].fileobj
+    if fileobj is not None:
+        fileobj.close()
+
+
+def downsample_factors(factor):
+    """ Return 3-tuple of spatial downsampling factors from `factor`
+    """
+    factors = (factor,) * 3 if np.isscalar(factor) else tuple(factor)
+    if len(factors) != 3 or min(factors) < 1:
+        raise ValueError(f'Need one or three factors >= 1, not {factor}')
+    return tuple(int(f) for f in factors)
+
+
+def downsampled_shape(shape, factor):
+    """ Return volume shape after downsampling volume `shape` by `factor`
+    """
+    factors = downsample_factors(factor)
+    return tuple(n // f for n, f in zip(shape[:3], factors))
+
+
+def downsample(block, factor):
+    """ Average 4D `block` over blocks of `factor` voxels along spatial axes
+
+    Voxels beyond the last whole block along each axis are dropped.
+
+    Parameters
+    ----------
+    block : array
+        4D floating point array of volumes.
+    factor : int or sequence
+        Downsampling factor for all three spatial axes, or one factor per
+        axis.
+
+    Returns
+    -------
+    small : array
+        4D array with shape ``downsampled_shape(block.shape, factor) +
+        block.shape[3:]``.
+    """
+    factors = downsample_factors(factor)
+    shape = downsampled_shape(block.shape, factors)
+    # Sum strided views, one per offset within the blocks.  This is much
+    # faster than reshaping to split the axes, and taking the mean, because
+    # the reshape of the cropped block copies it.
+    total = None
+    for offsets in product(*(range(f) for f in factors)):
+        part = block[tuple(slice(o, n * f, f)
+                           for o, n, f in zip(offsets, shape, factors))]
+        if total is None:
+            total = part.copy()
+        else:
+            total += part
+    total /= np.prod(factors)
+    return total
+
+
+def iter_volumes(img, block_size=1, dtype=np.float64, factor=None):
+    """ Iterate over blocks of volumes in 4D image `img`
+
+    Parameters
+    ----------
+    img : nibabel image
+        4D image.
+    block_size : int, optional
+        Number of volumes to read for each block.
+    dtype : dtype, optional
+        Data type for returned blocks.
+    factor : int or sequence, optional
+        If not None, downsample each block by `factor` as it is read; see
+        :func:`downsample`.
+
+    Yields
+    ------
+    block : array
+        2D array with voxels in rows and up to `block_size` timepoints in
+        columns.  Voxels are in the same order as for
+        ``np.reshape(img.get_fdata(), (-1, img.shape[-1]))``, or, with
+        `factor`, the same image after downsampling.
+    """
+    n_vols = img.shape[-1]
+    for start in range(0, n_vols, block_size):
+        # Reading includes any decompression, and scaling.
+        with stage('read_volumes'):
+            block = np.asarray(img.dataobj[..., start:start + block_size],
+                               dtype=dtype)
+        if factor is not None:
+            with stage('downsample'):
+                block = downsample(block, factor)
+        yield np.reshape(block, (-1, block.shape[-1]))
+
+
+def stream_image(img, accumulators, block_size=1, dtype=np.float64,
+                 factor=None):
+    """ Pass each block of volumes in `img` to each of `accumulators`
+
+    Parameters
+    ----------
+    img : nibabel image
+        4D image.
+    accumulators : sequence
+        Objects with an ``update`` method, accepting a 2D voxel by time block
+        of volumes.
+    block_size : int, optional
+        Number of volumes to read at a time.
+    dtype : dtype, optional
+        Data type for blocks.
+    factor : int or sequence, optional
+        If not None, downsample blocks by `factor`; see :func:`downsample`.
+
+    Returns
+    -------
+    accumulators : sequence
+        The input `accumulators`, after updating with all volumes.
+    """
+    for block in iter_volumes(img, block_size, dtype, factor):
+        for accumulator in accumulators:
+            with stage(f'stream_{type(accumulator).__name__}'):
+                accumulator.update(block)
+    return accumulators
+
+
+class MeanImage:
+    """ Accumulate the mean over time for each voxel
+    """
+
+    def __init__(self):
+        self._sum = None
+        self._n = 0
+
+    def update(self, block):
+        # Sum in float64, to avoid loss of precision over long runs.
+        block_sum = np.sum(block, axis=-1, dtype=np.float64)
+        self._sum = block_sum if self._sum is None else self._sum + block_sum
+        self._n += block.shape[-1]
+
+    def result(self):
+        return self._sum / self._n
+
+
+class VolumeMeans:
+    """ Accumulate the mean over voxels for each volume
+
+    Parameters
+    ----------
+    mask : array, optional
+        1D boolean array selecting voxels (rows of the blocks) to use.
+    """
+
+    def __init__(self, mask=None):
+        self.mask = mask
+        self._values = []
+
+    def update(self, block):
+        if self.mask is not None:
+            block = block[self.mask]
+        self._values.append(np.mean(block, axis=0, dtype=np.float64))
+
+    def result(self):
+        return np.concatenate(self._values)
+
+
+class Dvars:
+    """ Accumulate dvars, keeping only the previous volume between blocks
+
+    Parameters
+    ----------
+    mask : array, optional
+        1D boolean array selecting voxels (rows of the blocks) to use.
+    """
+
+    def __init__(self, mask=None):
+        self.mask = mask
+        self._previous = None
+        self._values = []
+
+    def update(self, block):
+        if self.mask is not None:
+            block = block[self.mask]
+        if self._previous is not None:
+            block = np.column_stack([self._previous, block])
+        self._previous = block[:, -1].copy()
+        if block.shape[-1] > 1:
+            vol_diff = np.diff(block, axis=-1)
+            self._values.append(
+                np.sqrt(np.mean(vol_diff ** 2, axis=0, dtype=np.float64)))
+
+    def result(self):
+        if len(self._values) == 0:
+            return np.zeros(0)
+        return np.concatenate(self._values)
+
+
+class SpmGlobals:
+    """ Accumulate the SPM global metric for each volume
+    """
+
+    def __init__(self):
+        self._values = []
+
+    def update(self, block):
+        self._values.append(spm_globals_voxels(block))
+
+    def result(self):
+        return np.concatenate(self._values)
+
+
+class BrainVoxels:
+    """ Collect voxel time courses for voxels in `mask`
+
+    Parameters
+    ----------
+    mask : array
+        1D boolean array selecting voxels (rows of the blocks) to keep.
+    n_volumes : int
+        Number of volumes in the image.
+    dtype : dtype, optional
+        Data type for collected time courses.
+    empty : callable, optional
+        Called as ``empty(shape, dtype)`` to allocate the time courses, for
+        example :meth:`findoutlie.voxelpool.VoxelPool.empty`.
+    """
+
+    def __init__(self, mask, n_volumes, dtype=np.float64, empty=np.empty):
+        self.mask = mask
+        self._voxels = empty((np.count_nonzero(mask), n_volumes), dtype)
+        self._n = 0
+
+    def update(self, block):
+        n = block.shape[-1]
+        self._voxels[:, self._n:self._n + n] = block[self.mask]
+        self._n += n
+
+    def result(self):
+        return self._voxels
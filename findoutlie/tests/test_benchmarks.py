@@ -0,0 +1,61 @@
+""" Test synthetic images and benchmark runner
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie import outfind
+from findoutlie.benchmarks.synthetic import make_data, write_image
+from findoutlie.benchmarks.run_benchmarks import (run_benchmarks,
+                                                  compare_results,
+                                                  import_benchmarks,
+                                                  format_results)
+
+
+def test_make_data():
+    data, spikes = make_data((10, 12, 8), 30, n_spikes=2, seed=1)
+    assert data.shape == (10, 12, 8, 30)
+    assert data.dtype == np.int16
+    assert len(spikes) == 2
+    data2, spikes2 = make_data((10, 12, 8), 30, n_spikes=2, seed=1)
+    assert np.all(data == data2) and np.all(spikes == spikes2)
+    data, _ = make_data((4, 5, 6), 3, dtype=np.float32)
+    assert data.dtype == np.float32
+
+
+def test_write_image(tmp_path):
+    fname = tmp_path / "sub-01_bold.nii.gz"
+    spikes = write_image(fname, (16, 16, 10), 60, n_spikes=3, seed=2)
+    img = nib.load(fname)
+    assert img.shape == (16, 16, 10, 60)
+    assert img.get_data_dtype() == np.int16
+    # The voxel outlier detector finds the spikes.
+    outliers = outfind.detect_outliers_mad_median_absolute_deviation_mask(
+        fname)
+    assert set(spikes) <= set(outliers[0])
+
+
+def test_run_benchmarks():
+    results = run_benchmarks([((8, 8, 4), 20)], ('int16',), (True,),
+                             repeat=1, names=('metrics.dvars_voxel',
+                                              'outfind.file_outliers'))
+    assert results['meta']['numpy'] == np.__version__
+    assert [r['name'] for r in results['results']] == [
+        'metrics.dvars_voxel', 'outfind.file_outliers']
+    assert compare_results(results, results) == []
+    slower = {'results': [dict(r, time=r['time'] * 2 + 1)
+                          for r in results['results']]}
+    assert len(compare_results(results, slower)) == 2
+
+
+def test_import_benchmarks():
+    results = import_benchmarks(repeat=1)
+    assert [r['name'] for r in results] == ['import findoutlie.outfind']
+    assert results[0]['time'] > 0 and results[0]['peak_mb'] > 0
+    assert import_benchmarks(names=('metrics.dvars',)) == []
+    assert 'import findoutlie.outfind' in format_results({'results': results})
@@ -0,0 +1,129 @@
+""" Test memory estimates and block planning
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import tracemalloc
+
+import numpy as np
+
+import pytest
+
+from findoutlie import outfind
+from findoutlie.budget import (BASE_BYTES, run_info, estimate_peak,
+                               plan_blocks)
+from findoutlie.metrics import dvars_voxel
+from findoutlie.voxelpool import (VoxelPool, TASKS_PER_JOB, _counts_task,
+                                  _sum_sq_task)
+from findoutlie.benchmarks.synthetic import write_image
+
+
+def test_dvars_blocks():
+    rng = np.random.default_rng(0)
+    voxels = rng.normal(size=(1000, 20))
+    expected = dvars_voxel(voxels)
+    for block_size in (1, 7, 999, 5000):
+        assert np.allclose(dvars_voxel(voxels, block_size), expected)
+
+
+def test_estimate_peak():
+    kwargs = dict(n_voxels=10000, n_volumes=100, disk_itemsize=2)
+    peak = estimate_peak(**kwargs)
+    assert peak > BASE_BYTES + 10000 * 100 * 8
+    assert estimate_peak(dtype=np.float32, **kwargs) < peak
+    assert estimate_peak(voxel_block=100, **kwargs) < peak
+    assert estimate_peak(volume_block=50, **kwargs) > estimate_peak(
+        volume_block=1, voxel_block=1, **kwargs)
+    assert estimate_peak(n_brain=2000, **kwargs) < peak
+
+
+def test_plan_blocks(tmp_path):
+    fname = tmp_path / "sub-01" / "sub-01_bold.nii.gz"
+    fname.parent.mkdir()
+    write_image(fname, (32, 32, 16), 60)
+    info = run_info(fname)
+    assert info == {'n_voxels': 32 * 32 * 16, 'n_volumes': 60,
+                    'disk_itemsize': 2, 'n_brain': None, 'streamed': True}
+    minimum = estimate_peak(volume_block=1, voxel_block=1, **info)
+    with pytest.raises(MemoryError):
+        plan_blocks(info, minimum - 1)
+    volume_block, voxel_block = plan_blocks(info, minimum)
+    assert estimate_peak(volume_block=volume_block, voxel_block=voxel_block,
+                         **info) == minimum
+    volume_block, voxel_block = plan_blocks(info, minimum + 2 ** 20)
+    assert estimate_peak(volume_block=volume_block, voxel_block=voxel_block,
+                         **info) <= minimum + 2 ** 20
+    assert voxel_block > 1
+    # Allocations with the planned blocks stay within the estimate.
+    budget = minimum + 2 ** 20
+    tracemalloc.start()
+    try:
+        outliers = outfind.file_outliers(fname, max_memory=budget)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < budget - BASE_BYTES
+    assert np.array_equal(outliers, outfind.file_outliers(fname))
+    # Stores know their number of brain voxels.
+    store_dir = outfind.convert_to_store(fname, tmp_path / 'run.tstore')
+    store_info = run_info(store_dir)
+    assert 0 < store_info['n_brain'] < info['n_voxels']
+    # Fail before processing.
+    with pytest.raises(MemoryError):
+        outfind.find_outliers(tmp_path, max_memory=minimum - 1)
+    with pytest.raises(MemoryError):
+        outfind.find_outliers(tmp_path, jobs=2, max_memory=minimum)
+    estimates = outfind.memory_estimates(tmp_path)
+    assert estimates[fname] == (estimate_peak(**info), minimum)
+
+
+def _traced_peak(func, *args, **kwargs):
+    # Return result of `func`, and peak traced allocations while calling.
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def test_voxel_jobs_budget(tmp_path):
+    fname = tmp_path / "sub-01" / "sub-01_bold.nii.gz"
+    fname.parent.mkdir()
+    write_image(fname, (32, 32, 16), 60)
+    info = run_info(fname)
+    # Each voxel worker has its own interpreter and temporary arrays.
+    assert estimate_peak(voxel_jobs=2, **info) > estimate_peak(**info)
+    assert (estimate_peak(voxel_jobs=4, voxel_block=100, **info) -
+            estimate_peak(voxel_jobs=2, voxel_block=100, **info) >=
+            2 * BASE_BYTES)
+    minimum = estimate_peak(volume_block=1, voxel_block=1, voxel_jobs=2,
+                            **info)
+    with pytest.raises(MemoryError):
+        plan_blocks(info, minimum - 1, voxel_jobs=2)
+    budget = minimum + 2 ** 20
+    with pytest.raises(MemoryError):
+        outfind.find_outliers(tmp_path, max_memory=budget, voxel_jobs=4)
+    volume_block, voxel_block = plan_blocks(info, budget, voxel_jobs=2)
+    assert voxel_block < plan_blocks(info, budget)[1]
+    # Allocations in this process, and in each worker, with the planned
+    # blocks, stay within the estimate.  Run the worker tasks here, on the
+    # rows each worker gets, to trace them.
+    outliers, peak = _traced_peak(outfind.file_outliers, fname,
+                                  max_memory=budget, voxel_jobs=2)
+    assert np.array_equal(outliers, outfind.file_outliers(fname))
+    run = outfind.load_run(fname, volume_block)
+    n_brain = len(run.brain_voxels)
+    task_rows = -(-n_brain // (2 * TASKS_PER_JOB))
+    with VoxelPool(2, shared_dir=tmp_path) as pool:
+        handle = pool.share(run.brain_voxels)
+        _, counts_peak = _traced_peak(
+            _counts_task, handle, 0, max(task_rows, voxel_block), 3.5,
+            voxel_block)
+        _, dvars_peak = _traced_peak(_sum_sq_task, handle, 0, task_rows,
+                                     voxel_block)
+    workers_peak = 2 * max(counts_peak, dvars_peak)
+    assert peak + workers_peak < budget - 3 * BASE_BYTES
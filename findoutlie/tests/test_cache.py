@@ -0,0 +1,206 @@
+""" Test metrics cache
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+import hashlib
+import inspect
+import os
+
+import numpy as np
+
+import pytest
+
+from findoutlie import cache as fo_cache
+from findoutlie.cache import (parse_size, file_hash, read_hash_lists,
+                              MetricsCache)
+from findoutlie import outfind
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_parse_size():
+    assert parse_size(100) == 100
+    assert parse_size("100") == 100
+    assert parse_size("2k") == 2048
+    assert parse_size("1.5M") == 3 * 2 ** 19
+    assert parse_size("1GB") == 2 ** 30
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_file_hash():
+    expected = hashlib.sha1(EXAMPLE_FILENAME.read_bytes()).hexdigest()
+    assert file_hash(EXAMPLE_FILENAME) == expected
+    assert file_hash(EXAMPLE_FILENAME, chunk_size=1000) == expected
+
+
+def test_read_hash_lists(tmp_path):
+    group = tmp_path / "group-01"
+    group.mkdir()
+    (group / "hash_list.txt").write_text(
+        "abc group-01/sub-01/a.nii.gz\n\ndef group-01/sub-02/b.nii.gz\n")
+    assert read_hash_lists(tmp_path) == {
+        (group / "sub-01" / "a.nii.gz").resolve(): "abc",
+        (group / "sub-02" / "b.nii.gz").resolve(): "def"}
+
+
+def test_metrics_cache(tmp_path):
+    cache = MetricsCache(tmp_path / "cache")
+    key = cache.key("abc", {"dtype": "float64"})
+    assert key != cache.key("abd", {"dtype": "float64"})
+    assert key != cache.key("abc", {"dtype": "float32"})
+    assert cache.get(key) is None
+    metrics = {"dvars": np.arange(10.), "mask": np.ones(5, dtype=bool)}
+    cache.put(key, metrics)
+    cached = cache.get(key)
+    assert set(cached) == set(metrics)
+    for name in metrics:
+        assert np.array_equal(cached[name], metrics[name])
+    assert MetricsCache(tmp_path / "cache", refresh=True).get(key) is None
+
+
+def test_metrics_format(tmp_path, monkeypatch):
+    # Changing the calculations, and so the format, gives new keys.
+    cache = MetricsCache(tmp_path)
+    key = cache.key("abc", {})
+    monkeypatch.setattr(fo_cache, "METRICS_FORMAT",
+                        fo_cache.METRICS_FORMAT + 1)
+    assert cache.key("abc", {}) != key
+
+
+def test_cache_concurrent_delete(tmp_path, monkeypatch):
+    # Entries deleted by other processes are misses, not errors.
+    cache = MetricsCache(tmp_path)
+    key = cache.key("abc", {})
+    metrics = {"dvars": np.arange(10.)}
+    cache.put(key, metrics)
+
+    def deleted(*args, **kwargs):
+        raise FileNotFoundError
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "utime", deleted)
+        assert np.array_equal(cache.get(key)["dvars"], metrics["dvars"])
+    with monkeypatch.context() as m:
+        m.setattr(np, "load", deleted)
+        assert cache.get(key) is None
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", deleted)
+        cache.put(cache.key("abd", {}), metrics)
+    assert [p.stem for p in tmp_path.glob("*.npz")] == [key]
+    with monkeypatch.context() as m:
+        m.setattr(Path, "unlink", deleted)
+        cache.max_bytes = 0
+        cache.evict()
+
+
+def test_cache_failed_put(tmp_path, monkeypatch):
+    # Failed writes leave no temporary files.
+    cache = MetricsCache(tmp_path)
+
+    def failing_save(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(np, "savez_compressed", failing_save)
+    with pytest.raises(KeyboardInterrupt):
+        cache.put(cache.key("abc", {}), {"dvars": np.arange(10.)})
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cache_eviction(tmp_path):
+    metrics = {"values": np.random.default_rng(0).normal(size=1000)}
+    cache = MetricsCache(tmp_path, max_bytes=10 ** 9)
+    keys = [cache.key(str(i), {}) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, metrics)
+        # Set use times explicitly, older first.
+        os.utime(tmp_path / f"{key}.npz", (i, i))
+    entry_size = (tmp_path / f"{keys[0]}.npz").stat().st_size
+    # Use the first entry; it becomes the most recently used.
+    cache.get(keys[0])
+    # A new cache with a lower maximum size evicts at once.
+    MetricsCache(tmp_path, max_bytes=2 * entry_size)
+    assert sorted(p.stem for p in tmp_path.glob("*.npz")) == sorted(
+        [keys[0], keys[2]])
+
+
+def test_file_metrics_cache(tmp_path):
+    cache = MetricsCache(tmp_path)
+    metrics = outfind.file_metrics(EXAMPLE_FILENAME, cache=cache)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+    cached = outfind.file_metrics(EXAMPLE_FILENAME, cache=cache)
+    for name in metrics:
+        assert np.array_equal(metrics[name], cached[name])
+    assert np.array_equal(
+        outfind.file_outliers(EXAMPLE_FILENAME, cache=cache),
+        outfind.file_outliers(EXAMPLE_FILENAME))
+    # Different dtype gives a new entry.
+    outfind.file_metrics(EXAMPLE_FILENAME, np.float32, cache=cache)
+    assert len(list(tmp_path.glob("*.npz"))) == 2
+
+
+def test_given_hash_cache(tmp_path):
+    # A given hash, as from a hash list, may be stale; an edited file gets a
+    # new entry even if the hash list was not updated.
+    fname = tmp_path / "bold.nii"
+    fname.write_bytes(EXAMPLE_FILENAME.read_bytes())
+    content_hash = file_hash(fname)
+    cache = MetricsCache(tmp_path / "cache")
+    outfind.file_metrics(fname, cache=cache, content_hash=content_hash)
+    outfind.file_metrics(fname, cache=cache, content_hash=content_hash)
+    assert len(list(cache.cache_dir.glob("*.npz"))) == 1
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    outfind.file_metrics(fname, cache=cache, content_hash=content_hash)
+    assert len(list(cache.cache_dir.glob("*.npz"))) == 2
+
+
+def test_spm_rule_cache(tmp_path, monkeypatch):
+    # A rule using SPM globals loads the run once on a miss, and not at all
+    # on a hit.
+    loads = []
+    load_run = outfind.load_run
+
+    def counting_load(*args, **kwargs):
+        bound = inspect.signature(load_run).bind(*args, **kwargs)
+        loads.append(bound.arguments.get("spm_globals", False))
+        return load_run(*args, **kwargs)
+
+    monkeypatch.setattr(outfind, "load_run", counting_load)
+    cache = MetricsCache(tmp_path)
+    rule = "spm_global | dvars"
+    outliers = outfind.file_outliers(EXAMPLE_FILENAME, cache=cache,
+                                     rule=rule)
+    assert loads == [True]
+    assert np.array_equal(
+        outfind.file_outliers(EXAMPLE_FILENAME, cache=cache, rule=rule),
+        outliers)
+    assert loads == [True]
+    assert np.array_equal(outfind.file_outliers(EXAMPLE_FILENAME, rule=rule),
+                          outliers)
+    # Metrics without SPM globals have their own entry.
+    metrics = outfind.file_metrics(EXAMPLE_FILENAME, cache=cache)
+    assert "spm_globals" not in metrics
+    assert len(list(tmp_path.glob("*.npz"))) == 2
+
+
+def test_given_hash_cache(tmp_path):
+    # A given hash, as from a hash list, may be stale; an edited file gets a
+    # new entry even if the hash list was not updated.
+    fname = tmp_path / "bold.nii"
+    fname.write_bytes(EXAMPLE_FILENAME.read_bytes())
+    content_hash = file_hash(fname)
+    cache = MetricsCache(tmp_path / "cache")
+    outfind.file_metrics(fname, cache=cache, content_hash=content_hash)
+    outfind.file_metrics(fname, cache=cache, content_hash=content_hash)
+    assert len(list(cache.cache_dir.glob("*.npz"))) == 1
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    outfind.file_metrics(fname, cache=cache, content_hash=content_hash)
+    assert len(list(cache.cache_dir.glob("*.npz"))) == 2
@@ -27,7 +27,10 @@ import numpy as np
 
 # This import needs the directory containing the findoutlie directory
 # on the Python path.
-from detectors import iqr_detector
+from detectors import (iqr_detector, mad_voxel_detector, mad_voxel_counts,
+                       median_last, mad_time_detector, sliding_window_detector,
+                       mad_voxel_count_sweep, mad_time_sweep,
+                       sliding_window_sweep, iqr_sweep, voxel_subset)
 
 
 def test_iqr_detector():
@@ -59,7 +62,103 @@ def test_iqr_detector():
     assert np.all(example_values[is_outlier] == [10.2, 14.1, 15.1, 15.9, 16.4])
 
 
+def test_median_last():
+    rng = np.random.default_rng(42)
+    for n in (1, 2, 9, 10):
+        values = rng.normal(size=(20, n))
+        assert np.array_equal(median_last(values), np.median(values, axis=-1))
+
+
+def test_mad_voxel_counts():
+    rng = np.random.default_rng(42)
+    img = rng.normal(100, 10, size=(1000, 51))
+    img[rng.integers(0, 1000, 200), rng.integers(0, 51, 200)] += 80
+    expected = np.sum(mad_voxel_detector(img), axis=0)
+    for block_size in (1, 7, 1000, 5000):
+        assert np.array_equal(mad_voxel_counts(img, block_size=block_size),
+                              expected)
+    assert np.array_equal(mad_voxel_counts(img, 2, 100),
+                          np.sum(mad_voxel_detector(img, 2), axis=0))
+    # Even number of time points, and NaN values.
+    img = img[:, :50].copy()
+    img[3, 4] = np.nan
+    assert np.array_equal(mad_voxel_counts(img, block_size=64),
+                          np.sum(mad_voxel_detector(img), axis=0))
+
+
+def test_sliding_window_detector():
+    rng = np.random.default_rng(42)
+    for n in (5, 19, 20, 21, 30, 31, 97):
+        measures = rng.normal(size=n)
+        measures[rng.integers(0, n, 3)] += 10
+        for window_length, step in ((20, 10), (10, 3), (7, 7), (5, 8)):
+            # Windows calculated one at a time.
+            expected = np.zeros(n, dtype=bool)
+            for i in range(0, n, step):
+                window = measures[i:i + window_length]
+                expected[i:i + window_length] |= mad_time_detector(
+                    window, lower_bound=True)
+                if i + window_length >= n:
+                    break
+            assert np.array_equal(
+                sliding_window_detector(measures, window_length, step),
+                expected)
+
+
+def test_sweeps():
+    rng = np.random.default_rng(42)
+    thresholds = [0, 1, 2.5, 3.5, 6]
+    img = rng.normal(100, 10, size=(1000, 30))
+    img[rng.integers(0, 1000, 200), rng.integers(0, 30, 200)] += 80
+    img[5] = 100  # Zero MAD.
+    img[7, 3] = np.nan
+    counts = mad_voxel_count_sweep(img, thresholds, block_size=300)
+    assert counts.shape == (5, 30)
+    for threshold, row in zip(thresholds, counts):
+        assert np.array_equal(row, mad_voxel_counts(img, threshold))
+    measures = rng.normal(size=47)
+    measures[[3, 30]] += 10
+    for lower_bound in (True, False):
+        sweep = mad_time_sweep(measures, lower_bound, thresholds)
+        for threshold, row in zip(thresholds, sweep):
+            assert np.array_equal(
+                row, mad_time_detector(measures, lower_bound, threshold))
+    for window_length, step in ((20, 10), (10, 3), (50, 5)):
+        sweep = sliding_window_sweep(measures, thresholds, window_length,
+                                     step)
+        for threshold, row in zip(thresholds, sweep):
+            assert np.array_equal(row, sliding_window_detector(
+                measures, window_length, step, threshold))
+    proportions = [0.5, 1.5, 2, 3]
+    for proportion, row in zip(proportions, iqr_sweep(measures, proportions)):
+        assert np.array_equal(row, iqr_detector(measures, proportion))
+
+
+def test_voxel_subset():
+    subset = voxel_subset(1000, 0.1, seed=1)
+    assert len(subset) == 100
+    assert np.all(np.diff(subset) > 0) and subset[-1] < 1000
+    assert np.array_equal(subset, voxel_subset(1000, 0.1, seed=1))
+    assert not np.array_equal(subset, voxel_subset(1000, 0.1, seed=2))
+    assert len(voxel_subset(1000, 250)) == 250
+    assert np.array_equal(voxel_subset(10, 20), np.arange(10))
+    assert np.array_equal(voxel_subset(10, 1.), np.arange(10))
+    assert len(voxel_subset(10, 0.001)) == 1
+    for bad in (0, 0., 1.5, -1):
+        try:
+            voxel_subset(10, bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Expected ValueError')
+
+
 if __name__ == "__main__":
     # File being executed as a script
     test_iqr_detector()
+    test_median_last()
+    test_mad_voxel_counts()
+    test_sliding_window_detector()
+    test_sweeps()
+    test_voxel_subset()
     print("Tests passed")
@@ -0,0 +1,98 @@
+""" Test detector ensembles
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+import nibabel as nib
+
+import pytest
+
+from findoutlie import outfind
+from findoutlie.ensemble import Ensemble, Detector, DEFAULT_RULE
+from findoutlie.detectors import (iqr_detector, mad_time_detector,
+                                  sliding_window_detector, mad_voxel_counts)
+from findoutlie.metrics import dvars_voxel
+from findoutlie.spm_funcs import get_spm_globals
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_rules():
+    data = nib.load(EXAMPLE_FILENAME).get_fdata()
+    run = outfind.RunData(np.reshape(data, (-1, data.shape[-1])))
+    brain = run.brain_voxels
+    counts = mad_voxel_counts(brain)
+    dvs = dvars_voxel(brain)
+    mad = np.nonzero(mad_time_detector(counts, False))[0]
+    dvars = np.nonzero(mad_time_detector(dvs, True))[0]
+    sliding = np.nonzero(sliding_window_detector(np.mean(brain, axis=0),
+                                                 10, 5))[0]
+    iqr = np.nonzero(iqr_detector(dvs, 2))[0]
+    spm = np.nonzero(mad_time_detector(run.spm_globals, True))[0]
+    for rule, expected in (
+            (DEFAULT_RULE,
+             np.intersect1d(sliding, np.union1d(mad, dvars))),
+            ('dvars', dvars),
+            ('mad_voxel | iqr_dvars | spm_global',
+             np.union1d(np.union1d(mad, iqr), spm)),
+            ('vote(2, mad_voxel, dvars, iqr_dvars)',
+             [i for i in range(data.shape[-1])
+              if (i in mad) + (i in dvars) + (i in iqr) >= 2])):
+        ensemble = Ensemble(rule, window_length=10, window_step=5)
+        outliers = ensemble.outliers(ensemble.intermediates({'run': run}))
+        assert np.array_equal(outliers, expected)
+    for rule in ('dvars +', 'dvars + mad_voxel', 'vote(dvars, mad_voxel)',
+                 'unknown | dvars', 'dvars()'):
+        with pytest.raises(ValueError):
+            Ensemble(rule)
+
+
+def test_shared_intermediates():
+    data = nib.load(EXAMPLE_FILENAME).get_fdata()
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    loads = []
+
+    def load(spm_globals):
+        loads.append(spm_globals)
+        return outfind.load_run(EXAMPLE_FILENAME, spm_globals=spm_globals)
+
+    calls = []
+
+    def counting(values):
+        calls.append(1)
+        return iqr_detector(values)
+
+    ensemble = Ensemble('iqr_dvars | spm_global | counted',
+                        detectors={'counted': Detector(('dvars',), counting)})
+    assert ensemble.needs == {'dvars', 'brain_voxels', 'run', 'spm_globals'}
+    intermediates = ensemble.intermediates(load=load)
+    ensemble.outliers(intermediates)
+    # One load, collecting SPM globals in the same pass.
+    assert loads == [True] and len(calls) == 1
+    dvars = intermediates['dvars']
+    assert intermediates['dvars'] is dvars
+    assert np.allclose(dvars, dvars_voxel(outfind.segment_brain(voxels)))
+    assert np.allclose(intermediates['spm_globals'],
+                       get_spm_globals(EXAMPLE_FILENAME))
+    # Values given up front are not recalculated, or loaded.
+    intermediates = ensemble.intermediates(
+        {'dvars': dvars, 'spm_globals': np.ones(data.shape[-1])})
+    assert np.array_equal(ensemble.outliers(intermediates),
+                          np.nonzero(iqr_detector(dvars))[0])
+
+
+def test_file_outliers_rule(tmp_path):
+    outliers = outfind.file_outliers(EXAMPLE_FILENAME, rule='dvars')
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    assert np.array_equal(outliers, outfind.dvars_outliers(run)[0])
+    store_dir = outfind.convert_to_store(EXAMPLE_FILENAME,
+                                         tmp_path / 'run.tstore')
+    with pytest.raises(ValueError):
+        outfind.file_outliers(store_dir, rule='spm_global')
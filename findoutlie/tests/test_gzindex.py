@@ -0,0 +1,68 @@
+""" Test random access to compressed images with seek-point indices
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+import nibabel as nib
+
+import pytest
+
+from findoutlie import gzindex
+from findoutlie.streaming import stream_image, Dvars
+from findoutlie.metrics import dvars_voxel
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+@pytest.fixture
+def gz_fname(tmp_path):
+    fname = tmp_path / "sub-01_bold.nii.gz"
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    return fname
+
+
+def test_load_indexed(tmp_path, gz_fname):
+    pytest.importorskip('indexed_gzip')
+    index_dir = tmp_path / "indices"
+    data = nib.load(EXAMPLE_FILENAME).get_fdata()
+    # Without build, there is no index, but we still get the image.
+    img = gzindex.load_indexed(gz_fname, index_dir, build=False)
+    assert not index_dir.exists()
+    assert np.all(img.get_fdata() == data)
+    gzindex.close_image(img)
+    img = gzindex.load_indexed(gz_fname, index_dir)
+    assert gzindex.index_path(gz_fname, index_dir).is_file()
+    for k in (7, 2, 9, 0):
+        assert np.all(img.dataobj[..., k] == data[..., k])
+    # Streaming works on the indexed image.
+    dvars_acc, = stream_image(img, [Dvars()], 3)
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    assert np.allclose(dvars_acc.result(), dvars_voxel(voxels))
+    vol = gzindex.read_volume(gz_fname, 4, index_dir, dtype=np.float32)
+    assert vol.dtype == np.float32
+    assert np.all(vol == data[..., 4])
+    # The image owns its open file until closed.
+    fobj = img.file_map['image'].fileobj
+    assert not fobj.closed
+    gzindex.close_image(img)
+    assert fobj.closed
+
+
+def test_uncompressed(tmp_path):
+    img = gzindex.load_indexed(EXAMPLE_FILENAME, tmp_path)
+    assert list(tmp_path.iterdir()) == []
+    assert np.all(img.dataobj[..., 3] ==
+                  nib.load(EXAMPLE_FILENAME).dataobj[..., 3])
+    fobj = img.file_map['image'].fileobj
+    gzindex.close_image(img)
+    assert fobj.closed
+    assert np.all(gzindex.read_volume(EXAMPLE_FILENAME, 3, tmp_path) ==
+                  nib.load(EXAMPLE_FILENAME).get_fdata()[..., 3])
@@ -0,0 +1,114 @@
+""" Test cache of decompressed images
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+import gzip
+import os
+import shutil
+
+import numpy as np
+
+import nibabel as nib
+
+import pytest
+
+from findoutlie.imcache import ImageCache, uncompressed_size
+from findoutlie.streaming import close_image
+from findoutlie import outfind
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_image_cache(tmp_path):
+    gz_fname = tmp_path / "sub-01_bold.nii.gz"
+    nib.save(nib.load(EXAMPLE_FILENAME), gz_fname)
+    cache_dir = tmp_path / "cache"
+    cache = ImageCache(cache_dir)
+    img = cache.load(gz_fname)
+    assert isinstance(img.dataobj.get_unscaled(), np.memmap)
+    assert np.all(img.get_fdata() == nib.load(EXAMPLE_FILENAME).get_fdata())
+    close_image(img)
+    cached = list(cache_dir.glob("*.nii"))
+    assert len(cached) == 1
+    # Loading again uses the same file.
+    assert cache.cached_path(gz_fname) == cached[0]
+    # A changed image gets a new entry.
+    os.utime(gz_fname, ns=(0, 0))
+    close_image(cache.load(gz_fname))
+    assert len(list(cache_dir.glob("*.nii"))) == 2
+    # Uncompressed images are not copied.
+    cache.load(EXAMPLE_FILENAME)
+    assert len(list(cache_dir.glob("*.nii"))) == 2
+    # Eviction when over the maximum size; most recently used image stays.
+    os.utime(cached[0], (0, 0))
+    ImageCache(cache_dir, cached[0].stat().st_size)
+    assert list(cache_dir.glob("*.nii")) == [cache.cached_path(gz_fname)]
+
+
+def test_image_cache_files(tmp_path, monkeypatch):
+    gz_fname = tmp_path / "sub-01_bold.nii.gz"
+    nib.save(nib.load(EXAMPLE_FILENAME), gz_fname)
+    cache_dir = tmp_path / "cache"
+    cache = ImageCache(cache_dir)
+    # Loading a run closes the cached image file after reading.
+    images = []
+    load_image = outfind.load_image
+
+    def recording_load(*args, **kwargs):
+        images.append(load_image(*args, **kwargs))
+        return images[-1]
+
+    monkeypatch.setattr(outfind, "load_image", recording_load)
+    outfind.load_run(gz_fname, image_cache=cache)
+    assert images[0].file_map["image"].fileobj.closed
+    # Failed decompression leaves no temporary file.
+    os.utime(gz_fname, ns=(0, 0))
+
+    def failing_copy(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(shutil, "copyfileobj", failing_copy)
+    with pytest.raises(KeyboardInterrupt):
+        cache.cached_path(gz_fname)
+    assert [p.suffix for p in cache_dir.iterdir()] == [".nii"]
+
+
+def test_image_cache_outliers(tmp_path):
+    gz_fname = tmp_path / "sub-01_bold.nii.gz"
+    nib.save(nib.load(EXAMPLE_FILENAME), gz_fname)
+    cache = ImageCache(tmp_path / "cache")
+    assert np.array_equal(
+        outfind.file_outliers(gz_fname, image_cache=cache),
+        outfind.file_outliers(gz_fname))
+
+
+def test_image_cache_size(tmp_path):
+    gz_fnames = [tmp_path / f"sub-0{i}_bold.nii.gz" for i in (1, 2)]
+    for gz_fname in gz_fnames:
+        nib.save(nib.load(EXAMPLE_FILENAME), gz_fname)
+    n_bytes = len(gzip.decompress(gz_fnames[0].read_bytes()))
+    assert uncompressed_size(gz_fnames[0]) == n_bytes
+    cache_dir = tmp_path / "cache"
+    # An image larger than the cache is read without caching.
+    cache = ImageCache(cache_dir, '1K')
+    assert cache.cached_path(gz_fnames[0]) is None
+    run = outfind.load_run(gz_fnames[0], image_cache=cache)
+    assert np.array_equal(run.brain_voxels,
+                          outfind.load_run(EXAMPLE_FILENAME).brain_voxels)
+    assert list(cache_dir.glob("*.nii")) == []
+    # A new image evicts older images, never itself.
+    cache = ImageCache(cache_dir, n_bytes)
+    first = cache.cached_path(gz_fnames[0])
+    img = cache.load(gz_fnames[0])
+    second = cache.cached_path(gz_fnames[1])
+    assert list(cache_dir.glob("*.nii")) == [second]
+    # The evicted image is still readable where it is already open.
+    assert not first.exists()
+    assert np.all(img.get_fdata() == nib.load(EXAMPLE_FILENAME).get_fdata())
+    close_image(img)
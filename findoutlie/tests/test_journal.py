@@ -0,0 +1,79 @@
+""" Test journal of finished runs
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import os
+
+import numpy as np
+
+from findoutlie import outfind
+from findoutlie.journal import Journal
+from findoutlie.benchmarks.synthetic import write_image
+
+
+def test_journal(tmp_path):
+    fname = tmp_path / "sub-01_bold.nii.gz"
+    write_image(fname, (8, 8, 4), 20)
+    journal = Journal(tmp_path / "runs" / "journal.jsonl")
+    params = {'rule': 'dvars', 'downsample': (2, 2, 2)}
+    assert journal.entries() == []
+    assert journal.completed(params) == {}
+    journal.record(fname, params, np.array([3, 7]), 1.5, 'abc')
+    entry, = journal.entries()
+    assert entry['file'] == str(fname.resolve())
+    assert entry['hash'] == 'abc'
+    assert entry['seconds'] == 1.5
+    done = journal.completed(params)
+    assert list(done) == [fname.resolve()]
+    assert list(done[fname.resolve()]) == [3, 7]
+    assert journal.completed(dict(params, rule='mad_voxel')) == {}
+    # A partial line from a crash is ignored, and does not spoil the next.
+    with open(journal.path, 'at') as fobj:
+        fobj.write('{"file": "/some/where", "outl')
+    journal.record(fname, params, [4])
+    assert len(journal.entries()) == 2
+    assert list(journal.completed(params)[fname.resolve()]) == [4]
+    # A changed image is no longer completed.
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert journal.completed(params) == {}
+
+
+def test_resume(tmp_path):
+    data_dir = tmp_path / "data"
+    for i, seed in enumerate((0, 1)):
+        fname = data_dir / f"sub-0{i}" / f"sub-0{i}_bold.nii.gz"
+        fname.parent.mkdir(parents=True)
+        write_image(fname, (16, 16, 8), 40, seed=seed)
+    journal = Journal(tmp_path / "journal.jsonl")
+    expected = outfind.find_outliers(data_dir)
+    for jobs in (1, 2):
+        journal.path.unlink(missing_ok=True)
+        outliers = outfind.find_outliers(data_dir, jobs=jobs,
+                                         journal=journal)
+        assert len(journal.entries()) == 2
+        for fname in expected:
+            assert np.array_equal(outliers[fname], expected[fname])
+        # Resuming processes nothing, and gives the same outliers.
+        outliers = outfind.find_outliers(data_dir, jobs=jobs,
+                                         journal=journal, resume=True)
+        assert len(journal.entries()) == 2
+        for fname in expected:
+            assert np.array_equal(outliers[fname], expected[fname])
+    # Without resume, or with other settings, images are processed again.
+    outfind.find_outliers(data_dir, journal=journal)
+    assert len(journal.entries()) == 4
+    outfind.find_outliers(data_dir, window_length=10, journal=journal,
+                          resume=True)
+    assert len(journal.entries()) == 6
+    # Only a changed image is processed again.
+    fname = sorted(expected)[0]
+    stat = fname.stat()
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    outfind.find_outliers(data_dir, journal=journal, resume=True)
+    entries = journal.entries()
+    assert len(entries) == 7
+    assert entries[-1]['file'] == str(fname.resolve())
@@ -0,0 +1,33 @@
+""" Test lazy module imports
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import subprocess
+import sys
+
+import numpy as np
+
+import pytest
+
+from findoutlie.lazy import lazy_import
+
+
+def test_lazy_import():
+    # Already imported modules come back as they are.
+    assert lazy_import('numpy') is np
+    with pytest.raises(ImportError):
+        lazy_import('findoutlie_no_such_module')
+
+
+def test_fast_imports():
+    # Importing outfind should not import the heavy modules.
+    code = ('import sys, findoutlie.outfind; '
+            'print(" ".join(sorted(sys.modules)))')
+    modules = subprocess.run([sys.executable, '-c', code], check=True,
+                             capture_output=True, text=True).stdout.split()
+    for name in ('skimage', 'scipy', 'nibabel.nifti1',
+                 'concurrent.futures.process'):
+        assert name not in modules
@@ -0,0 +1,64 @@
+""" Test online outlier detection
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import numpy as np
+
+import pytest
+
+from findoutlie import outfind
+from findoutlie.metrics import dvars_voxel
+from findoutlie.online import OnlineDetector, replay
+from findoutlie.benchmarks.synthetic import make_data, write_image
+
+
+def test_replay(tmp_path):
+    fname = tmp_path / "sub-01_bold.nii.gz"
+    spikes = write_image(fname, (20, 20, 10), 80, n_spikes=4, seed=3)
+    decisions = list(replay(fname, history=30))
+    assert [d['index'] for d in decisions] == list(range(80))
+    voxel_outliers = [d['index'] for d in decisions if d['voxel_outlier']]
+    assert voxel_outliers == list(spikes)
+    # Dvars picks up the change into and out of each spike.
+    dvars_outliers = [d['index'] for d in decisions if d['dvars_outlier']]
+    assert dvars_outliers == sorted(set(spikes) | set(spikes + 1))
+    outliers = [d['index'] for d in decisions if d['outlier']]
+    assert outliers == sorted(set(voxel_outliers) | set(dvars_outliers))
+
+
+def test_online_detector():
+    data, _ = make_data((12, 12, 6), 30, n_spikes=0, seed=1)
+    data = data.astype(float)
+    detector = OnlineDetector(warmup=5, history=10)
+    decisions = []
+    for i in range(data.shape[-1]):
+        new = detector.add_volume(data[..., i])
+        assert len(new) == (0 if i < 4 else 5 if i == 4 else 1)
+        decisions += new
+    assert detector.finish() == []
+    # Mask frozen from the warm-up volumes.
+    assert np.all(detector.mask ==
+                  outfind.mask_from_mean(np.mean(data[..., :5], axis=-1)))
+    brain = data[detector.mask]
+    assert np.isnan(decisions[0]['dvars'])
+    assert np.allclose([d['dvars'] for d in decisions[1:]],
+                       dvars_voxel(brain))
+    assert np.allclose([d['mean'] for d in decisions],
+                       np.mean(brain, axis=0))
+    # Bounded history.
+    assert len(detector._counts) == len(detector._dvars) == 10
+    with pytest.raises(ValueError):
+        detector.add_volume(data[..., 0, 0])
+
+
+def test_short_run():
+    data, _ = make_data((8, 8, 4), 6, n_spikes=0)
+    detector = OnlineDetector(warmup=10)
+    for i in range(data.shape[-1]):
+        assert detector.add_volume(data[..., i]) == []
+    decisions = detector.finish()
+    assert [d['index'] for d in decisions] == list(range(6))
+    assert detector.mask is not None
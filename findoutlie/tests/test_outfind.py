@@ -0,0 +1,187 @@
+""" Test outlier finding routines
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+import nibabel as nib
+
+import pytest
+
+from findoutlie import outfind
+from findoutlie.cache import MetricsCache
+from findoutlie.benchmarks.synthetic import write_image
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_load_run():
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    data = nib.load(EXAMPLE_FILENAME).get_fdata()
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    assert run.voxels is None
+    assert run.n_volumes == data.shape[-1]
+    assert np.all(run.mask == outfind.brain_mask(voxels))
+    assert np.all(run.brain_voxels == outfind.segment_brain(voxels))
+    # Reading in blocks gives the same result.
+    run_blocks = outfind.load_run(EXAMPLE_FILENAME, block_size=3)
+    assert np.all(run_blocks.brain_voxels == run.brain_voxels)
+    # Runs from in-memory arrays.
+    run = outfind.RunData(voxels)
+    assert np.all(run.brain_voxels == run_blocks.brain_voxels)
+
+
+def test_run_detectors():
+    # Per-file wrappers give the same answers as detectors on a loaded run.
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    for by_run, by_file in (
+        (outfind.mad_voxel_outliers,
+         outfind.detect_outliers_mad_median_absolute_deviation_mask),
+        (outfind.dvars_outliers, outfind.detect_outliers_mad_dvars_mask),
+        (outfind.sliding_window_outliers,
+         outfind.detect_outliers_mad_sliding_window_mask),
+    ):
+        assert np.array_equal(np.ravel(by_run(run)),
+                              np.ravel(by_file(EXAMPLE_FILENAME)))
+
+
+def test_threshold_otsu():
+    filters = pytest.importorskip('skimage.filters')
+    data = nib.load(EXAMPLE_FILENAME).get_fdata()
+    rng = np.random.default_rng(42)
+    for image in (np.mean(data, axis=-1), data[..., 0],
+                  rng.normal(size=(20, 30)), rng.gamma(2, size=1000),
+                  rng.normal(size=100).astype(np.float32)):
+        assert (outfind.threshold_otsu(image) ==
+                filters.threshold_otsu(image))
+    assert outfind.threshold_otsu(np.ones((3, 4)) * 2) == 2
+    assert outfind.threshold_otsu(np.arange(10.), nbins=8) == (
+        filters.threshold_otsu(np.arange(10.), nbins=8))
+
+
+def test_find_outliers(tmp_path):
+    fname = tmp_path / "sub-01" / "func" / "sub-01_task-test_run-01_bold.nii.gz"
+    fname.parent.mkdir(parents=True)
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    outlier_dict = outfind.find_outliers(tmp_path)
+    assert list(outlier_dict) == [fname]
+    assert np.array_equal(outlier_dict[fname], [4])
+
+
+def test_find_outliers_jobs(tmp_path):
+    # Parallel runs give the same results, in the same order.
+    img = nib.load(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    for sub_no in range(1, 4):
+        fname = tmp_path / f"sub-0{sub_no}" / f"sub-0{sub_no}_bold.nii.gz"
+        fname.parent.mkdir()
+        # Vary size, so size ordering differs from name ordering.
+        nib.save(nib.Nifti1Image(data[..., :10 - sub_no], img.affine), fname)
+    serial = outfind.find_outliers(tmp_path)
+    parallel = outfind.find_outliers(tmp_path, jobs=2)
+    assert list(parallel) == list(serial) == sorted(serial)
+    for fname in serial:
+        assert np.array_equal(parallel[fname], serial[fname])
+    # The generator gives the same results, as each image finishes.
+    for jobs in (1, 2):
+        results = list(outfind.iter_outliers(tmp_path, jobs=jobs))
+        if jobs == 1:
+            assert [fname for fname, _ in results] == list(serial)
+        assert len(results) == len(serial)
+        for fname, outliers in results:
+            assert np.array_equal(outliers, serial[fname])
+        # Stopping early is fine.
+        outliers = outfind.iter_outliers(tmp_path, jobs=jobs)
+        fname, first = next(outliers)
+        assert np.array_equal(first, serial[fname])
+        outliers.close()
+
+
+def test_threshold_sweep(tmp_path):
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    thresholds = [2, 3.5, 5]
+    sweep = outfind.run_threshold_sweep(run, thresholds)
+    assert len(sweep) == 3
+    assert np.array_equal(sweep[1], outfind.detect_run_outliers(run))
+    # Lower thresholds give at least as many outliers here.
+    assert len(sweep[0]) >= len(sweep[1]) >= len(sweep[2])
+    fname = tmp_path / "sub-01" / "sub-01_bold.nii.gz"
+    fname.parent.mkdir()
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    for jobs in (1, 2):
+        sweep_dict = outfind.sweep_thresholds(tmp_path, thresholds, jobs=jobs)
+        assert list(sweep_dict) == [fname]
+        for by_file, by_run in zip(sweep_dict[fname], sweep):
+            assert np.array_equal(by_file, by_run)
+
+
+def test_triage(tmp_path):
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    full = outfind.mad_voxel_outliers(run)[0]
+    assert np.array_equal(outfind.mad_voxel_outliers(run, 1.)[0], full)
+    assert np.array_equal(outfind.mad_voxel_outliers(run, 0.2, seed=3)[0],
+                          outfind.mad_voxel_outliers(run, 0.2, seed=3)[0])
+    # Agreement with the full calculation on the bundled data.
+    fname = tmp_path / "sub-01" / "sub-01_bold.nii.gz"
+    fname.parent.mkdir()
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    agreements = outfind.compare_to_full(tmp_path, {'subsample': 0.1})
+    assert agreements[fname]['jaccard'] == 1
+    assert np.array_equal(agreements[fname]['reference'],
+                          outfind.file_outliers(fname))
+    agreement = outfind.compare_outliers([1, 4, 7], [4, 7, 9, 9])
+    assert list(agreement['missed']) == [1]
+    assert list(agreement['extra']) == [9]
+    assert agreement['jaccard'] == 2 / 4
+    assert outfind.compare_outliers([], [])['jaccard'] == 1
+
+
+def test_preview(tmp_path):
+    run = outfind.load_run(EXAMPLE_FILENAME, downsample=2)
+    assert run.mask.shape == (32 * 32 * 17,)
+    assert run.brain_voxels.shape == (np.count_nonzero(run.mask), 10)
+    # Reading in blocks, and SPM globals, give the same downsampled run.
+    run4 = outfind.load_run(EXAMPLE_FILENAME, 4, downsample=2,
+                            spm_globals=True)
+    assert np.allclose(run4.brain_voxels, run.brain_voxels)
+    assert run4.spm_globals.shape == (10,)
+    fname = tmp_path / "sub-01" / "sub-01_bold.nii.gz"
+    fname.parent.mkdir()
+    spikes = write_image(fname, (32, 32, 16), 80, n_spikes=3, seed=1)
+    agreements = outfind.compare_to_full(tmp_path, {'downsample': 2})
+    assert agreements[fname]['jaccard'] == 1
+    assert set(spikes) <= set(agreements[fname]['test'])
+    # Downsampled metrics have their own cache entry.
+    cache = MetricsCache(tmp_path / "cache")
+    for downsample in (None, 2, None, 2):
+        outliers = outfind.find_outliers(tmp_path, cache=cache,
+                                         downsample=downsample)
+        assert np.array_equal(outliers[fname],
+                              agreements[fname]['test' if downsample
+                                                else 'reference'])
+    store = tmp_path / "sub-01.tstore"
+    outfind.convert_to_store(fname, store)
+    with pytest.raises(ValueError):
+        outfind.load_run(store, downsample=2)
+
+
+def test_dtype_deviations():
+    run32 = outfind.load_run(EXAMPLE_FILENAME, dtype=np.float32)
+    assert run32.brain_voxels.dtype == np.float32
+    deviations = outfind.dtype_deviations(EXAMPLE_FILENAME, np.float32)
+    # The example image is int16, so float32 values are exact; sums
+    # accumulate in float64.
+    assert deviations['dvars'] < 1e-5
+    assert deviations['volume_means'] < 1e-5
+    assert deviations['voxel_outlier_counts'] == 0
+    assert deviations['outliers_equal']
+    assert np.array_equal(
+        outfind.file_outliers(EXAMPLE_FILENAME, np.float32),
+        outfind.file_outliers(EXAMPLE_FILENAME))
@@ -0,0 +1,79 @@
+""" Test profiling instrumentation
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+import csv
+import json
+
+from findoutlie import profiling
+from findoutlie import outfind
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_stage():
+    assert not profiling.is_enabled()
+    # Stages do nothing when profiling is off.
+    with profiling.stage('a'):
+        pass
+    assert profiling.get_records() == []
+    profiling.enable()
+    try:
+        with profiling.current_file('f1'):
+            for i in range(3):
+                with profiling.stage('a'):
+                    sum(range(1000))
+        with profiling.stage('b'):
+            pass
+        records = profiling.get_records()
+    finally:
+        assert len(profiling.disable()) == 2
+    assert not profiling.is_enabled()
+    by_key = {(r['file'], r['stage']): r for r in records}
+    assert set(by_key) == {('f1', 'a'), (None, 'b')}
+    assert by_key[('f1', 'a')]['calls'] == 3
+    assert by_key[('f1', 'a')]['wall'] > 0
+    # Merging records.
+    profiling.enable()
+    try:
+        profiling.add_records(records)
+        profiling.add_records(records)
+        merged = profiling.disable()
+    finally:
+        profiling.disable()
+    assert {(r['file'], r['stage']): r['calls'] for r in merged} == {
+        ('f1', 'a'): 6, (None, 'b'): 2}
+
+
+def test_file_profile(tmp_path):
+    profiling.enable()
+    try:
+        outfind.file_outliers(EXAMPLE_FILENAME)
+        records = profiling.disable()
+    finally:
+        profiling.disable()
+    stages = {r['stage'] for r in records}
+    assert {'load_run', 'load_image', 'read_volumes', 'mask',
+            'voxel_outlier_counts', 'dvars', 'detect_sliding_window'} <= stages
+    # Loading and intermediate values are not timed in the detector stages.
+    wall = {r['stage']: r['wall'] for r in records}
+    assert wall['load_run'] > wall['detect_sliding_window']
+    assert wall['voxel_outlier_counts'] > wall['detect_mad_voxel']
+    assert {r['file'] for r in records} == {str(EXAMPLE_FILENAME)}
+    json_fname = tmp_path / 'trace.json'
+    profiling.write_trace(json_fname, records)
+    assert json.loads(json_fname.read_text()) == records
+    tsv_fname = tmp_path / 'trace.tsv'
+    profiling.write_trace(tsv_fname, records)
+    with open(tsv_fname, 'rt') as fobj:
+        rows = list(csv.DictReader(fobj, delimiter='\t'))
+    assert len(rows) == len(records)
+    table = profiling.summary(records, top=3)
+    assert len(table.splitlines()) == 4
+    assert 'read_volumes' in profiling.summary(records)
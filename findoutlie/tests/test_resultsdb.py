@@ -0,0 +1,71 @@
+""" Test SQLite results database
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+import numpy as np
+
+import pytest
+
+from findoutlie import outfind
+from findoutlie.resultsdb import ResultsDB, bids_entities
+from findoutlie.benchmarks.synthetic import write_image
+
+
+def test_bids_entities():
+    assert bids_entities('sub-07_task-rest_run-02_bold.nii.gz') == {
+        'subject': '07', 'session': None, 'task': 'rest', 'run': '02'}
+    assert bids_entities('/data/sub-01/sub-01_ses-pre_bold.tstore') == {
+        'subject': '01', 'session': 'pre', 'task': None, 'run': None}
+    assert bids_entities('scan.nii') == dict.fromkeys(
+        ('subject', 'session', 'task', 'run'))
+
+
+def test_results_db(tmp_path):
+    data_dir = tmp_path / "data"
+    fnames = []
+    for sub in ("01", "07"):
+        fname = (data_dir / f"sub-{sub}" /
+                 f"sub-{sub}_task-rest_run-01_bold.nii.gz")
+        fname.parent.mkdir(parents=True)
+        write_image(fname, (16, 16, 8), 40, seed=int(sub))
+        fnames.append(fname)
+    db = ResultsDB(tmp_path / "results.sqlite")
+    for jobs in (1, 2):
+        outliers = outfind.find_outliers(data_dir, jobs=jobs, results_db=db)
+    # Running again replaces the earlier rows.
+    assert db.query('SELECT COUNT(*) FROM runs') == [(2,)]
+    assert db.query('SELECT COUNT(*) FROM volumes') == [(80,)]
+    results = outfind.file_outliers(fnames[1], results=True)
+    assert np.array_equal(results['outliers'], outliers[fnames[1]])
+    metrics = results['metrics']
+    assert sorted(metrics) == ['dvars', 'volume_means',
+                               'voxel_outlier_counts']
+    dvars = db.metric_values('dvars', subject='07', task='rest')
+    assert np.allclose(dvars, metrics['dvars'])
+    assert len(db.metric_values('mean')) == 80
+    assert db.metric_values('spm_global') == []
+    rows = db.query(
+        'SELECT volume FROM volumes JOIN runs ON runs.id = run_id '
+        'WHERE subject = ? AND outlier = 1 ORDER BY volume', ('07',))
+    assert [volume for volume, in rows] == list(outliers[fnames[1]])
+    rows = db.query(
+        'SELECT volume FROM detections JOIN runs ON runs.id = run_id '
+        'WHERE subject = ? AND detector = ? ORDER BY volume',
+        ('07', 'dvars'))
+    assert [volume for volume, in rows] == list(results['detectors']['dvars'])
+    fractions = dict(db.outlier_runs(0))
+    for fname in fnames:
+        assert fractions.get(str(fname.resolve()), 0) == pytest.approx(
+            len(outliers[fname]) / 40)
+    # Another rule adds rows, with SPM globals if the rule uses them.
+    outfind.find_outliers(data_dir, rule='spm_global | dvars', results_db=db)
+    assert db.query('SELECT COUNT(*) FROM runs') == [(4,)]
+    assert len(db.metric_values('spm_global', subject='01')) == 40
+    with pytest.raises(ValueError):
+        db.metric_values('brain')
+    with pytest.raises(ValueError):
+        db.metric_values('dvars', acquisition='fast')
+    db.close()
@@ -27,7 +27,7 @@ import nibabel as nib
 
 # This import needs the directory containing the findoutlie directory
 # on the Python path.
-from spm_funcs import get_spm_globals, spm_global
+from spm_funcs import get_spm_globals, spm_global, spm_globals_voxels
 
 
 def test_spm_globals():
@@ -44,9 +44,33 @@ def test_spm_globals():
         vol = data[..., vol_no]
         globals.append(spm_global(vol))
     assert np.allclose(globals, expected_values, rtol=1e-4)
+    # The image has integer data, so the batched calculation is exact.
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    assert np.array_equal(spm_globals_voxels(voxels), globals)
+    for block_size in (1, 3, 100):
+        assert np.array_equal(get_spm_globals(example_path,
+                                              block_size=block_size),
+                              globals)
+
+
+def test_spm_globals_voxels():
+    rng = np.random.default_rng(42)
+    voxels = rng.normal(100, 50, size=(1000, 12))
+    assert np.allclose(spm_globals_voxels(voxels),
+                       [spm_global(vol) for vol in voxels.T],
+                       rtol=1e-12, atol=0)
+    # Float32 data gives float64 globals, matching spm_global on float64.
+    voxels32 = voxels.astype(np.float32)
+    glob_vals = spm_globals_voxels(voxels32)
+    assert glob_vals.dtype == np.float64
+    assert np.allclose(glob_vals,
+                       [spm_global(vol.astype(np.float64))
+                        for vol in voxels32.T],
+                       rtol=1e-12, atol=0)
 
 
 if __name__ == "__main__":
     # File being executed as a script
     test_spm_globals()
+    test_spm_globals_voxels()
     print("Tests passed")
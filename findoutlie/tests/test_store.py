@@ -0,0 +1,73 @@
+""" Test time-major stores
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie.store import is_store, read_store, store_path
+from findoutlie import outfind
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_store_path():
+    assert store_path('/data/group-01/sub-01/func/sub-01_bold.nii.gz',
+                      '/data', '/store') == Path(
+                          '/store/group-01/sub-01/func/sub-01_bold.tstore')
+    assert store_path('data/sub-01.nii', 'data', 'store') == Path(
+        'store/sub-01.tstore')
+
+
+def test_convert_to_store(tmp_path):
+    store_dir = tmp_path / "sub-01.tstore"
+    assert not is_store(store_dir)
+    outfind.convert_to_store(EXAMPLE_FILENAME, store_dir, block_size=3)
+    assert is_store(store_dir)
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    mask, brain_voxels, meta = read_store(store_dir)
+    assert isinstance(brain_voxels, np.memmap)
+    assert brain_voxels.dtype == np.float32
+    # Each voxel time course is contiguous.
+    assert brain_voxels.flags.c_contiguous
+    assert np.all(mask == run.mask)
+    assert np.all(brain_voxels == run.brain_voxels)
+    img = nib.load(EXAMPLE_FILENAME)
+    assert meta['shape'] == list(img.shape)
+    assert np.all(meta['affine'] == img.affine)
+    assert meta['source_sha1'] is not None
+    # By default, calculations use the memory-mapped store voxels as they
+    # are; another dtype gives an in-memory copy.
+    store_run = outfind.load_run(store_dir)
+    assert isinstance(store_run.brain_voxels, np.memmap)
+    assert store_run.brain_voxels.dtype == np.float32
+    assert np.all(store_run.brain_voxels == run.brain_voxels)
+    assert outfind.run_dtype(store_dir) == np.float32
+    assert outfind.run_dtype(EXAMPLE_FILENAME) == np.float64
+    store_run = outfind.load_run(store_dir, dtype=np.float64)
+    assert store_run.brain_voxels.dtype == np.float64
+    assert np.all(store_run.brain_voxels == run.brain_voxels)
+    assert np.array_equal(outfind.file_outliers(store_dir),
+                          outfind.file_outliers(EXAMPLE_FILENAME))
+
+
+def test_convert_dataset(tmp_path):
+    data_dir = tmp_path / "data"
+    fname = data_dir / "sub-01" / "func" / "sub-01_task-test_run-01_bold.nii.gz"
+    fname.parent.mkdir(parents=True)
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    store_root = tmp_path / "store"
+    store_dirs = outfind.convert_dataset(data_dir, store_root)
+    assert store_dirs == [store_path(fname, data_dir, store_root)]
+    from_store = outfind.find_outliers(store_root)
+    from_images = outfind.find_outliers(data_dir)
+    assert list(from_store) == store_dirs
+    assert np.array_equal(from_store[store_dirs[0]], from_images[fname])
@@ -0,0 +1,76 @@
+""" Test streaming metrics
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+import pytest
+
+from findoutlie.streaming import (load_image, iter_volumes, stream_image,
+                                  MeanImage, VolumeMeans, Dvars, SpmGlobals,
+                                  BrainVoxels, downsample, downsampled_shape)
+from findoutlie.metrics import dvars_voxel
+from findoutlie.spm_funcs import spm_global
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_iter_volumes():
+    img = load_image(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    for block_size in (1, 3, 10, 20):
+        blocks = list(iter_volumes(img, block_size))
+        assert len(blocks) == int(np.ceil(data.shape[-1] / block_size))
+        assert np.all(np.column_stack(blocks) == voxels)
+
+
+def test_accumulators():
+    img = load_image(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    voxels = np.reshape(data, (-1, data.shape[-1]))
+    mask = voxels.mean(axis=-1) > 400
+    for block_size in (1, 4, 10):
+        accs = stream_image(
+            img,
+            [MeanImage(), VolumeMeans(mask), Dvars(), Dvars(mask),
+             SpmGlobals(), BrainVoxels(mask, voxels.shape[-1])],
+            block_size)
+        mean_img, means, dvs, masked_dvs, globals, brain = [
+            acc.result() for acc in accs]
+        assert np.allclose(mean_img, voxels.mean(axis=-1))
+        assert np.allclose(means, voxels[mask].mean(axis=0))
+        assert np.allclose(dvs, dvars_voxel(voxels))
+        assert np.allclose(masked_dvs, dvars_voxel(voxels[mask]))
+        assert np.allclose(globals,
+                           [spm_global(data[..., i])
+                            for i in range(data.shape[-1])])
+        assert np.all(brain == voxels[mask])
+
+
+def test_downsample():
+    img = load_image(EXAMPLE_FILENAME)
+    data = img.get_fdata()
+    assert downsampled_shape(data.shape, 2) == (32, 32, 17)
+    assert downsampled_shape(data.shape, (1, 2, 3)) == (64, 32, 11)
+    small = downsample(data, 2)
+    assert small.shape == (32, 32, 17, data.shape[-1])
+    assert np.allclose(small[3, 5, 7],
+                       data[6:8, 10:12, 14:16].mean(axis=(0, 1, 2)))
+    assert np.allclose(downsample(data, (1, 1, 1)), data)
+    assert np.allclose(downsample(data, (1, 2, 1))[:, 4],
+                       data[:, 8:10].mean(axis=1))
+    with pytest.raises(ValueError):
+        downsample(data, 0)
+    with pytest.raises(ValueError):
+        downsample(data, (2, 2))
+    blocks = list(iter_volumes(img, 3, factor=2))
+    assert np.allclose(np.column_stack(blocks),
+                       np.reshape(small, (-1, data.shape[-1])))
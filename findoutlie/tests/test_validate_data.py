@@ -0,0 +1,98 @@
+""" Test data validation script
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+import hashlib
+import importlib.util
+
+import nibabel as nib
+
+import pytest
+
+from findoutlie import gzindex
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+SCRIPT = MY_DIR.parent.parent / "scripts" / "validate_data.py"
+
+spec = importlib.util.spec_from_file_location("validate_data", SCRIPT)
+validate_data = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(validate_data)
+
+
+@pytest.fixture
+def group_dir(tmp_path):
+    # Group directory with two images and a text file, and a hash list.
+    group_dir = tmp_path / "data" / "group-01"
+    lines = []
+    for sub in ("01", "02"):
+        fname = group_dir / f"sub-{sub}" / f"sub-{sub}_bold.nii.gz"
+        fname.parent.mkdir(parents=True)
+        nib.save(nib.load(EXAMPLE_FILENAME), fname)
+        lines.append(fname)
+    events = group_dir / "sub-01" / "sub-01_events.tsv"
+    events.write_text("onset\tduration\n0\t10\n")
+    lines.append(events)
+    (group_dir / "hash_list.txt").write_text("".join(
+        f"{hashlib.sha1(fname.read_bytes()).hexdigest()} "
+        f"{fname.relative_to(group_dir.parent)}\n" for fname in lines))
+    return group_dir
+
+
+def test_good_manifest(group_dir, capsys):
+    validate_data.validate_data(group_dir, jobs=2)
+    out = capsys.readouterr().out
+    assert "Hashed 3 files" in out
+    assert "MB/s" in out
+    assert "all the hashes match" in out
+    # The manifest can be elsewhere.
+    manifest = group_dir.parent / "hashes.txt"
+    (group_dir / "hash_list.txt").rename(manifest)
+    validate_data.validate_data(group_dir, manifest=manifest)
+    with pytest.raises(FileNotFoundError):
+        validate_data.validate_data(group_dir)
+
+
+def test_mismatches(group_dir):
+    # All changed and missing files are reported, not just the first.
+    for sub in ("01", "02"):
+        fname = group_dir / f"sub-{sub}" / f"sub-{sub}_bold.nii.gz"
+        fname.write_bytes(fname.read_bytes() + b"\0")
+    with pytest.raises(ValueError) as excinfo:
+        validate_data.validate_data(group_dir)
+    message = str(excinfo.value)
+    assert message.startswith("2 of 3 files failed validation")
+    assert "sub-01_bold.nii.gz changed" in message
+    assert "sub-02_bold.nii.gz changed" in message
+    (group_dir / "sub-01" / "sub-01_events.tsv").unlink()
+    with pytest.raises(ValueError) as excinfo:
+        validate_data.validate_data(group_dir, jobs=1)
+    message = str(excinfo.value)
+    assert message.startswith("3 of 3 files failed validation")
+    assert "sub-01_events.tsv is missing" in message
+
+
+def test_build_index(group_dir, tmp_path):
+    pytest.importorskip('indexed_gzip')
+    index_dir = tmp_path / "indices"
+    args = validate_data.get_parser().parse_args(
+        [str(group_dir.parent), "--build-index"])
+    assert args.build_index
+    assert args.data_directory == str(group_dir.parent)
+    validate_data.validate_data(group_dir, build_indices=True,
+                                index_dir=index_dir)
+    images = sorted(group_dir.glob("*/*.nii.gz"))
+    assert sorted(index_dir.iterdir()) == sorted(
+        gzindex.index_path(fname, index_dir) for fname in images)
+    # No indices for data that fail validation.
+    (group_dir / "sub-01" / "sub-01_events.tsv").unlink()
+    other_dir = tmp_path / "other"
+    with pytest.raises(ValueError):
+        validate_data.validate_data(group_dir, build_indices=True,
+                                    index_dir=other_dir)
+    assert not other_dir.exists()
@@ -0,0 +1,77 @@
+""" Test voxel-parallel kernels
+
+You can run the tests from the root directory (containing ``README.md``) with::
+
+    python3 -m pytest .
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+import nibabel as nib
+
+from findoutlie import outfind
+from findoutlie.voxelpool import VoxelPool
+from findoutlie.detectors import mad_voxel_counts
+from findoutlie.metrics import dvars_voxel
+from findoutlie.store import read_store
+
+
+MY_DIR = Path(__file__).parent
+EXAMPLE_FILENAME = MY_DIR / "ds107_sub012_t1r2_small.nii"
+
+
+def test_kernels(tmp_path):
+    rng = np.random.default_rng(0)
+    voxels = rng.normal(size=(5000, 40))
+    voxels[10:20] *= 10
+    with VoxelPool(2, shared_dir=tmp_path) as pool:
+        assert np.array_equal(pool.mad_voxel_counts(voxels, block_size=300),
+                              mad_voxel_counts(voxels))
+        assert np.array_equal(pool.mad_voxel_counts(voxels, 2.5),
+                              mad_voxel_counts(voxels, 2.5))
+        assert np.allclose(pool.dvars_voxel(voxels), dvars_voxel(voxels))
+        assert np.allclose(pool.voxel_means(voxels), voxels.mean(axis=-1))
+        # The array is copied to shared memory once.
+        assert len(list(tmp_path.iterdir())) == 1
+        shared = pool.empty((100, 40), np.float32)
+        shared[:] = voxels[:100]
+        assert np.array_equal(pool.mad_voxel_counts(shared),
+                              mad_voxel_counts(np.array(shared)))
+        assert len(list(tmp_path.iterdir())) == 2
+        assert np.array_equal(pool.mad_voxel_counts(voxels[:0]),
+                              np.zeros(40))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_voxel_jobs(tmp_path):
+    run = outfind.load_run(EXAMPLE_FILENAME)
+    with VoxelPool(2, shared_dir=tmp_path) as pool:
+        shared_run = outfind.load_run(EXAMPLE_FILENAME, pool=pool)
+        assert np.array_equal(shared_run.brain_voxels, run.brain_voxels)
+        metrics = outfind.run_metrics(run)
+        shared_metrics = outfind.run_metrics(shared_run, pool=pool)
+        for name, value in metrics.items():
+            assert np.allclose(shared_metrics[name], value)
+        # Brain voxels loaded into the pool are not copied again.
+        assert len(list(tmp_path.iterdir())) == 1
+        data = nib.load(EXAMPLE_FILENAME).get_fdata()
+        voxels = np.reshape(data, (-1, data.shape[-1]))
+        assert np.array_equal(outfind.segment_brain(voxels, pool),
+                              outfind.segment_brain(voxels))
+        # Memory-mapped stores are mapped from their own files.
+        store = outfind.convert_to_store(EXAMPLE_FILENAME,
+                                         tmp_path / "run.tstore")
+        brain_voxels = read_store(store)[1]
+        handle = pool.share(brain_voxels)
+        assert handle[0] == str(store / "brain.npy")
+        assert np.array_equal(pool.mad_voxel_counts(brain_voxels),
+                              mad_voxel_counts(brain_voxels))
+    assert list(tmp_path.glob("*.dat")) == []
+    fname = tmp_path / "data" / "sub-01" / "sub-01_bold.nii.gz"
+    fname.parent.mkdir(parents=True)
+    nib.save(nib.load(EXAMPLE_FILENAME), fname)
+    serial = outfind.find_outliers(tmp_path / "data")
+    parallel = outfind.find_outliers(tmp_path / "data", voxel_jobs=2)
+    assert np.array_equal(parallel[fname], serial[fname])
@@ -0,0 +1,183 @@
+""" Voxel-parallel kernels within one run, on shared-memory arrays
+
+Running files in parallel, as with ``jobs`` for
+:func:`findoutlie.outfind.find_outliers`, does not help when one large run
+takes most of the time.  A :class:`VoxelPool` splits the rows (voxels) of a
+voxels by time points array into blocks of rows, runs the per-voxel kernels
+on the blocks in a pool of worker processes, and then combines the results
+for the blocks:
+
+* voxel outlier counts (medians and MADs per voxel) : sum of counts;
+* dvars : sum of squared differences, then the root mean;
+* voxel means, for the brain mask : concatenation.
+
+Workers do not get copies of the array.  Instead, the array is in a memory
+mapped file in shared memory (``/dev/shm`` where it exists), and each worker
+maps the rows it needs.  Arrays allocated with :meth:`VoxelPool.empty` are
+already in shared memory; :func:`findoutlie.outfind.load_run` allocates the
+brain voxels there when given a pool.  Memory-mapped arrays, such as the
+brain voxels from a store, are mapped from their own files.  Other arrays
+are copied into shared memory once, on first use.
+
+For example::
+
+    with VoxelPool(8) as pool:
+        run = load_run(fname, pool=pool)
+        counts = pool.mad_voxel_counts(run.brain_voxels)
+        dvars = pool.dvars_voxel(run.brain_voxels)
+"""
+
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+from .detectors import mad_voxel_counts
+from .metrics import sum_sq_diffs
+
+# Directory for shared arrays; files in /dev/shm stay in memory.
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Number of blocks of rows for each worker, so workers finishing early can
+# take more of the work.
+TASKS_PER_JOB = 4
+
+
+def _map(handle):
+    # Map array from (filename, offset, shape, dtype) `handle`.
+    filename, offset, shape, dtype = handle
+    if filename is None:  # Empty array.
+        return np.empty(shape, dtype)
+    return np.memmap(filename, np.dtype(dtype), 'r', offset, tuple(shape))
+
+
+def _counts_task(handle, start, stop, threshold, block_size):
+    return mad_voxel_counts(_map(handle)[start:stop], threshold, block_size)
+
+
+def _sum_sq_task(handle, start, stop, block_size):
+    return sum_sq_diffs(_map(handle)[start:stop], block_size)
+
+
+def _means_task(handle, start, stop):
+    return np.mean(_map(handle)[start:stop], axis=-1)
+
+
+class VoxelPool:
+    """ Pool of processes running kernels on blocks of voxels
+
+    Use as a context manager, or call :meth:`close` when done, to stop the
+    workers and remove the shared arrays.  The worker processes start on
+    first use.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        Number of worker processes.  If None, use one per CPU.
+    shared_dir : str or Path, optional
+        Directory for shared array files.  Default is ``/dev/shm`` if it
+        exists, otherwise the temporary directory.
+    """
+
+    def __init__(self, jobs=None, shared_dir=SHARED_DIR):
+        self.jobs = jobs or os.cpu_count()
+        self.shared_dir = shared_dir
+        self._executor = None
+        self._files = []
+        # id of array: (array, handle), for arrays copied to shared memory.
+        self._copies = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stop the workers, and remove the shared array files
+
+        Arrays from :meth:`empty` stay valid while they exist, but workers
+        can no longer map them.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for filename in self._files:
+            try:
+                os.unlink(filename)
+            except OSError:  # Windows cannot remove mapped files.
+                pass
+        self._files = []
+        self._copies = {}
+
+    def empty(self, shape, dtype=np.float64):
+        """ Return new uninitialized array in shared memory
+        """
+        fd, filename = tempfile.mkstemp(dir=self.shared_dir,
+                                        prefix='findoutlie-', suffix='.dat')
+        os.close(fd)
+        self._files.append(filename)
+        if int(np.prod(shape)) == 0:  # Cannot map an empty file.
+            return np.empty(shape, dtype)
+        return np.memmap(filename, np.dtype(dtype), 'w+', shape=tuple(shape))
+
+    def share(self, array):
+        """ Return handle for workers to map `array`, sharing it if needed
+
+        The handle is a picklable (filename, offset, shape, dtype) tuple.
+        """
+        if array.size == 0:
+            return (None, 0, array.shape, array.dtype.str)
+        if (isinstance(array, np.memmap)
+                and isinstance(array.base, mmap.mmap)
+                and array.flags.c_contiguous and array.filename is not None):
+            return (str(array.filename), array.offset, array.shape,
+                    array.dtype.str)
+        if id(array) not in self._copies:
+            shared = self.empty(array.shape, array.dtype)
+            shared[...] = array
+            shared.flush()
+            # Keep `array`, so its id is not reused while we have the copy.
+            self._copies[id(array)] = (array, self.share(shared))
+        return self._copies[id(array)][1]
+
+    def _map_blocks(self, func, array, min_rows, *args):
+        """ Return ``func(handle, start, stop, *args)`` for blocks of rows
+        """
+        handle = self.share(array)
+        n_rows = len(array)
+        rows = max(min_rows, -(-n_rows // (self.jobs * TASKS_PER_JOB)), 1)
+        if self._executor is None:
+            # Importing the process pool machinery is slow; only do it when
+            # needed.
+            from concurrent.futures import ProcessPoolExecutor
+            self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+        futures = [self._executor.submit(func, handle, start,
+                                         min(start + rows, n_rows), *args)
+                   for start in range(0, n_rows, rows)]
+        return [future.result() for future in futures]
+
+    def mad_voxel_counts(self, img, threshold=3.5, block_size=4096):
+        """ Parallel :func:`findoutlie.detectors.mad_voxel_counts`
+        """
+        if len(img) == 0:
+            return mad_voxel_counts(img, threshold, block_size)
+        counts = self._map_blocks(_counts_task, img, block_size, threshold,
+                                  block_size)
+        return np.sum(counts, axis=0)
+
+    def dvars_voxel(self, voxels, block_size=None):
+        """ Parallel :func:`findoutlie.metrics.dvars_voxel`
+
+        Gives the same result, to within floating point error.
+        """
+        sum_sq = sum(self._map_blocks(_sum_sq_task, voxels, 1, block_size))
+        return np.sqrt(sum_sq / len(voxels))
+
+    def voxel_means(self, img):
+        """ Mean over time (columns) for each voxel (row) in 2D `img`
+        """
+        if len(img) == 0:
+            return np.mean(img, axis=-1)
+        return np.concatenate(self._map_blocks(_means_task, img, 1))
@@ -0,0 +1,56 @@
+""" Python script to convert images to time-major stores
+
+Run as:
+
+    python3 scripts/convert_store.py data store
+
+This writes the brain voxels of each ``sub-*.nii.gz`` image in ``data`` to a
+``.tstore`` directory in ``store``, with time as the fast axis.  Find
+outliers from the stores with:
+
+    python3 scripts/find_outliers.py store
+"""
+
+from pathlib import Path
+import sys
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+# Put the findoutlie directory on the Python path.
+PACKAGE_DIR = Path(__file__).parent / ".."
+sys.path.append(str(PACKAGE_DIR))
+
+from findoutlie import outfind
+
+
+def get_parser():
+    parser = ArgumentParser(
+        description=__doc__,  # Usage from docstring
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("data_directory", help="Directory containing data")
+    parser.add_argument("store_directory", help="Directory for stores")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to use (default 1); "
+                        "0 means one per CPU")
+    parser.add_argument("--dtype", choices=("float32", "float64"),
+                        default="float32",
+                        help="Data type for stored values (default "
+                        "%(default)s)")
+    return parser
+
+
+def main():
+    # This function (main) called when this file run as a script.
+    args = get_parser().parse_args()
+    store_dirs = outfind.convert_dataset(args.data_directory,
+                                         args.store_directory,
+                                         dtype=args.dtype,
+                                         jobs=args.jobs or None)
+    for store_dir in store_dirs:
+        print(store_dir)
+
+
+if __name__ == "__main__":
+    # Python is running this file as a script, not importing it.
+    main()
@@ -3,29 +3,166 @@
 Run as:
 
     python3 scripts/find_outliers.py data
+
+Use ``--jobs`` to process images in parallel, e.g.:
+
+    python3 scripts/find_outliers.py data --jobs 8
+
+Each image's line is printed as soon as that image is done, so with
+``--jobs``, lines come in the order the images finish.
+
+Use ``--voxel-jobs 8`` to split the per-voxel calculations for each image
+(voxel outlier counts and dvars) over 8 processes, sharing the image data in
+memory.  This helps when one very large image would otherwise take much
+longer than the rest.
+
+Use ``--dtype float32`` to halve memory use, at some cost in precision.
+
+Metrics for each run are cached in ``~/.cache/findoutlie`` by default, so
+re-running with different detector settings is fast.  Use ``--no-cache`` to
+turn this off, or ``--refresh`` to recalculate the cached metrics.
+
+Use ``--image-cache DIR`` to keep decompressed copies of the images in DIR,
+for fast memory-mapped reads on later runs.
+
+Use ``--rule`` to choose how to combine the detectors, e.g.:
+
+    python3 scripts/find_outliers.py data --rule "vote(2, mad_voxel, dvars, iqr_dvars)"
+
+See ``findoutlie/ensemble.py`` for the detectors and rule syntax.
+
+Use ``--sweep 2,2.5,3,3.5,4`` to list outliers for each of several MAD
+thresholds, from one pass over each image.  Each output line has the
+filename, threshold, number of outliers, and the outlier indices.  The sweep
+uses the default rule, and does not use the metrics cache, so it cannot be
+combined with ``--rule``, the fast modes, the memory budget, the journal, the
+results database, ``--voxel-jobs``, ``--cache-dir`` or ``--cache-size``.
+
+Use ``--triage`` for a fast first pass, counting outlying voxels in a random
+10% of the brain voxels (or ``--triage 0.05`` for 5%, ``--triage 5000`` for
+5000 voxels).  Add ``--compare-full`` to also run the full calculation, and
+print the agreement for each image: filename, number of full outliers,
+number of triage outliers, missed and extra outliers, and Jaccard index.
+
+Use ``--preview`` for a fast pass over a whole archive, averaging each volume
+over 2x2x2 voxel blocks as it is read, and running the detectors on the
+smaller images.  ``--preview 3`` averages over 3x3x3 blocks, ``--preview
+2,2,1`` over 2x2x1 blocks.  ``--compare-full`` works with ``--preview`` as
+for ``--triage``, so you can check how well the preview agrees before relying
+on it, then run the full analysis on the flagged images.
+
+Use ``--max-memory 4G`` to choose block sizes for reading and calculation that
+keep memory use within 4 GB, shared between the ``--jobs`` processes, and
+their ``--voxel-jobs`` workers.  If an image will not fit, the script stops
+before processing any images.  Use ``--estimate-memory`` to print estimated
+peak memory for each image, with default block sizes, and with the smallest
+blocks, then stop.
+
+Use ``--journal FILE`` to append the outliers for each image to FILE as soon
+as the image is done, and ``--resume`` to skip images that FILE already has,
+with the same detector settings, for example after a crash or preemption:
+
+    python3 scripts/find_outliers.py data --journal data.journal --resume
+
+Use ``--results-db results.sqlite`` to also store the metrics for every
+volume (voxel outlier counts, dvars, means, and SPM globals if the rule uses
+them), and which detectors found each outlier, in an SQLite database.  See
+``findoutlie/resultsdb.py`` for the tables and example queries.
+
+Use ``--profile trace.json`` (or ``trace.tsv``) to record time and memory for
+each processing stage and file, and print a summary of the slowest stages.
 """
 
 from pathlib import Path
 import sys
 
+import numpy as np
+
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 # Put the findoutlie directory on the Python path.
 PACKAGE_DIR = Path(__file__).parent / ".."
 sys.path.append(str(PACKAGE_DIR))
 
-from findoutlie import outfind
+from findoutlie import outfind, profiling
+from findoutlie.cache import MetricsCache, DEFAULT_CACHE_DIR
+from findoutlie.imcache import ImageCache
+from findoutlie.journal import Journal
+from findoutlie.resultsdb import ResultsDB
+from findoutlie.ensemble import DEFAULT_RULE, Ensemble
+from findoutlie.streaming import downsample_factors
+
+# Options (as argument names) that do not work with --sweep.  The sweep never
+# uses the metrics cache, so --no-cache and --refresh are fine.
+SWEEP_EXCLUDES = ("rule", "triage", "preview", "compare_full", "max_memory",
+                  "journal", "resume", "results_db", "voxel_jobs",
+                  "cache_dir", "cache_size")
 
 
-def print_outliers(data_directory):
-    outlier_dict = outfind.find_outliers(data_directory)
-    for fname, outliers in outlier_dict.items():
+def print_outliers(data_directory, **kwargs):
+    # kwargs are options for outfind.iter_outliers.  Print each line as its
+    # image finishes, so other programs can act on it straight away.
+    for fname, outliers in outfind.iter_outliers(data_directory, **kwargs):
         if len(outliers) == 0:
             continue
         outlier_strs = []
         for out_ind in outliers:
             outlier_strs.append(str(out_ind))
-        print(", ".join([str(fname)] + outlier_strs))
+        print(", ".join([str(fname)] + outlier_strs), flush=True)
+
+
+def parse_thresholds(value):
+    """ Return list of floats from comma-separated string `value`
+    """
+    return [float(v) for v in value.split(",")]
+
+
+def print_sweep(data_directory, thresholds, **kwargs):
+    # kwargs are options for outfind.sweep_thresholds.
+    sweep_dict = outfind.sweep_thresholds(data_directory, thresholds,
+                                          **kwargs)
+    for fname, outlier_lists in sweep_dict.items():
+        for threshold, outliers in zip(thresholds, outlier_lists):
+            print(", ".join([str(fname), str(threshold), str(len(outliers))]
+                            + [str(out_ind) for out_ind in outliers]))
+
+
+def print_memory_estimates(data_directory, dtype, voxel_jobs):
+    estimates = outfind.memory_estimates(data_directory, dtype, voxel_jobs)
+    for fname, (default, minimum) in estimates.items():
+        print(f"{fname}, {default / 2 ** 20:.1f} MB, "
+              f"{minimum / 2 ** 20:.1f} MB")
+    if estimates:
+        print(f"Maximum, {max(d for d, m in estimates.values()) / 2 ** 20:.1f} "
+              f"MB, {max(m for d, m in estimates.values()) / 2 ** 20:.1f} MB")
+
+
+def parse_subsample(value):
+    """ Return int voxel count or float fraction from string `value`
+    """
+    return int(value) if value.isdigit() else float(value)
+
+
+def parse_factor(value):
+    """ Return int or tuple of ints from comma-separated string `value`
+    """
+    factors = tuple(int(v) for v in value.split(","))
+    return factors[0] if len(factors) == 1 else factors
+
+
+def print_agreement(data_directory, approximation, **kwargs):
+    # kwargs are options for outfind.compare_to_full.
+    agreements = outfind.compare_to_full(data_directory, approximation,
+                                         **kwargs)
+    for fname, agreement in agreements.items():
+        print(", ".join([str(fname), str(len(agreement["reference"])),
+                         str(len(agreement["test"])),
+                         " ".join(map(str, agreement["missed"])),
+                         " ".join(map(str, agreement["extra"])),
+                         f"{agreement['jaccard']:.3f}"]))
+    if agreements:
+        mean_jaccard = np.mean([a["jaccard"] for a in agreements.values()])
+        print(f"Mean Jaccard index: {mean_jaccard:.3f}")
 
 
 def get_parser():
@@ -34,6 +171,78 @@ def get_parser():
         formatter_class=RawDescriptionHelpFormatter,
     )
     parser.add_argument("data_directory", help="Directory containing data")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to use (default 1); "
+                        "0 means one per CPU")
+    parser.add_argument("--voxel-jobs", type=int, default=1,
+                        help="Number of processes for per-voxel calculations "
+                        "within each image (default 1); 0 means one per CPU")
+    parser.add_argument("--dtype", choices=("float64", "float32"),
+                        help="Floating point type for calculations "
+                        "(default float64 for images, the stored type for "
+                        "stores)")
+    parser.add_argument("--window-length", type=int, default=20,
+                        help="Volumes per window for sliding window "
+                        "detector (default 20)")
+    parser.add_argument("--window-step", type=int, default=10,
+                        help="Volumes between starts of sliding windows "
+                        "(default 10)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory for cached metrics (default "
+                        "%(default)s)")
+    parser.add_argument("--cache-size", default="1G",
+                        help="Maximum size of metrics cache, e.g. 500M, 2G "
+                        "(default %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not use or store cached metrics")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Recalculate metrics, replacing cached values")
+    parser.add_argument("--image-cache", metavar="DIR",
+                        help="Cache decompressed images in DIR, and read "
+                        "them memory-mapped (default is no image cache)")
+    parser.add_argument("--image-cache-size", default="20G",
+                        help="Maximum size of image cache (default "
+                        "%(default)s)")
+    parser.add_argument("--rule", default=DEFAULT_RULE,
+                        help="Rule combining detectors (default "
+                        "%(default)r)")
+    parser.add_argument("--sweep", metavar="THRESHOLDS",
+                        type=parse_thresholds,
+                        help="Comma-separated MAD thresholds; list outliers "
+                        "for each threshold (metrics cache not used)")
+    parser.add_argument("--triage", metavar="FRACTION", nargs="?",
+                        const=0.1, type=parse_subsample,
+                        help="Count voxel outliers in a random subset of "
+                        "brain voxels: a fraction, or an integer number of "
+                        "voxels (default fraction %(const)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for random voxel subset (default 0)")
+    parser.add_argument("--preview", metavar="FACTOR", nargs="?", const=2,
+                        type=parse_factor,
+                        help="Average voxels over FACTOR-sized blocks "
+                        "(e.g. 2 or 2,2,1) before detection (default "
+                        "factor %(const)s)")
+    parser.add_argument("--compare-full", action="store_true",
+                        help="Also run the full calculation, and print "
+                        "agreement with the fast mode")
+    parser.add_argument("--max-memory", metavar="SIZE",
+                        help="Memory budget for all processes, e.g. 4G; "
+                        "block sizes are chosen to keep within it")
+    parser.add_argument("--estimate-memory", action="store_true",
+                        help="Print estimated peak memory per image with "
+                        "default and smallest blocks, then stop")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="Append outliers for each finished image to "
+                        "FILE")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip images already finished in the --journal "
+                        "FILE with the same settings")
+    parser.add_argument("--results-db", metavar="FILE",
+                        help="Store per-volume metrics and detector outliers "
+                        "in SQLite database FILE")
+    parser.add_argument("--profile", metavar="TRACE_FILE",
+                        help="Write per-stage profile to TRACE_FILE (JSON, "
+                        "or TSV if name ends in .tsv), and print summary")
     return parser
 
 
@@ -43,8 +252,63 @@ def main():
     # Get the data directory from the command line arguments
     parser = get_parser()
     args = parser.parse_args()
+    try:
+        Ensemble(args.rule)
+        if args.preview is not None:
+            downsample_factors(args.preview)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+    if args.sweep:
+        # The sweep varies the thresholds of the default rule, calculating
+        # the metrics in full, so these options cannot apply.
+        ignored = [f"--{dest.replace('_', '-')}" for dest in SWEEP_EXCLUDES
+                   if getattr(args, dest) != parser.get_default(dest)]
+        if ignored:
+            parser.error(f"--sweep cannot be used with {', '.join(ignored)}")
+    if args.estimate_memory:
+        print_memory_estimates(args.data_directory, args.dtype,
+                               args.voxel_jobs or None)
+        return
+    cache = None if args.no_cache else MetricsCache(
+        args.cache_dir, args.cache_size, refresh=args.refresh)
+    image_cache = (ImageCache(args.image_cache, args.image_cache_size)
+                   if args.image_cache else None)
+    if args.profile:
+        profiling.enable()
+    options = dict(jobs=args.jobs or None, dtype=args.dtype,
+                   window_length=args.window_length,
+                   window_step=args.window_step, image_cache=image_cache)
     # Call function to find outliers.
-    print_outliers(args.data_directory)
+    if args.sweep:
+        print_sweep(args.data_directory, args.sweep, **options)
+    elif args.compare_full:
+        if args.triage is None and args.preview is None:
+            parser.error("--compare-full needs a fast mode, --triage or "
+                         "--preview")
+        print_agreement(args.data_directory,
+                        {"subsample": args.triage, "seed": args.seed,
+                         "downsample": args.preview},
+                        rule=args.rule, max_memory=args.max_memory,
+                        **options)
+    else:
+        try:
+            print_outliers(args.data_directory, cache=cache, rule=args.rule,
+                           max_memory=args.max_memory,
+                           subsample=args.triage, seed=args.seed,
+                           downsample=args.preview,
+                           journal=Journal(args.journal) if args.journal
+                           else None,
+                           resume=args.resume,
+                           results_db=ResultsDB(args.results_db)
+                           if args.results_db else None,
+                           voxel_jobs=args.voxel_jobs or None, **options)
+        except MemoryError as err:
+            sys.exit(f"Not enough memory: {err}")
+    if args.profile:
+        profiling.write_trace(args.profile)
+        print(profiling.summary(), file=sys.stderr)
 
 
 if __name__ == "__main__":
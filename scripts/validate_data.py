@@ -2,48 +2,95 @@
 
 Run as:
 
-    python3 scripts/validata_data.py data
+    python3 scripts/validate_data.py data
+
+where ``data`` is the directory containing the group directory.  Use
+``--manifest`` to give a hash list file other than ``hash_list.txt`` in the
+group directory.
+
+Use ``--jobs`` to set the number of threads used to hash files.
+
+Use ``--build-index`` to also build gzip seek-point indices for the
+``.nii.gz`` images, for fast access to single volumes later.
 """
 
 from pathlib import Path
 import sys
-import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
+# Put the findoutlie directory on the Python path.
+PACKAGE_DIR = Path(__file__).parent / ".."
+sys.path.append(str(PACKAGE_DIR))
 
-def file_hash(filename):
-    """Get byte contents of file `filename`, return SHA1 hash
+# file_hash reads files in chunks, so memory use is constant, whatever the
+# file size.
+from findoutlie.cache import file_hash
+from findoutlie.gzindex import DEFAULT_INDEX_DIR, build_index
+
+
+def read_hashes(data_directory, manifest=None):
+    """ Read expected hashes from ``hash_list.txt`` file in `data_directory`
 
     Parameters
     ----------
-    filename : str
-        Name of file to read
+    data_directory : str
+        Directory containing data and ``hash_list.txt`` file.
+    manifest : str or Path, optional
+        Hash list file to read instead of ``hash_list.txt`` in
+        `data_directory`.
 
     Returns
     -------
-    hash : str
-        SHA1 hexadecimal hash string for contents of `filename`.
+    hashes : list
+        List of (expected_hash, path) tuples.  Filenames in the hash list
+        are relative to the directory containing `data_directory`.
     """
-    # Open the file, read contents as bytes.
-    # Calculate, return SHA1 has on the bytes from the file.
-    # This is a placeholder, replace it to write your solution.
-    fpath = Path(filename)
-    con = fpath.read_bytes()
-    hash_v = hashlib.sha1(con).hexdigest()
-    # Your code here.
+    data_pth = Path(data_directory)
+    if manifest is None:
+        manifest = data_pth / 'hash_list.txt'
+    hashes = []
+    for line in Path(manifest).read_text().splitlines():
+        if not line.strip():
+            continue
+        # Split each line into expected_hash and filename
+        expected_hash, fname = line.split()
+        hashes.append((expected_hash, data_pth.parent / fname))
+    return hashes
+
 
-    # raise NotImplementedError(
-    #     "This is just a template -- you are expected to code this."
-    # )
-    return hash_v
+def _hash_or_none(filename):
+    # Hash of `filename`, or None if the file is missing.
+    try:
+        return file_hash(filename)
+    except FileNotFoundError:
+        return None
 
 
-def validate_data(data_directory):
-    """Read ``data_hashes.txt`` file in `data_directory`, check hashes
+def validate_data(data_directory, jobs=None, build_indices=False,
+                  manifest=None, index_dir=DEFAULT_INDEX_DIR):
+    """Read ``hash_list.txt`` file in `data_directory`, check hashes
+
+    Files are hashed concurrently in a pool of threads.  All files are
+    checked, before reporting any mismatches.
 
     Parameters
     ----------
     data_directory : str
-        Directory containing data and ``data_hashes.txt`` file.
+        Directory containing data and ``hash_list.txt`` file.
+    jobs : int, optional
+        Number of threads to use for hashing.  If None, use the default for
+        ``concurrent.futures.ThreadPoolExecutor``.
+    build_indices : bool, optional
+        If True, build gzip seek-point indices for ``.nii.gz`` files that
+        pass validation, see :mod:`findoutlie.gzindex`.
+    manifest : str or Path, optional
+        Hash list file to use instead of ``hash_list.txt`` in
+        `data_directory`.
+    index_dir : str or Path, optional
+        Directory in which to save gzip seek-point indices.
 
     Returns
     -------
@@ -53,51 +100,64 @@ def validate_data(data_directory):
     ------
     ValueError:
         If hash value for any file is different from hash value recorded in
-        ``data_hashes.txt`` file.
+        ``hash_list.txt`` file, or the file is missing.  The message lists
+        all such files.
     """
-    # Read lines from ``data_hashes.txt`` file.
-    # Split into SHA1 hash and filename
-    # Calculate actual hash for given filename.
-    # If hash for filename is not the same as the one in the file, raise
-    # ValueError
-    # This is a placeholder, replace it to write your solution.
-    data_pth = Path(data_directory)
-    # print(data_pth)
-    hash_pth = list(data_pth.glob("**/*.txt"))
-    hash_pth = str(hash_pth[0])
-    # hash_pth= "data_pth/**/hash_list.txt"
-    # print(hash_pth[0])
-
-    with open(hash_pth) as f:
-        lines = f.readlines()
-        # print(lines)
-        f.close()
-    # Split into lines.
-    # lines.strip()
-
-    # For each line:
-    for line in lines:
-        # Split each line into expected_hash and filename
-        spl = line.split()
-        # Calculate actual hash for given filename.
-        d_pth = list(data_pth.glob("**/*"))
- 
-        # print(d_pth)
-
-        #print(d_pth)
-
-        cal_hash = file_hash(data_pth.parent / spl[1])
+    hashes = read_hashes(data_directory, manifest)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        actual_hashes = list(executor.map(
+            _hash_or_none, [pth for _, pth in hashes]))
+    elapsed = time.perf_counter() - start
+    mismatches = []
+    n_bytes = 0
+    for (expected_hash, pth), actual_hash in zip(hashes, actual_hashes):
+        if actual_hash is None:
+            mismatches.append(f'{pth} is missing')
+            continue
+        n_bytes += pth.stat().st_size
         # Check actual hash against expected hash
-        act_hash = spl[0]
-        # Return False if any of the hashes do not match.
-        if cal_hash != act_hash:
-            raise ValueError(f'{spl[1]} changed, hashes do not match')
+        if actual_hash != expected_hash:
+            mismatches.append(f'{pth} changed, hashes do not match')
+    n_mb = n_bytes / 2 ** 20
+    print(f'Hashed {len(hashes)} files, {n_mb:.1f} MB in {elapsed:.2f} s '
+          f'({n_mb / max(elapsed, 1e-9):.1f} MB/s)')
+    if mismatches:
+        raise ValueError(f'{len(mismatches)} of {len(hashes)} files failed '
+                         'validation:\n' + '\n'.join(mismatches))
     print(f'{data_directory} is not corrupted, all the hashes match')
-    return
+    if build_indices:
+        gz_paths = [pth for _, pth in hashes if pth.name.endswith('.nii.gz')]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda pth: build_index(pth, index_dir),
+                              gz_paths))
+        print(f'Built gzip indices for {len(gz_paths)} images')
+
+
+def get_parser():
+    parser = ArgumentParser(
+        description=__doc__,  # Usage from docstring
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("data_directory", nargs="?",
+                        default=str(PACKAGE_DIR / "data"),
+                        help="Directory containing the group directory "
+                        "(default is the data directory of the repository)")
+    parser.add_argument("--manifest",
+                        help="Hash list file (default is hash_list.txt in "
+                        "the group directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of threads for hashing "
+                        "(default depends on number of CPUs)")
+    parser.add_argument("--build-index", action="store_true",
+                        help="Build gzip seek-point indices for images")
+    return parser
+
 
 def main():
     # This function (main) called when this file run as a script.
-    group_directory = (Path(__file__).parent.parent / 'data')
+    args = get_parser().parse_args()
+    group_directory = Path(args.data_directory)
     groups = list(group_directory.glob('group-??'))
     if len(groups) == 0:
         raise RuntimeError('No group directory in data directory: '
@@ -105,7 +165,8 @@ def main():
     if len(groups) > 1:
         raise RuntimeError('Too many group directories in data directory')
     # Call function to validate data in data directory
-    validate_data(groups[0])
+    validate_data(groups[0], jobs=args.jobs, build_indices=args.build_index,
+                  manifest=args.manifest)
 
 
 if __name__ == "__main__":